@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Record entity XML from the BioCyc web services as benchmark fixtures
+
+    python -m benchmarks.record benchmarks/fixtures ECOLI PWY0-1319 GLYCOLYSIS --depth 2
+
+Writes <dir>/<org_id>/<id>.xml for each object, following its relationships up
+to --depth levels, for serving with python -m benchmarks.run --fixtures <dir>.
+
+"""
+import argparse
+import os
+
+try:
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
+
+from biocyc import biocyc
+from biocyc.stores import mkdir_p
+
+
+def record(path, org_id, ids, depth=1):
+    '''
+    Request ids (and related objects to depth) and write the XML for each, returning the number written
+    '''
+    org_path = os.path.join(path, org_id)
+    mkdir_p(org_path)
+
+    seen = set()
+    count = 0
+    for _ in range(depth + 1):
+        ids = [id for id in ids if id not in seen]
+        seen.update(ids)
+        related = []
+
+        for n in range(0, len(ids), biocyc.max_ids_per_request):
+            batch = ids[n:n + biocyc.max_ids_per_request]
+            xml = biocyc.request_objs(org_id, batch)
+            if xml is None:
+                continue
+
+            for element in xml:
+                id = element.attrib.get('frameid')
+                if id not in batch:
+                    continue
+                with open(os.path.join(org_path, '%s.xml' % id), 'wb') as f:
+                    f.write( et.tostring(element) )
+                count += 1
+
+                related.extend( ref.attrib['frameid'] for ref in element.iter() if ref is not element and 'resource' in ref.attrib and ref.attrib.get('orgid') == org_id )
+
+        ids = related
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record BioCyc entity XML as benchmark fixtures')
+    parser.add_argument('path', help='fixtures folder')
+    parser.add_argument('org_id', help='organism database identifier, e.g. ECOLI')
+    parser.add_argument('ids', nargs='+', help='objects to start from')
+    parser.add_argument('--depth', type=int, default=1, help='levels of related objects to follow')
+    args = parser.parse_args()
+
+    print('%d objects recorded' % record(args.path, args.org_id, args.ids, args.depth))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks against a local stand-in BioCyc server
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --latency 0.05 --error-rate 0.02 --workers 4 bulk_load_cold
+    python -m benchmarks.run --fixtures benchmarks/fixtures --org ECOLI
+
+Each benchmark starts from an empty cache folder (cold) or one filled by the
+benchmark before it (warm), with no rate limit. Results are written as JSON,
+one entry per benchmark with the elapsed time, objects handled, server requests
+and the counters and timings recorded by biocyc.metrics.
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
+
+from biocyc import biocyc
+from biocyc.stores import LRUMemoryCache, SQLiteStore
+
+from .server import BioCycServer, Corpus, synthetic_corpus
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+# Attributes of the shared biocyc instance replaced by use_cache, restored after the run
+CACHE_STATE = ['cache_path', 'cache_store', 'secondary_cache_paths', 'secondary_cache_stores',
+               '_locals', '_known', '_networks', '_memberships', 'memory_cache']
+
+
+def use_cache(path):
+    '''
+    Point the shared biocyc instance at an empty cache folder, with new cache state
+    '''
+    biocyc.cache_path = path
+    biocyc.cache_store = None
+    biocyc.secondary_cache_paths = []
+    biocyc.secondary_cache_stores = []
+    biocyc._locals = {}
+    biocyc._known = {}
+    biocyc._networks = {}
+    biocyc._memberships = {}
+    biocyc.memory_cache = LRUMemoryCache(biocyc.memory_cache.max_bytes)
+
+
+class Context(object):
+    def __init__(self, corpus, server, org_id, workdir, workers):
+        self.corpus = corpus
+        self.server = server
+        self.org_id = org_id
+        self.workdir = workdir
+        self.workers = workers
+        self.caches = 0
+
+    def ids(self, tag=None):
+        return sorted( self.corpus.ids(self.org_id, tag) )
+
+    def cold(self):
+        self.caches += 1
+        use_cache( os.path.join(self.workdir, 'cache-%d' % self.caches) )
+
+
+def _responses(ctx):
+    ids = ctx.ids()
+    size = biocyc.max_ids_per_request
+    responses = []
+    for n in range(0, len(ids), size):
+        batch = ids[n:n + size]
+        xml = ''.join( ctx.corpus.xml(ctx.org_id, id) for id in batch )
+        responses.append( (batch, ('<ptools-xml><metadata/>%s</ptools-xml>' % xml).encode('utf-8')) )
+    return responses
+
+
+@benchmark
+def parse(ctx):
+    '''
+    Parse getxml responses and create the objects in batches, without the server
+
+    Enzymatic reactions found in reactions are cached as they are imported, so this
+    starts from an empty cache folder like the cold benchmarks.
+    '''
+    ctx.cold()
+    responses = _responses(ctx)
+
+    def run():
+        count = 0
+        for batch, response in responses:
+            count += len( biocyc.create_objs_from_xml(batch, et.fromstring(response), ctx.org_id) )
+        return count
+    return run
+
+
+@benchmark
+def parse_per_object(ctx):
+    '''
+    As parse, creating each object from the response separately
+    '''
+    ctx.cold()
+    responses = _responses(ctx)
+
+    def run():
+        count = 0
+        for batch, response in responses:
+            xml = et.fromstring(response)
+            for id in batch:
+                biocyc.create_obj_from_xml(id, xml, ctx.org_id)
+                count += 1
+        return count
+    return run
+
+
+@benchmark
+def bulk_load_cold(ctx):
+    ctx.cold()
+    return lambda: len( biocyc.get_for_org(ctx.org_id, ctx.ids(), workers=ctx.workers) )
+
+
+@benchmark
+def bulk_load_warm_memory(ctx):
+    return lambda: len( biocyc.get_for_org(ctx.org_id, ctx.ids(), workers=ctx.workers) )
+
+
+@benchmark
+def bulk_load_warm_disk(ctx):
+    biocyc.memory_cache.clear()
+    return lambda: len( biocyc.get_for_org(ctx.org_id, ctx.ids(), workers=ctx.workers) )
+
+
+def _traverse(ctx, tag, relation):
+    def run():
+        count = 0
+        for obj in biocyc.get_for_org(ctx.org_id, ctx.ids(tag), workers=ctx.workers):
+            count += 1 + len( getattr(obj, relation) )
+        return count
+    return run
+
+
+@benchmark
+def pathway_compounds_cold(ctx):
+    ctx.cold()
+    return _traverse(ctx, 'Pathway', 'compounds')
+
+
+@benchmark
+def pathway_compounds_warm(ctx):
+    return _traverse(ctx, 'Pathway', 'compounds')
+
+
+@benchmark
+def protein_pathways_cold(ctx):
+    ctx.cold()
+    return _traverse(ctx, 'Protein', 'pathways')
+
+
+@benchmark
+def protein_pathways_warm(ctx):
+    return _traverse(ctx, 'Protein', 'pathways')
+
+
+def _store_read(ctx, store):
+    ids = ctx.ids()
+    def run():
+        count = 0
+        for n in range(0, len(ids), 500):
+            count += len( store.get_many(ctx.org_id, ids[n:n + 500]) )
+        return count
+    return run
+
+
+def _filled_cache(ctx):
+    ctx.cold()
+    biocyc.get_for_org(ctx.org_id, ctx.ids(), workers=ctx.workers)
+    return biocyc.primary_cache_store
+
+
+@benchmark
+def cache_read_pickle(ctx):
+    return _store_read(ctx, _filled_cache(ctx))
+
+
+@benchmark
+def cache_read_sqlite(ctx):
+    store = SQLiteStore( os.path.join(ctx.workdir, 'cache-%d.sqlite' % ctx.caches) )
+    store.import_pickle_directory( _filled_cache(ctx).path )
+    return _store_read(ctx, store)
+
+
+@benchmark
+def cache_read_bundle(ctx):
+    _filled_cache(ctx)
+    path = os.path.join(ctx.workdir, 'cache-%d.bundle' % ctx.caches)
+    biocyc.export_bundle(path, ctx.org_id)
+    return _store_read(ctx, biocyc.add_bundle(path))
+
+
+def measure(ctx, name, repeat):
+    '''
+    Run benchmark name repeat times (setup excluded) and return the result of the fastest run
+    '''
+    best = None
+    for _ in range(repeat):
+        run = BENCHMARKS[name](ctx)
+        ctx.server.reset_counts()
+        with biocyc.metrics.collect() as stats:
+            start = time.perf_counter()
+            objects = run()
+            elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best['seconds']:
+            best = {
+                'name': name,
+                'seconds': elapsed,
+                'objects': objects,
+                'objects_per_second': objects / elapsed if elapsed else None,
+                'requests': ctx.server.requests,
+                'injected_errors': ctx.server.errors,
+                'metrics': stats.as_dict(),
+            }
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the biocyc benchmarks against a local stand-in server')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default all): %s' % ', '.join(BENCHMARKS))
+    parser.add_argument('--output', help='write the JSON results to this file (default stdout)')
+    parser.add_argument('--fixtures', help='serve recorded fixtures (<dir>/<org_id>/<id>.xml) instead of a synthetic corpus')
+    parser.add_argument('--org', default='BENCH', help='organism to benchmark')
+    parser.add_argument('--pathways', type=int, default=50, help='synthetic corpus size, in pathways')
+    parser.add_argument('--reactions', type=int, default=10, help='synthetic reactions per pathway')
+    parser.add_argument('--compounds', type=int, default=500, help='synthetic compounds')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each server response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a (retried) 503 response')
+    parser.add_argument('--workers', type=int, default=1, help='concurrent requests in get_for_org')
+    parser.add_argument('--batch', type=int, default=biocyc.max_ids_per_request, help='objects per getxml request')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest is reported')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+
+    if args.fixtures:
+        corpus = Corpus.load(args.fixtures)
+    else:
+        corpus = synthetic_corpus(args.org, args.pathways, args.reactions, args.compounds)
+
+    workdir = tempfile.mkdtemp(prefix='biocyc-benchmark-')
+    server = BioCycServer(corpus, latency=args.latency, error_rate=args.error_rate)
+    saved = (biocyc.base_url, biocyc.rate_limiter, biocyc.max_ids_per_request, biocyc.backoff_factor)
+    saved_cache = dict( (name, getattr(biocyc, name)) for name in CACHE_STATE )
+    try:
+        server.start()
+        biocyc.base_url = server.url
+        biocyc.set_rate_limit(1e6, 1000)
+        biocyc.max_ids_per_request = args.batch
+        biocyc.backoff_factor = 0.01
+
+        ctx = Context(corpus, server, args.org, workdir, args.workers)
+        ctx.cold() # Never touch the real cache, whichever benchmark runs first
+        results = [measure(ctx, name, args.repeat) for name in (args.benchmarks or BENCHMARKS)]
+
+    finally:
+        server.stop()
+        biocyc.base_url, biocyc.rate_limiter, biocyc.max_ids_per_request, biocyc.backoff_factor = saved
+        for name, value in saved_cache.items():
+            setattr(biocyc, name, value)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict( (k, v) for k, v in vars(args).items() if k not in ('benchmarks', 'output') ),
+        'entities': len(corpus),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the BioCyc web services
+
+Serves getxml (one or more comma-separated ORG:ID) and apixml get-class-all-instances
+from a corpus of entity XML, either synthetic (see synthetic_corpus) or recorded
+from the real service (see record.py), with optional latency and error injection.
+
+    server = BioCycServer(synthetic_corpus(), latency=0.05, error_rate=0.01)
+    server.start()
+    biocyc.base_url = server.url
+    ...
+    server.stop()
+
+"""
+import os
+import random
+import threading
+import time
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
+
+# Classes listed by apixml get-class-all-instances, to the entity element tag
+CLASS_TAGS = {
+    'Pathways': 'Pathway',
+    'Compounds': 'Compound',
+    'Reactions': 'Reaction',
+    'Proteins': 'Protein',
+    'Genes': 'Gene',
+}
+
+
+class Corpus(object):
+    '''
+    Entity XML keyed by (org_id, frame ID), with the element tag of each entity
+    '''
+    def __init__(self):
+        self.entities = {} # (org_id, id): (tag, xml)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def add(self, org_id, id, tag, xml):
+        self.entities[org_id, id] = (tag, xml)
+
+    def ids(self, org_id, tag=None):
+        return [id for (o, id), (t, _) in self.entities.items() if o == org_id and (tag is None or t == tag)]
+
+    def xml(self, org_id, id):
+        entity = self.entities.get( (org_id, id) )
+        return entity[1] if entity else None
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load recorded fixtures from <path>/<org_id>/<id>.xml, each holding one entity element
+        '''
+        corpus = cls()
+        for org_id in sorted(os.listdir(path)):
+            org_path = os.path.join(path, org_id)
+            if not os.path.isdir(org_path):
+                continue
+            for filename in os.listdir(org_path):
+                if filename.endswith('.xml'):
+                    with open(os.path.join(org_path, filename), 'r') as f:
+                        xml = f.read().strip()
+                    tag = et.fromstring(xml).tag
+                    corpus.add(org_id, filename[:-4], tag, xml)
+        return corpus
+
+
+def _ref(tag, org_id, id):
+    return '<%s resource="getxml?%s:%s" orgid="%s" frameid="%s"/>' % (tag, org_id, id, org_id, id)
+
+
+def _entity(tag, org_id, id, body):
+    return '<%s ID="%s:%s" orgid="%s" frameid="%s" detail="full"><parent>%s</parent>%s</%s>' % (
+        tag, org_id, id, org_id, id, _ref(tag, org_id, tag + 's'), ''.join(body), tag)
+
+
+def synthetic_corpus(org_id='BENCH', pathways=50, reactions_per_pathway=10, compounds=500, seed=0):
+    '''
+    Generate a corpus of connected pathways, reactions, enzymatic reactions, proteins,
+    genes and compounds, in the same shape as the BioCyc getxml output
+    '''
+    rng = random.Random(seed)
+    corpus = Corpus()
+    compound_reactions = dict( (n, ([], [])) for n in range(compounds) )
+
+    for p in range(pathways):
+        pathway = 'PWY-%d' % p
+        reactions = []
+        for r in range(reactions_per_pathway):
+            reaction = 'RXN-%d-%d' % (p, r)
+            enzrxn, protein, gene = 'ENZRXN-%d-%d' % (p, r), 'PROT-%d-%d' % (p, r), 'G-%d-%d' % (p, r)
+            reactions.append(reaction)
+
+            left, right = rng.sample(range(compounds), 2), rng.sample(range(compounds), 2)
+            for c in left:
+                compound_reactions[c][0].append(reaction)
+            for c in right:
+                compound_reactions[c][1].append(reaction)
+
+            corpus.add(org_id, reaction, 'Reaction', _entity('Reaction', org_id, reaction, [
+                '<common-name datatype="string">reaction %d-%d</common-name>' % (p, r),
+                '<ec-number>EC-%d.%d.%d.%d</ec-number>' % (1 + r % 6, p % 20, r, p),
+                '<enzymatic-reaction><Enzymatic-Reaction orgid="%s" frameid="%s" detail="low"><common-name datatype="string">enzrxn %d-%d</common-name><enzyme>%s</enzyme><reaction>%s</reaction></Enzymatic-Reaction></enzymatic-reaction>' % (
+                    org_id, enzrxn, p, r, _ref('Protein', org_id, protein), _ref('Reaction', org_id, reaction)),
+                '<in-pathway>%s</in-pathway>' % _ref('Pathway', org_id, pathway),
+                '<left>%s</left>' % ''.join(_ref('Compound', org_id, 'CPD-%d' % c) for c in left),
+                '<right>%s</right>' % ''.join(_ref('Compound', org_id, 'CPD-%d' % c) for c in right),
+                '<reaction-direction>LEFT-TO-RIGHT</reaction-direction>',
+            ]))
+            corpus.add(org_id, enzrxn, 'Enzymatic-Reaction', _entity('Enzymatic-Reaction', org_id, enzrxn, [
+                '<common-name datatype="string">enzrxn %d-%d</common-name>' % (p, r),
+                '<enzyme>%s</enzyme>' % _ref('Protein', org_id, protein),
+                '<reaction>%s</reaction>' % _ref('Reaction', org_id, reaction),
+            ]))
+            corpus.add(org_id, protein, 'Protein', _entity('Protein', org_id, protein, [
+                '<common-name datatype="string">protein %d-%d</common-name>' % (p, r),
+                '<synonym datatype="string">enzyme %d-%d</synonym>' % (p, r),
+                '<gene>%s</gene>' % _ref('Gene', org_id, gene),
+                '<catalyzes>%s</catalyzes>' % _ref('Enzymatic-Reaction', org_id, enzrxn),
+                '<molecular-weight-seq datatype="float">%.1f</molecular-weight-seq>' % rng.uniform(10, 200),
+            ]))
+            corpus.add(org_id, gene, 'Gene', _entity('Gene', org_id, gene, [
+                '<common-name datatype="string">gene%d%d</common-name>' % (p, r),
+                '<product>%s</product>' % _ref('Protein', org_id, protein),
+                '<dblink><dblink-db>UNIPROT</dblink-db><dblink-oid>P%05d</dblink-oid></dblink>' % (p * 100 + r),
+            ]))
+
+        corpus.add(org_id, pathway, 'Pathway', _entity('Pathway', org_id, pathway, [
+            '<common-name datatype="string">pathway %d</common-name>' % p,
+            '<synonym datatype="string">synthetic pathway %d</synonym>' % p,
+            '<reaction-list>%s</reaction-list>' % ''.join(_ref('Reaction', org_id, r) for r in reactions),
+        ]))
+
+    for c, (left_of, right_of) in compound_reactions.items():
+        compound = 'CPD-%d' % c
+        body = [
+            '<common-name datatype="string">compound %d</common-name>' % c,
+            '<synonym datatype="string">synthetic compound %d</synonym>' % c,
+            '<molecular-weight datatype="float">%.3f</molecular-weight>' % rng.uniform(20, 800),
+            '<inchi datatype="string">InChI=1S/C%dH%d/c%d</inchi>' % (c % 30 + 1, c % 50 + 2, c),
+            '<dblink><dblink-db>CAS</dblink-db><dblink-oid>%d-00-0</dblink-oid></dblink>' % c,
+        ]
+        if left_of:
+            body.append('<appears-in-left-side-of>%s</appears-in-left-side-of>' % ''.join(_ref('Reaction', org_id, r) for r in left_of))
+        if right_of:
+            body.append('<appears-in-right-side-of>%s</appears-in-right-side-of>' % ''.join(_ref('Reaction', org_id, r) for r in right_of))
+        corpus.add(org_id, compound, 'Compound', _entity('Compound', org_id, compound, body))
+
+    return corpus
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.biocyc_server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        server.count_request()
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.inject_error():
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+
+        if url.path.endswith('/getxml'):
+            entities = []
+            for full_id in query.get('id', [''])[0].split(','):
+                org_id, _, id = full_id.partition(':')
+                xml = server.corpus.xml(org_id, id)
+                if xml is not None:
+                    entities.append(xml)
+
+            if not entities: # As the real service, for a single unknown object
+                self.send_response(404)
+                self.end_headers()
+                return
+            self._send_xml(entities)
+
+        elif url.path.endswith('/apixml') and query.get('fn', [''])[0] == 'get-class-all-instances':
+            org_id, _, cls = query.get('id', [''])[0].partition(':')
+            tag = CLASS_TAGS.get(cls)
+            self._send_xml(['<%s ID="%s:%s" orgid="%s" frameid="%s"/>' % (tag, org_id, id, org_id, id) for id in server.corpus.ids(org_id, tag)])
+
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def _send_xml(self, entities):
+        body = ('<ptools-xml ptools-version="benchmark"><metadata/>%s</ptools-xml>' % ''.join(entities)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BioCycServer(object):
+    '''
+    Threaded HTTP server for a corpus on localhost
+
+    latency is added to every response (seconds); error_rate is the probability of
+    a 503 response, which clients are expected to retry.
+    '''
+    def __init__(self, corpus, latency=0.0, error_rate=0.0, port=0, seed=0):
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.biocyc_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def inject_error(self):
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='biocyc-benchmark-server')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
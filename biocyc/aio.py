@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio interface to the BioCyc REST API
+
+AsyncBioCyc wraps a BioCyc instance, sharing its memory/disk caches and rate limit,
+so synchronous and asynchronous code can be mixed freely. Requests are made with
+aiohttp when it is installed, otherwise they are passed to the loop's default executor.
+Cache reads and writes are also run in the default executor, so the event loop is
+never blocked on disk. Fetches are single-flight with the synchronous client and other
+processes sharing the cache: each ID is claimed before it is requested, and IDs claimed
+elsewhere are awaited until they appear in the cache.
+
+    from biocyc.aio import AsyncBioCyc
+
+    async with AsyncBioCyc() as abc:
+        p = await abc.get('PWY-6713')
+        compounds = await abc.related(p, 'compounds')
+
+"""
+import asyncio
+import functools
+
+from collections import OrderedDict
+
+# aiohttp and ElementTree are imported when first needed, as in biocyc.biocyc
+
+from .biocyc import biocyc as default_biocyc, clean, returned, RETRY_STATUS_CODES, BioCycEntityUnavailable
+from .exceptions import BioCycRequestError, BioCycOfflineError
+from .locking import claim, release
+from .transport import HTTPTransport
+
+_aiohttp = False # Not yet imported, None if not installed
+
+
+def get_aiohttp():
+    '''
+    Return the aiohttp module, imported on first use, or None if it is not installed
+    '''
+    global _aiohttp
+    if _aiohttp is False:
+        try:
+            import aiohttp
+        except ImportError:
+            aiohttp = None
+        _aiohttp = aiohttp
+    return _aiohttp
+
+
+class AsyncBioCyc(object):
+    '''
+    Asynchronous counterpart to the BioCyc get/get_for_org methods and entity relationship properties
+    '''
+    def __init__(self, biocyc=None, max_concurrency=8):
+        self.biocyc = biocyc or default_biocyc
+        self.max_concurrency = max_concurrency
+
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def requestxml(self, url, params):
+        '''
+        Request url and return the parsed XML, or None if the server reports the object does not exist
+
+        Retries follow the same policy (max_retries, backoff, Retry-After) as BioCyc.requestxml
+        '''
+        from xml.etree import ElementTree as et
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        bc = self.biocyc
+        metrics = bc.metrics
+        aiohttp = get_aiohttp()
+        network_errors = bc.transport.errors + (asyncio.TimeoutError,) + ((aiohttp.ClientError,) if aiohttp is not None else ())
+        for attempt in range(bc.max_retries + 1):
+            if attempt:
+                metrics.count('http.retry')
+                await asyncio.sleep( bc.retry_delay(attempt - 1, retry_after) )
+
+            retry_after = None
+
+            try:
+                status, headers, content = await self._get(url, params)
+            except network_errors as e:
+                error = e
+                continue
+
+            metrics.count('http.bytes', len(content))
+            if status == 200:
+                try:
+                    # Parse and return the XML
+                    with metrics.timer('xml.parse'):
+                        return et.fromstring(content)
+                except et.ParseError as e: # Truncated response
+                    error = e
+
+            elif status == 404:
+                return None
+
+            elif status in RETRY_STATUS_CODES:
+                error = 'HTTP %d' % status
+                retry_after = headers.get('Retry-After')
+
+            else:
+                raise BioCycRequestError('HTTP %d for %s' % (status, url))
+
+        raise BioCycRequestError('%s for %s after %d attempts' % (error, url, bc.max_retries + 1))
+
+    async def _get(self, url, params):
+        r = self.biocyc.transport.lookup(url, params)
+        if r is not None:
+            return r.status_code, r.headers, r.content
+
+        async with self._semaphore:
+            # Wait so we don't hammer server, sharing the budget with synchronous requests
+            wait = self.biocyc.rate_limiter.reserve()
+            self.biocyc.metrics.timing('ratelimit.wait', max(wait, 0.0))
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            with self.biocyc.metrics.timer('http.request'):
+                return await self._request(url, params)
+
+    async def _request(self, url, params):
+        transport = self.biocyc.transport
+        aiohttp = get_aiohttp()
+        if aiohttp is not None and type(transport) is HTTPTransport:
+            if self._session is None:
+                connect, read = self.biocyc.timeout
+                self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+
+            async with self._session.get(url, params=params) as r:
+                return r.status, r.headers, await r.read()
+
+        else:
+            loop = asyncio.get_running_loop()
+            r = await loop.run_in_executor(None, lambda: transport.get(url, params, timeout=self.biocyc.timeout))
+            return r.status_code, r.headers, r.content
+
+    async def request_objs(self, org_id, objs):
+        ids = ','.join( ['%s:%s' % (org_id, obj) for obj in objs] )
+        return await self.requestxml( self.biocyc.base_url + '/getxml', {'id': ids, 'detail': self.biocyc.detail } )
+
+    async def get(self, ids, skip_cache=False):
+        return await self.get_for_org(self.biocyc.org_id, ids, skip_cache=skip_cache)
+
+    async def get_for_org(self, org_id, ids, skip_cache=False):
+        '''
+        Returns objects for the given identifiers
+        If called with a list returns a list, else returns a single entity
+
+        Cache misses are requested in batches of max_ids_per_request, with all
+        batches in flight at once (limited by max_concurrency and the rate limit).
+        As BioCyc.get_for_org, ids being requested by another thread or process are
+        waited for rather than requested again
+        '''
+        single = not isinstance(ids, (list, tuple))
+        if single:
+            ids = [ids]
+
+        valid = [id for id in OrderedDict.fromkeys(ids) if id != '' and type(id) is str] # Skip empty string and duplicates
+
+        if skip_cache == False:
+            loop = asyncio.get_running_loop()
+            objs = await loop.run_in_executor(None, self.biocyc.get_many_from_cache, org_id, valid)
+        else:
+            objs = {}
+
+        missing = [id for id in valid if id not in objs]
+        if missing:
+            objs.update( await self._fetch_single_flight(org_id, missing, recheck=not skip_cache) )
+
+        objs = [returned(objs.get(id)) for id in ids]
+
+        if single:
+            return objs[0]
+        else:
+            return objs
+
+    def _claim(self, org_id, ids):
+        return [id for id in ids if claim( self.biocyc._claim_path(org_id, id), self.biocyc.claim_timeout )]
+
+    def _release(self, org_id, ids):
+        for id in ids:
+            release( self.biocyc._claim_path(org_id, id) )
+
+    async def _fetch_single_flight(self, org_id, ids, recheck=True):
+        # As BioCyc._fetch_single_flight, with the claim files handled in the executor
+        loop = asyncio.get_running_loop()
+        claimed = await loop.run_in_executor(None, self._claim, org_id, ids)
+        objs = await self._fetch_claimed(org_id, claimed, recheck)
+        waiting = [id for id in ids if id not in objs]
+
+        while waiting:
+            await asyncio.sleep(self.biocyc.claim_poll_interval)
+            objs.update( await loop.run_in_executor(None, functools.partial(self.biocyc.get_many_from_cache, org_id, waiting, stale=False)) )
+            waiting = [id for id in waiting if id not in objs]
+
+            claimed = await loop.run_in_executor(None, self._claim, org_id, waiting)
+            objs.update( await self._fetch_claimed(org_id, claimed) )
+            waiting = [id for id in waiting if id not in objs]
+
+        return objs
+
+    async def _fetch_claimed(self, org_id, ids, recheck=True):
+        # Each batch is cached (in _import_batch) before the claims are released
+        loop = asyncio.get_running_loop()
+        try:
+            # Another process may have cached them between our cache check and the claim
+            objs = await loop.run_in_executor(None, functools.partial(self.biocyc.get_many_from_cache, org_id, ids, stale=False)) if recheck and ids else {}
+            missing = [id for id in ids if id not in objs]
+
+            n = self.biocyc.max_ids_per_request
+            batches = [missing[i:i + n] for i in range(0, len(missing), n)]
+            for fetched in await asyncio.gather(*[self._fetch_batch(org_id, batch) for batch in batches]):
+                objs.update(fetched)
+            return objs
+
+        finally:
+            await loop.run_in_executor(None, self._release, org_id, ids)
+
+    async def _fetch_batch(self, org_id, ids):
+        try:
+            xml = await self.request_objs(org_id, ids)
+        except BioCycOfflineError:
+            if not self.biocyc.unavailable_markers:
+                raise
+            return dict( (id, BioCycEntityUnavailable(id, org_id)) for id in ids )
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._import_batch, org_id, ids, xml)
+
+    def _import_batch(self, org_id, ids, xml):
+        # Creates and caches the objects, run in the executor as it writes to the cache
+        with self.biocyc.buffered_writes():
+            with self.biocyc.metrics.timer('xml.import'):
+                objs = self.biocyc.create_objs_from_xml(ids, xml, org_id)
+            with self.biocyc.metrics.timer('cache.write'):
+                for obj in objs.values():
+                    self.biocyc.cache(obj)
+            self.biocyc.metrics.count('xml.import.objects', len(objs))
+            self.biocyc.metrics.count('cache.write.objects', len(objs))
+        return objs
+
+    async def related(self, obj, name):
+        '''
+        Awaitable equivalent of the relationship property name on obj, e.g.
+        await related(pathway, 'reactions') for pathway.reactions
+        '''
+        if name in obj.relationships:
+            return await self.get_for_org(obj.org_id, getattr(obj, obj.relationships[name], None))
+
+        elif name in obj.derived_relationships:
+            results = []
+            for path in obj.derived_relationships[name]:
+                results.extend( await self._follow(obj, path) )
+            return results
+
+        else:
+            raise AttributeError("'%s' has no relationship '%s'" % (type(obj).__name__, name))
+
+    async def _follow(self, obj, path):
+        r = await self.related(obj, path[0])
+        rs = clean(r) if type(r) == list else clean([r])
+        if len(path) == 1:
+            return rs
+
+        # Follow the remaining path from every object at this step concurrently
+        results = []
+        for l in await asyncio.gather(*[self._follow(o, path[1:]) for o in rs]):
+            results.extend(l)
+        return results
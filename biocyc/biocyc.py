@@ -13,34 +13,21 @@ May 2014
 """
 
 import os
-import errno
-import pickle
-import requests
-import time
 import csv
 import logging
 import re
+import sys
+import threading
+import time
+import zlib
 
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict, OrderedDict
+from queue import Queue, Empty
 
-try:
-    import xml.etree.cElementTree as et
-except ImportError:
-    import xml.etree.ElementTree as et
-
-try:
-    # Python 2.x
-    import HTMLParser
-    html = HTMLParser.HTMLParser()
-except:
-    # Python 3+
-    try:
-        import html.parser
-        html = html.parser.HTMLParser()
-    except:
-        # Python 3.5
-        import html
+# requests, ElementTree, concurrent.futures and email.utils are imported when first
+# needed, so that importing biocyc stays fast for short-lived scripts and workers
 
 strip_tags_re = re.compile(r'<[^>]*?>')
 strip_entities_re = re.compile(r'[&;]*') 
@@ -52,8 +39,18 @@ type_converter = {
 }
 
 
-from .exceptions import BioCycObjectNotFound, BioCycInvalidExpiry, BioCycInvalidDetailLevel
+from .exceptions import BioCycObjectNotFound, BioCycInvalidExpiry, BioCycInvalidDetailLevel, BioCycRequestError, BioCycOfflineError
 from .singleton import Singleton
+from .ratelimit import TokenBucket
+from .bundle import BundleStore, export_bundle
+from .names import NameIndex, NAME_TABLES
+from .network import NetworkIndex
+from .enrichment import PathwayMembership
+from .locking import file_lock, claim, release
+from .metrics import Metrics
+from . import serialize
+from .stores import mkdir_p, atomic_write, LRUMemoryCache, PickleDirectoryStore, SQLiteStore
+from .transport import HTTPTransport, OfflineTransport, ArchiveTransport
 
 
 DETAIL_NONE = 'none'
@@ -61,6 +58,20 @@ DETAIL_LOW = 'low'
 DETAIL_FULL = 'full'
 
 DEFAULT_RECORD_EXPIRY = timedelta(weeks=6*4) # Expire after 6 months
+DEFAULT_EXPIRY_JITTER = 0.1 # Objects expire up to 10% early, spreading out refreshes
+DEFAULT_REFRESH_RATE = 0.2 # Background refresh batches per second
+
+DEFAULT_MEMORY_CACHE_BYTES = 256 * 1024 * 1024 # Approximate, by record size
+
+DEFAULT_NETWORK_JOURNAL_EDGES = 50000 # Journalled network edges compacted into the arrays, see BioCyc._write
+
+DEFAULT_REQUEST_RATE = 1.0 # Requests per second
+DEFAULT_REQUEST_BURST = 1
+
+DEFAULT_BASE_URL = 'http://websvc.biocyc.org' # Web services, e.g. a local mirror for testing
+
+DEFAULT_REQUEST_TIMEOUT = (10, 60) # Connect, read (seconds)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
 
 DBLINK_URLS = {
     'BIOPATH': "http://www.molecular-networks.com/biopath3/biopath/mols/%s",
@@ -86,16 +97,6 @@ REACTION_DIRECTIONS = {
     'PHYSIOL-RIGHT-TO-LEFT': 'back'
     }
 
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
-        pass
-
 def to_plain_text(str):
     '''
     Return a plain-text version of a given string
@@ -112,6 +113,63 @@ def to_plain_text(str):
     return str
     
 clean = lambda l: [i for i in l if i]    
+
+def returned(obj):
+    # Not found (BioCycEntityNotFound) and invalid identifiers are returned as None,
+    # objects unavailable offline as their BioCycEntityUnavailable markers
+    return obj if obj or isinstance(obj, BioCycEntityUnavailable) else None
+
+def intern_id(id):
+    return sys.intern(id) if type(id) is str else id
+
+def intern_ids(ids):
+    return tuple( intern_id(id) for id in ids )
+
+# Kinds of entity field imported from the children of an entity element, see
+# BioCycEntityBase.xml_fields
+XML_TEXT = 'text' # Text of the first element (or its first path child), converted by datatype
+XML_ID = 'id' # Frame ID of the first path child
+XML_IDS = 'ids' # Frame IDs of all path children (all children for path None) of all elements
+XML_CALL = 'call' # Method called with each element
+
+def extend_xml_fields(fields, extra):
+    '''
+    Return xml_fields with the fields in extra added, for a subclass
+    '''
+    fields = dict(fields)
+    for tag, specs in extra.items():
+        fields[tag] = fields.get(tag, ()) + tuple(specs)
+    return fields
+
+def id_list_fields(fields):
+    '''
+    Return the attributes set by XML_IDS fields, which are set (if empty) on every import
+    '''
+    return tuple(sorted( set( var for specs in fields.values() for kind, path, var in specs if kind == XML_IDS ) ))
+
+def index_xml(xml):
+    '''
+    Index the object elements of a returned XML document by upper-case frameid, in a
+    single pass. Where a frameid appears more than once the element of the earliest type
+    in AVAILABLE_OBJECT_TYPES is used, and of those the first
+    '''
+    ranks = OBJECT_TYPE_RANKS
+    elements = {}
+    for x in xml:
+        rank = ranks.get(x.tag)
+        if rank is None:
+            continue
+        id = x.attrib.get('frameid')
+        key = id.upper() if id is not None else None
+        current = elements.get(key)
+        if current is None or rank < ranks[current.tag]:
+            elements[key] = x
+    return elements
+
+# Attributes renamed since earlier versions, converted when unpickling
+RENAMED_ATTRIBUTES = {
+    'component_coeffecient': 'component_coefficient',
+}
     
 
 class BioCyc(object):
@@ -120,36 +178,107 @@ class BioCyc(object):
     """
     Basic tools for querying a specific organism via Pathway Tools/BioCyc web API
     """
-    _hammer_lock = None
-    _hammer_delay = timedelta(seconds=1)
-
-    def __init__(self):
-        self.secondary_cache_paths = [] # Not yet implemented
-        self.cache_path = os.path.join( os.path.expanduser('~'), '.biocyc' )
-        self.memory_cache = defaultdict( OrderedDict )
-        self.max_memory_cache = 50000
 
+    def __init__(self, cache_path=None, organism='HUMAN'):
+        '''
+        Nothing is created on disk, and no network libraries are imported, until first used
+        '''
+        self.secondary_cache_paths = [] # Read-only pickle directories
+        self.secondary_cache_stores = [] # Read-only stores (e.g. bundles), checked after secondary_cache_paths
+        self.cache_path = cache_path or os.path.join( os.path.expanduser('~'), '.biocyc' )
+        self.cache_store = None # Primary store, default pickle files under cache_path
+        self.compression = None # Of cached records, see set_compression
+        self._default_stores = {}
+        self._locals = {} # Known object indexes by (org_id, table)
+        self._known = {} # KnownObjects by (org_id, table), until more are added to the index
+        self._name_indexes = {}
+        self._networks = {} # Loaded network indexes by org_id, updated by cache
+        self.network_journal_edges = DEFAULT_NETWORK_JOURNAL_EDGES
+        self._memberships = {} # Pathway membership matrices by (org_id, kind, rollup), see pathway_membership
+        self.memory_cache = LRUMemoryCache(DEFAULT_MEMORY_CACHE_BYTES) # Shared by all organisms
+        self.max_ids_per_request = 50 # Objects requested per getxml call
+        self.max_workers = 1 # Concurrent requests in get_for_org
+
+        self.metrics = Metrics() # Counters and timings, see biocyc.metrics
+
+        # Guards the memory cache and writes to the disk cache across worker threads
+        self._lock = threading.RLock()
+
+        # Write-behind: objects cached within buffered_writes are held here and written in
+        # batches, once write_buffer_size are waiting or the oldest has waited write_buffer_delay seconds
+        # (checked when the next object is cached, there is no background flush)
+        self.write_buffer_size = 1000
+        self.write_buffer_delay = 5.0
+        self._write_buffer = OrderedDict() # (org_id, id): obj
+        self._write_buffer_since = None
+        self._buffering = threading.local() # Nesting depth of buffered_writes, per thread
+
+        # Cross-process single-flight: seconds before another process' claim on an id is
+        # considered abandoned, and how often to check for the object while waiting
+        self.claim_timeout = 300
+        self.claim_poll_interval = 0.2
+
+        # Requests go through the transport, by default a pooled HTTP session created on first request
+        self.base_url = DEFAULT_BASE_URL
+        self._transport = None
+        self.unavailable_markers = False # Return BioCycEntityUnavailable, rather than raise, when offline
+        self.timeout = DEFAULT_REQUEST_TIMEOUT
+        self.max_retries = 5
+        self.backoff_factor = 1.0 # Seconds, doubled on each retry
+        self.max_backoff = 120
+
+        self.set_rate_limit(DEFAULT_REQUEST_RATE, DEFAULT_REQUEST_BURST)
         self.set_detail(DETAIL_FULL)
-        self.set_organism('HUMAN')
+        self.set_organism(organism)
         
         self.expire_records_after = DEFAULT_RECORD_EXPIRY
+        self.expiry_jitter = DEFAULT_EXPIRY_JITTER
         
-    def _get_locals(self, table):
-        if table in self._locals:
-            return self._locals[table]
-        else:
-            lt = []
-            for cache_path in [self.cache_path] + self.secondary_cache_paths:
-                try:
-                    with open( os.path.join( cache_path, self.org_id, table), 'rU') as f:
-                        reader = csv.reader(f)
-                        for row in reader:
-                            lt.append( self.get(row[0]) )
-                except:
-                    continue
+        # Stale-while-revalidate: serve expired objects and refresh them in a background thread
+        self.stale_while_revalidate = False
+        self.refresh_limiter = TokenBucket(DEFAULT_REFRESH_RATE, 1)
+        self._refresh_queue = Queue()
+        self._refreshing = set() # (org_id, id) queued or being refreshed
+        self._refresh_thread = None
+        
+    def _get_local_index(self, org_id, table):
+        '''
+        Return the ordered, de-duplicated identifiers listed in the table index file(s) for org_id
+
+        The index is read once (identifiers only) and then kept up to date by add_to_localstore.
+        Duplicates left in the primary index file by earlier versions are compacted on load.
+        '''
+        key = (org_id, table)
+        with self._lock:
+            if key not in self._locals:
+                index = OrderedDict()
+                for cache_path in [self.cache_path] + self.secondary_cache_paths:
+                    path = os.path.join( cache_path, org_id, table)
+                    try:
+                        with open( path, 'r', newline='') as f:
+                            ids = [row[0] for row in csv.reader(f) if row]
+                    except IOError:
+                        continue
+
+                    if cache_path == self.cache_path and len(set(ids)) < len(ids):
+                        with file_lock( os.path.join( cache_path, org_id, '.%s.lock' % table ) ):
+                            with open( path, 'r', newline='') as f: # Re-read under the lock
+                                ids = [row[0] for row in csv.reader(f) if row]
+                            atomic_write( path, ''.join( '%s\r\n' % id for id in OrderedDict.fromkeys(ids) ).encode('utf-8') )
+
+                    index.update( (id, None) for id in ids )
+
+                self._locals[key] = index
+            return self._locals[key]
 
-            self._locals[table] = lt
-            return lt
+    def _get_locals(self, table):
+        key = (self.org_id, table)
+        with self._lock:
+            known = self._known.get(key)
+            if known is None:
+                known = KnownObjects(self, self.org_id, tuple( self._get_local_index(*key) ))
+                self._known[key] = known
+            return known
                 
     @property
     def known_pathways(self):
@@ -171,47 +300,76 @@ class BioCyc(object):
     def known_reactions(self):
         return self._get_locals('reactions')
         
-    def _get_by_name(self, table, n):
-        if table not in self._synonyms:
-            nt = {}
-            for cache_path in [self.cache_path] + self.secondary_cache_paths:
-                try:
-                    with open( os.path.join( cache_path, self.org_id, table + '-synonyms'), 'rU') as f:
-                        reader = csv.reader(f)
-                        for row in reader:
-                            nt[ row[1] ] = self.get(row[0])
-                except:
-                    continue
-                
-            self._synonyms[table] = nt
+    @property
+    def name_index(self):
+        '''
+        The name index for the primary cache, created on first use
+        '''
+        path = os.path.join( self.cache_path, 'names.sqlite' )
+        with self._lock:
+            if path not in self._name_indexes:
+                self._name_indexes[path] = NameIndex(path)
+            return self._name_indexes[path]
 
-        if n in self._synonyms[table]:
-            return self._synonyms[table][n]
+    def _get_name_index(self, org_id):
+        '''
+        Return the name index, importing the legacy <table>-synonyms files for org_id on first use
+        '''
+        index = self.name_index
+        if not index.is_imported(org_id):
+            with self._lock:
+                for cache_path in [self.cache_path] + self.secondary_cache_paths:
+                    for table in NAME_TABLES:
+                        try:
+                            with open( os.path.join( cache_path, org_id, table + '-synonyms'), 'r', newline='') as f:
+                                index.add_many(org_id, [(table, row[0], row[1]) for row in csv.reader(f) if len(row) > 1])
+                        except IOError:
+                            continue
+                index.set_imported(org_id)
+        return index
+
+    def search_names(self, name, mode='exact', tables=None, max_distance=2, limit=None, org_id=None):
+        '''
+        Search the name index, returning NameMatch(table, id, name, distance) tuples without loading any objects
+
+        Matching is case-insensitive. Modes are 'exact', 'prefix' (autocomplete, distance is the
+        number of characters completed) and 'fuzzy' (within max_distance edits). Results are
+        ordered by distance, then table (pathways, genes, reactions, compounds, proteins).
+        '''
+        index = self._get_name_index(org_id or self.org_id)
+        if mode == 'exact':
+            return index.exact(org_id or self.org_id, name, tables=tables, limit=limit)
+        elif mode == 'prefix':
+            return index.prefix(org_id or self.org_id, name, tables=tables, limit=limit)
+        elif mode == 'fuzzy':
+            return index.fuzzy(org_id or self.org_id, name, max_distance=max_distance, tables=tables, limit=limit)
         else:
-            None
+            raise ValueError("Unknown name search mode '%s'" % mode)
 
+    def _get_by_name(self, tables, n):
+        matches = self.search_names(n, tables=tables, limit=1)
+        if matches:
+            return self.get(matches[0].id)
+        else:
+            return None
         
     def find_pathway_by_name(self, n):
-        return self._get_by_name('pathways', n)
+        return self._get_by_name(['pathways'], n)
 
     def find_gene_by_name(self, n):
-        return self._get_by_name('genes', n)
+        return self._get_by_name(['genes'], n)
 
     def find_compound_by_name(self, n):
-        return self._get_by_name('compounds', n)
+        return self._get_by_name(['compounds'], n)
 
     def find_protein_by_name(self, n):
-        return self._get_by_name('proteins', n)
+        return self._get_by_name(['proteins'], n)
 
     def find_reaction_by_name(self, n):
-        return self._get_by_name('reactions', n)
+        return self._get_by_name(['reactions'], n)
 
-    def find_by_name(self,n ):
-        for t in ['pathways', 'genes', 'reactions', 'compounds', 'proteins']:
-            o  =  self._get_by_name(t, n)
-            if o is not None:
-                break
-        return o
+    def find_by_name(self, n):
+        return self._get_by_name(NAME_TABLES, n)
         
     '''
     This API is incomplete.
@@ -268,35 +426,108 @@ class BioCyc(object):
     '''
 
     def add_to_localstore(self, obj):
-        if hasattr(obj, 'localstore'):
-            with open( os.path.join( self.cache_path, self.org_id, obj.localstore), 'a+') as f:
-                writer = csv.writer(f)
-                writer.writerow( [obj.id] )
-            self._locals[ obj.localstore ].append( obj )
+        self.add_many_to_localstore([obj])
+
+    def add_many_to_localstore(self, objs, check_known=True):
+        '''
+        Append the ids of newly cached objects to their index files, with one write per file
+
+        With check_known False ids are appended without loading the index to skip those
+        already listed (duplicates are compacted when the index is next loaded)
+        '''
+        new = OrderedDict() # (org_id, table): ids
+        for obj in objs:
+            if hasattr(obj, 'localstore'):
+                if not check_known or obj.id not in self._get_local_index(obj.org_id, obj.localstore): # Else re-cached
+                    new.setdefault( (obj.org_id, obj.localstore), OrderedDict() )[obj.id] = None
+
+        for (org_id, table), ids in new.items():
+            with file_lock( os.path.join( self.cache_path, org_id, '.%s.lock' % table ) ):
+                with open( os.path.join( self.cache_path, org_id, table), 'a', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerows( [id] for id in ids )
+            with self._lock:
+                if (org_id, table) in self._locals:
+                    self._locals[org_id, table].update(ids)
+                self._known.pop( (org_id, table), None )
             
     def add_to_names(self, obj):
-        if hasattr(obj, 'localstore'):
+        self.add_many_to_names([obj])
+
+    def add_many_to_names(self, objs):
+        '''
+        Add the names and synonyms of cached objects to the name index, in one transaction per organism
+        '''
+        rows = defaultdict(list) # org_id: (table, id, name)
+        for obj in objs:
+            if hasattr(obj, 'localstore'):
         
-            name_list = []
-            if obj.name is not None:
-                name_list.append( obj.name ) # Use plaintext name not the html one
-            
-            name_list.extend( obj.synonyms )
-            name_list = set(name_list) # Only uniques
+                name_list = []
+                if obj.name is not None:
+                    name_list.append( obj.name ) # Use plaintext name not the html one
             
-            with open( os.path.join( self.cache_path, self.org_id, obj.localstore + '-synonyms'), 'a+') as f:
-                writer = csv.writer(f)
-                
-                for synonym in name_list:
-                    writer.writerow( [obj.id, synonym] )
-                    self._synonyms[ obj.localstore ][ synonym ] = obj
+                name_list.extend( [s for s in obj.synonyms if s] )
+                name_list.extend( [to_plain_text(s) for s in obj.synonyms if s] )
+                name_list = set(name_list) # Only uniques
+
+                rows[obj.org_id].extend( (obj.localstore, obj.id, name) for name in name_list )
+
+        for org_id, org_rows in rows.items():
+            self._get_name_index(org_id).add_many(org_id, org_rows)
+
+    def network(self, org_id=None):
+        '''
+        Return the network index for org_id (default current organism), loading it on first use
+        and reloading it if other processes have changed it since
+
+        Once built (see build_network, to (re)build it from everything already in the cache)
+        the index is kept up to date as objects are cached, by any process sharing the cache.
+        '''
+        org_id = org_id or self.org_id
+        with self._lock:
+            if org_id not in self._networks:
+                self._networks[org_id] = NetworkIndex( os.path.join( self.cache_path, org_id, 'network' ) )
+            else:
+                self._networks[org_id].refresh()
+            return self._networks[org_id]
+
+    def build_network(self, org_id=None):
+        org_id = org_id or self.org_id
+        with self._lock:
+            self._networks[org_id] = NetworkIndex.build(self, org_id)
+            return self._networks[org_id]
+
+    def pathway_membership(self, kind='compound', org_id=None, rollup=False):
+        '''
+        Return the compound (or gene) by pathway membership matrix for org_id (default
+        current organism) for enrichment tests, see biocyc.enrichment
+
+        The matrix is built from the network index (see build_network) on first use, and
+        kept until the index changes, in this process or on disk (e.g. objects cached by
+        another process). With rollup super-pathways include the members of their sub-pathways
+        '''
+        org_id = org_id or self.org_id
+        network = self.network(org_id) # Reloaded if changed on disk
+        key = (org_id, kind, rollup)
+        with self._lock:
+            cached = self._memberships.get(key)
+            if cached is None or cached[0] is not network or cached[1] != network.state:
+                cached = (network, network.state, PathwayMembership.build(network, kind, rollup))
+                self._memberships[key] = cached
+            return cached[2]
+
+    def enrich(self, ids, kind='compound', org_id=None, rollup=False, **kwargs):
+        '''
+        Test the compounds (or genes) ids for over-representation in the pathways of
+        org_id, returning EnrichmentResults most significant first. Keyword arguments
+        are passed to PathwayMembership.test_many
+        '''
+        return self.pathway_membership(kind, org_id, rollup).test(ids, **kwargs)
 
     def set_organism(self, organism):
+        # The organism's cache folder is created when the first object is cached
         self.org_id = organism.upper()
-        mkdir_p( os.path.join( self.cache_path, self.org_id ) )
 
-        self._locals = defaultdict(list)
-        self._synonyms = defaultdict(dict)
         self._foreign_ids = defaultdict(list)
         
     def set_detail(self, detail):
@@ -305,162 +536,906 @@ class BioCyc(object):
         else:
             raise BioCycInvalidDetailLevel
         
-    def set_expiry(self, td):
+    def set_expiry(self, td, jitter=None, stale_while_revalidate=None):
+        '''
+        Set the age after which cached objects expire
+
+        Each object expires up to jitter (a fraction of td) early, at a point fixed by
+        its identifier, so objects cached together are not all refetched together. With
+        stale_while_revalidate expired objects are still returned, and queued for a
+        background refresh (see set_refresh_rate)
+        '''
         if type(td) == timedelta:
             self.expire_records_after = td
         else:
             raise BioCycInvalidExpiry
-        
+
+        if jitter is not None:
+            if not 0 <= jitter < 1:
+                raise BioCycInvalidExpiry
+            self.expiry_jitter = jitter
+
+        if stale_while_revalidate is not None:
+            self.stale_while_revalidate = stale_while_revalidate
+
+    def set_refresh_rate(self, rate, burst=1):
+        '''
+        Limit background refreshes to rate batches (of up to max_ids_per_request objects)
+        per second. These requests are also subject to the main rate limit
+        '''
+        self.refresh_limiter = TokenBucket(rate, burst)
+
+    def expires_at(self, org_id, id, created_at):
+        '''
+        Return the time the object id, cached at created_at, expires
+        '''
+        # Stable across processes (unlike hash), so all agree when an object expires
+        fraction = zlib.crc32( ('%s:%s' % (org_id, id)).encode('utf-8') ) / float(2 ** 32)
+        return created_at + self.expire_records_after * (1 - self.expiry_jitter * fraction)
+
+    def is_expired(self, obj, now=None):
+        return self.expires_at(obj.org_id, obj.id, obj.created_at) <= (now or datetime.now())
+
+    def set_cache_store(self, store):
+        '''
+        Use store (e.g. SQLiteStore) as the primary cache in place of the default
+        pickle files under cache_path. Pass None to revert to the default
+        '''
+        self.cache_store = store
+
+    def use_sqlite_cache(self, path=None):
+        '''
+        Use a single SQLite file (default cache.sqlite under cache_path) as the primary cache
+        '''
+        self.set_cache_store( SQLiteStore( path or os.path.join( self.cache_path, 'cache.sqlite' ), self.compression ) )
+
+    def set_compression(self, compression):
+        '''
+        Compress newly cached objects with 'zlib', 'zstd' (needs the zstandard package) or None
+        '''
+        if compression not in serialize.CODECS:
+            raise ValueError('Unknown compression %r' % compression)
+
+        self.compression = compression
+        for store in [self.cache_store] + list(self._default_stores.values()):
+            if store is not None and not store.read_only:
+                store.compression = compression
+
+    def _pickle_store(self, path):
+        if path not in self._default_stores:
+            self._default_stores[path] = PickleDirectoryStore(path, self.compression)
+        return self._default_stores[path]
+
+    @property
+    def primary_cache_store(self):
+        return self.cache_store or self._pickle_store(self.cache_path)
+
+    @property
+    def cache_stores(self):
+        return [self.primary_cache_store] + [self._pickle_store(p) for p in self.secondary_cache_paths] + self.secondary_cache_stores
+
+    def export_bundle(self, path, org_id=None, compression=None):
+        '''
+        Pack all cached objects for org_id (default current organism) into a read-only bundle file
+        '''
+        return export_bundle(self.cache_stores, org_id or self.org_id, path, compression=compression)
+
+    def add_bundle(self, path):
+        '''
+        Use the bundle file at path as a secondary (read-only) cache
+        '''
+        store = BundleStore(path)
+        self.secondary_cache_stores.append(store)
+        return store
+
+    def set_memory_cache_size(self, max_bytes):
+        '''
+        Set the (approximate) memory budget in bytes for cached objects across all organisms
+        '''
+        self.memory_cache.resize(max_bytes)
+
+    def set_rate_limit(self, rate, burst=1):
+        '''
+        Limit requests to the server to rate per second, allowing bursts of up to burst
+        requests. The limit is shared by all worker threads
+        '''
+        self.rate_limiter = TokenBucket(rate, burst)
+
+    def set_workers(self, workers):
+        self.max_workers = max(1, int(workers))
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            with self._lock:
+                if self._transport is None:
+                    self._transport = HTTPTransport(pool_maxsize=max(10, self.max_workers))
+        return self._transport
+
+    def set_transport(self, transport):
+        '''
+        Send requests through transport (see biocyc.transport). Pass None to revert to HTTP
+        '''
+        self._transport = transport
+
+    def set_offline(self, offline=True, markers=False):
+        '''
+        Make no network requests: objects missing from the cache raise BioCycOfflineError
+        at once, or with markers are returned as BioCycEntityUnavailable. Neither is cached
+        '''
+        self.set_transport( OfflineTransport() if offline else None )
+        self.unavailable_markers = markers
+
+    def use_archive(self, path, mode='replay'):
+        '''
+        Serve requests from the archive file at path; record missing responses in 'record'
+        mode, or treat them as offline in 'replay' mode (see set_offline for markers)
+        '''
+        self.set_transport( ArchiveTransport(path, mode) )
+
+    def retry_delay(self, attempt, retry_after=None):
+        '''
+        Return the seconds to wait before retry attempt (from 0), honouring a
+        Retry-After header (seconds or HTTP date) if the server sent one
+        '''
+        delay = None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+                try:
+                    delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    pass
+
+        if delay is None:
+            delay = self.backoff_factor * 2 ** attempt
+
+        return min(max(delay, 0), self.max_backoff)
+
     def requestxml(self, url, params):
-    
-        # Wait so we don't hammer server
-        if self._hammer_lock is not None:
-            wait_required = (self._hammer_lock - datetime.now()) + self._hammer_delay
-                    
-            if not wait_required.days < 0:
-                time.sleep(wait_required.seconds)
+        '''
+        Request url and return the parsed XML, or None if the server reports the object does not exist
 
-        self._hammer_lock = datetime.now()
-            
-        r = requests.get(url, params=params)
-        if r.status_code == 200:
-            # Parse and return the XML
-            return et.fromstring(r.text)
-        else:
-            return False
+        Connection errors, timeouts, 429 and 5xx responses are retried with exponential
+        backoff, raising BioCycRequestError once max_retries is exhausted. These are never
+        cached, so a failed request will simply be retried on the next get.
+        '''
+        from xml.etree import ElementTree as et
+
+        metrics = self.metrics
+        transport = self.transport
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.count('http.retry')
+                time.sleep( self.retry_delay(attempt - 1, retry_after) )
+
+            retry_after = None
 
-    def request_api(self, func, org_id, obj):
-        return self.requestxml( 'http://websvc.biocyc.org/apixml', {'fn': func, 'id': '%s:%s' % (org_id, obj), 'detail': self.detail } )
+            r = transport.lookup(url, params)
+            if r is None:
+                # Wait so we don't hammer server
+                wait = self.rate_limiter.acquire()
+                metrics.timing('ratelimit.wait', wait)
+
+                try:
+                    with metrics.timer('http.request'):
+                        r = transport.get(url, params, timeout=self.timeout)
+                except transport.errors as e:
+                    error = e
+                    continue
+
+            metrics.count('http.bytes', len(r.content))
+            if r.status_code == 200:
+                try:
+                    # Parse and return the XML
+                    with metrics.timer('xml.parse'):
+                        return et.fromstring(r.content)
+                except et.ParseError as e: # Truncated response
+                    error = e
+
+            elif r.status_code == 404:
+                return None
+
+            elif r.status_code in RETRY_STATUS_CODES:
+                error = 'HTTP %d' % r.status_code
+                retry_after = r.headers.get('Retry-After')
+
+            else:
+                raise BioCycRequestError('HTTP %d for %s' % (r.status_code, url))
+
+        raise BioCycRequestError('%s for %s after %d attempts' % (error, url, self.max_retries + 1))
+
+    def request_api(self, func, org_id, obj, detail=None):
+        return self.requestxml( self.base_url + '/apixml', {'fn': func, 'id': '%s:%s' % (org_id, obj), 'detail': detail or self.detail } )
 
     def request_obj(self, org_id, obj):
-        return self.requestxml( 'http://websvc.biocyc.org/getxml', {'id': '%s:%s' % (org_id, obj), 'detail': self.detail } )
+        return self.request_objs(org_id, [obj])
+
+    def request_objs(self, org_id, objs):
+        '''
+        Request multiple objects in a single getxml call, the response contains
+        one element per object found (missing objects are simply absent)
+        '''
+        ids = ','.join( ['%s:%s' % (org_id, obj) for obj in objs] )
+        return self.requestxml( self.base_url + '/getxml', {'id': ids, 'detail': self.detail } )
 
     def get_from_cache(self, org_id, id):
         '''
         Get an object from the cache
         
-        Use all cache folders available (primary first, then secondary in order) and look for the ID in the dir
-        if found unpickle and return the object, else return False
-        
-        FIXME: Check for expiry of object! Return false is expired (will auto-refetch and overwrite)
+        Use all cache stores available (primary first, then secondary in order) and look for the ID,
+        if found and not expired return the object, else return None
+        '''
+        return self.get_many_from_cache(org_id, [id]).get(id)
+
+    def get_many_from_cache(self, org_id, ids, stale=None):
         '''
-        current_time = datetime.now()
+        Get multiple objects from the cache, returning a dict of id: obj for those found
+
+        The memory cache is checked first, then each store with a single batched read
+        for the remaining ids. Expired objects are skipped (will auto-refetch and overwrite),
+        unless stale (default stale_while_revalidate) is set. Then the most recent expired
+        copy is returned if there is no current one, and queued for a background refresh
+        '''
+        if stale is None:
+            stale = self.stale_while_revalidate
+
+        metrics = self.metrics
+        now = datetime.now()
+        objs = {}
+        expired = {}
+        sizes = {} # Of the records read from stores, for the memory cache
         
         # Check memory cache first
-        if id in self.memory_cache[org_id]:
-            obj = self.memory_cache[org_id][id]
-            if obj.created_at > current_time - self.expire_records_after:
-                return obj
-        
-        for cache in [self.cache_path] + self.secondary_cache_paths:
-            read_path = os.path.join( cache, org_id, id )
-            try:
-                with open(read_path, 'rb') as f:
-                    obj = pickle.load(f)
+        for id in ids:
+            obj = self.memory_cache.get(org_id, id)
+            if obj is not None:
+                if not self.is_expired(obj, now):
+                    objs[id] = obj
+                else:
+                    expired[id] = obj
+
+        if metrics.enabled:
+            metrics.count('cache.memory.hit', len(objs))
+            metrics.count('cache.memory.miss', len(ids) - len(objs))
+
+        missing = [id for id in ids if id not in objs]
+        if self._write_buffer: # Not yet flushed (and evicted from the memory cache)
+            with self._lock:
+                for id in missing:
+                    obj = self._write_buffer.get( (org_id, id) )
+                    if obj is not None and not self.is_expired(obj, now):
+                        objs[id] = obj
+            missing = [id for id in missing if id not in objs]
+
+        for store in self.cache_stores:
+            if not missing:
+                break
 
-            except:
-                # Continue to try the next cache
-                pass 
-                
-            else:
-                # It worked so we have obj
-                # Check for expiry date; if it's not expired return it else continue
-                if obj.created_at > current_time - self.expire_records_after:
-                    # If we're here it mustn't be in the memory cache
-                    self.memory_cache[org_id][id] = obj
-                    if len(self.memory_cache[org_id]) > self.max_memory_cache:
-                        self.memory_cache[org_id].popitem(last=False)
-
-                    return obj
-                    
-                # Else continue looking
+            with metrics.timer('cache.%s.read' % store.name):
+                found = store.get_many(org_id, missing, sized=True)
+
+            for id, (obj, size) in found.items():
+                obj._biocyc = self # Relationships resolve through this instance
+                # Check for expiry date; if it's not expired use it else continue looking
+                if not self.is_expired(obj, now):
+                    objs[id] = obj
+                    self.memory_cache.put(obj, size)
+                elif id not in expired or obj.created_at > expired[id].created_at:
+                    expired[id] = obj
+                    sizes[id] = size
+
+            if metrics.enabled:
+                metrics.count('cache.%s.hit' % store.name, sum(1 for id in missing if id in objs))
+            missing = [id for id in missing if id not in objs]
 
-        # We found nothing (or all expired)
-        return None
+        if expired:
+            metrics.count('cache.expired', len(expired))
+
+        if stale and expired:
+            for id, obj in expired.items():
+                objs[id] = obj
+                self.memory_cache.put(obj, sizes.get(id))
+            self.queue_refresh(org_id, list(expired))
+
+        return objs
+
+    def queue_refresh(self, org_id, ids):
+        '''
+        Queue ids for refetching by the background refresh thread (started if needed)
+        '''
+        with self._lock:
+            for id in ids:
+                if (org_id, id) not in self._refreshing:
+                    self._refreshing.add( (org_id, id) )
+                    self._refresh_queue.put( (org_id, id) )
+
+            if self._refresh_thread is None or not self._refresh_thread.is_alive():
+                self._refresh_thread = threading.Thread(target=self._refresh_worker, name='biocyc-refresh')
+                self._refresh_thread.daemon = True
+                self._refresh_thread.start()
+
+    def _refresh_worker(self):
+        while True:
+            # Collect up to one request's worth of queued ids, grouped by organism
+            queued = [self._refresh_queue.get()]
+            while len(queued) < self.max_ids_per_request:
+                try:
+                    queued.append( self._refresh_queue.get_nowait() )
+                except Empty:
+                    break
+
+            batches = defaultdict(list)
+            for org_id, id in queued:
+                batches[org_id].append(id)
+
+            for org_id, ids in batches.items():
+                self.refresh_limiter.acquire()
+                try:
+                    self.get_for_org(org_id, ids, skip_cache=True, workers=1)
+                except Exception as e: # Keep serving the stale copies, retried when next requested
+                    logging.warning('Background refresh of %d %s objects failed: %s' % (len(ids), org_id, e))
+                finally:
+                    with self._lock:
+                        self._refreshing.difference_update( (org_id, id) for id in ids )
+
+            for _ in queued:
+                self._refresh_queue.task_done()
+
+    def wait_for_refresh(self):
+        '''
+        Block until all queued background refreshes have completed
+        '''
+        self._refresh_queue.join()
+
+    def refresh_expiring(self, within=timedelta(0), org_id=None, workers=None, batch_size=500):
+        '''
+        Refetch all cached objects for org_id (default current organism) that have expired,
+        or will within the given timedelta, e.g. during off-peak hours ahead of use
+
+        Objects are refreshed soonest-expiring first, in batches of batch_size (each
+        requested in batches of max_ids_per_request, with workers). Returns the number
+        of objects refreshed.
+        '''
+        org_id = org_id or self.org_id
+        deadline = datetime.now() + within
+
+        # Known objects only: pickle cache folders also hold the index files
+        known = set()
+        for table in set( o.localstore for o in AVAILABLE_OBJECT_TYPES if hasattr(o, 'localstore') ):
+            known.update( self._get_local_index(org_id, table) )
+
+        newest = {}
+        for store in self.cache_stores:
+            for id, created_at in store.iter_created(org_id):
+                if id in known and (id not in newest or created_at > newest[id]):
+                    newest[id] = created_at
+
+        expiring = sorted(
+            (expires_at, id) for expires_at, id in
+            ((self.expires_at(org_id, id, created_at), id) for id, created_at in newest.items())
+            if expires_at <= deadline
+        )
+
+        count = 0
+        for n in range(0, len(expiring), batch_size):
+            ids = [id for _, id in expiring[n:n + batch_size]]
+            count += len( clean( self.get_for_org(org_id, ids, skip_cache=True, workers=workers) ) )
+
+        return count
 
     def cache(self, obj):
         '''
         Store an object in the cache (this allows temporarily assigning a new cache
         for exploring the DB without affecting the stored version
+
+        Within buffered_writes the object is held in memory and written with the next flush
+        '''
+        with self._lock:
+            self.memory_cache.put(obj)
+            key = (obj.org_id, obj.id)
+
+            if getattr(self._buffering, 'depth', 0):
+                if not self._write_buffer:
+                    self._write_buffer_since = time.time()
+                self._write_buffer[key] = obj
+                if len(self._write_buffer) >= self.write_buffer_size or time.time() - self._write_buffer_since >= self.write_buffer_delay:
+                    self.flush()
+            else:
+                self._write_buffer.pop(key, None) # Superseded
+                self._write([obj])
+
+    def _write(self, objs, check_known=True):
+        '''
+        Write objects to the primary store, and add them to the index files and the network
+        index, if one has been built for the organism
+
+        Network edges are journalled, and compacted into the index arrays once more than
+        network_journal_edges are waiting
+        '''
+        with self._lock:
+            self.primary_cache_store.put_many(objs)
+
+            by_org = defaultdict(list)
+            for obj in objs:
+                by_org[obj.org_id].append(obj)
+
+            # Indexes are kept as files under cache_path whatever the store
+            for org_id in by_org:
+                index_path = os.path.join( self.cache_path, org_id )
+                if not os.path.exists( index_path ):
+                    mkdir_p( index_path )
+        
+            # Add to localstore (keep track of numbers of objects, etc.)
+            self.add_many_to_localstore(objs, check_known)
+            self.add_many_to_names(objs)
+
+            for org_id, org_objs in by_org.items():
+                if org_id in self._networks or os.path.isdir( os.path.join( self.cache_path, org_id, 'network' ) ):
+                    network = self.network(org_id)
+                    network.add_many(org_objs)
+                    if network.pending > self.network_journal_edges:
+                        network.save()
+
+    def bulk_cache(self, objs):
+        '''
+        Write objects straight to the cache store and index files, e.g. when loading a
+        whole database (see biocyc.flatfile)
+
+        Unlike cache, the objects are not kept in the memory cache and the known-object
+        indexes are not loaded, so memory use does not grow with the number of objects
         '''
-        # Check cache path exists for current obj
-        write_path = os.path.join( self.cache_path, obj.org_id )
-        if not os.path.exists( write_path ): 
-            mkdir_p( write_path )
+        with self._lock:
+            for obj in objs: # Drop any earlier copies
+                self.memory_cache.remove(obj.org_id, obj.id)
+                self._write_buffer.pop( (obj.org_id, obj.id), None )
+            self._write(objs, check_known=False)
 
-        with open(os.path.join( write_path, obj.id ), 'wb') as f:
-            pickle.dump( obj, f )
+    def flush(self):
+        '''
+        Write all buffered objects to the cache store and index files. Once flush returns
+        they are visible to other processes sharing the cache, and survive this process
+        exiting. They are not fsynced, so an OS crash or power loss may still lose them
+        '''
+        with self._lock:
+            if not self._write_buffer:
+                return
+
+            objs = list(self._write_buffer.values())
+            with self.metrics.timer('cache.flush'):
+                self._write(objs)
+            self._write_buffer.clear() # Only once written, a failed flush is retried by the next
+            self.metrics.count('cache.flush.objects', len(objs))
+
+    @contextmanager
+    def buffered_writes(self):
+        '''
+        Buffer the objects cached by this thread within the block, writing them in batches
+        (see write_buffer_size and write_buffer_delay) rather than one at a time. There is
+        no background flush: the buffer is checked against both limits on each cache call,
+        so an idle buffer is only written by the next cache call, flush or the block exit
         
-        # Add to localstore (keep track of numbers of objects, etc.)
-        self.add_to_localstore(obj)   
-        self.add_to_names(obj) 
+        Everything buffered is flushed when the outermost block exits, also on error.
+        Buffered objects are served from memory here, but other processes sharing the
+        cache only see them once flushed (and may request them themselves meanwhile).
+        Requests are already buffered per get_for_org call, so this is for grouping
+        many calls, or objects cached directly
+        '''
+        depth = getattr(self._buffering, 'depth', 0)
+        self._buffering.depth = depth + 1
+        try:
+            yield self
+        finally:
+            self._buffering.depth = depth
+            if depth == 0:
+                self.flush()
         
-    def get(self, ids, skip_cache=False):
-        return self.get_for_org(self.org_id, ids, skip_cache=skip_cache)
+    def get(self, ids, skip_cache=False, workers=None):
+        return self.get_for_org(self.org_id, ids, skip_cache=skip_cache, workers=workers)
+
+    def get_multi(self, org_ids, ids, skip_cache=False, workers=None, shared_org=None):
+        '''
+        Returns objects for the same identifiers in several organisms, as a dict of
+        org_id: list of objects in the order of ids (or a single entity, for a single id)
+
+        The cache is checked for every organism first. The remaining misses of all
+        organisms are then requested together, in batches of max_ids_per_request per
+        organism shared out over workers (default max_workers) threads, within the
+        shared rate limit. Nothing global (e.g. the current organism) is changed.
+
+        With shared_org (e.g. 'META') objects of organism independent types (compounds)
+        are taken once from shared_org, and that copy returned for every organism
+        without its own. Its relationships are those in shared_org. Only identifiers
+        cached in shared_org, or listed in its index of organism independent objects,
+        are requested from it, together with the other organisms' batches; any it
+        does not return as organism independent are then requested per organism
+        '''
+        single = not isinstance(ids, (list, tuple))
+        if single:
+            ids = [ids]
 
-    def get_for_org(self, org_id, ids, skip_cache=False):
+        org_ids = list( OrderedDict.fromkeys( org_id.upper() for org_id in org_ids ) )
+        valid = [id for id in OrderedDict.fromkeys(ids) if id != '' and type(id) is str] # Skip empty string and duplicates
+        workers = workers or self.max_workers
+
+        objs = {}
+        for org_id in org_ids:
+            objs[org_id] = self.get_many_from_cache(org_id, valid) if skip_cache == False else {}
+
+        def use_shared(shared_objs):
+            for id, obj in shared_objs.items():
+                if getattr(obj, 'organism_independent', False):
+                    for org_id in org_ids:
+                        objs[org_id].setdefault(id, obj)
+
+        routed = []
+        if shared_org:
+            shared_org = shared_org.upper()
+            wanted = [id for id in valid if any( id not in objs[org_id] for org_id in org_ids )]
+            cached = self.get_many_from_cache(shared_org, wanted) if skip_cache == False else {}
+            use_shared(cached) # Not found markers leave the id to each organism
+
+            known = set()
+            for table in set( o.localstore for o in AVAILABLE_OBJECT_TYPES if o.organism_independent and hasattr(o, 'localstore') ):
+                known.update( self._get_local_index(shared_org, table) )
+            routed = [id for id in wanted if id not in cached and id in known]
+
+        def batched(org_id, missing):
+            return [(org_id, missing[n:n + self.max_ids_per_request]) for n in range(0, len(missing), self.max_ids_per_request)]
+
+        fetch = lambda batch: self._fetch_single_flight(batch[0], batch[1], workers=1, recheck=not skip_cache)
+
+        def run(batches):
+            if workers > 1 and len(batches) > 1:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=min(workers, len(batches))) as executor:
+                    return list( executor.map(fetch, batches) )
+            return [fetch(batch) for batch in batches]
+
+        def fetch_missing(candidates, shared_ids=()):
+            # All batches share the workers, those for shared_org first
+            batches = batched(shared_org, shared_ids) if shared_ids else []
+            n_shared = len(batches)
+            for org_id in org_ids:
+                batches.extend( batched(org_id, [id for id in candidates if id not in objs[org_id]]) )
+
+            fetched = run(batches)
+            for (org_id, _), org_objs in zip(batches[n_shared:], fetched[n_shared:]):
+                objs[org_id].update(org_objs)
+            for org_objs in fetched[:n_shared]:
+                use_shared(org_objs)
+
+        # Routed ids are requested from shared_org only, then any that are not organism
+        # independent there (e.g. not found, or a pathway) from each organism
+        fetch_missing([id for id in valid if id not in set(routed)], routed)
+        if routed:
+            fetch_missing(routed)
+
+        grid = OrderedDict()
+        for org_id in org_ids:
+            grid[org_id] = [returned(objs[org_id].get(id)) for id in ids]
+            if single:
+                grid[org_id] = grid[org_id][0]
+        return grid
+
+    def get_for_org(self, org_id, ids, skip_cache=False, workers=None):
         '''
         Returns objects for the given identifiers
         If called with a list returns a list, else returns a single entity
+
+        All identifiers are checked against the cache first, the remaining misses
+        are then requested from the server in batches of max_ids_per_request.
+        With more than one worker (default max_workers) the batches are requested
+        concurrently, within the shared rate limit
         '''
-        t = type(ids)
-        if t != list:
+        single = not isinstance(ids, (list, tuple))
+        if single:
             ids = [ids]
             
-        objs = []
-        
-        
-        for id in ids:
-            if id == '' or type(id) is not str: # Empty string
-                objs.append(None)
-                continue
+        valid = [id for id in OrderedDict.fromkeys(ids) if id != '' and type(id) is str] # Skip empty string and duplicates
 
-            if skip_cache ==False:
-                obj = self.get_from_cache(org_id, id)
-            else:
-                obj = None
-                
-            if obj is None:
-                xml = self.request_obj(org_id, id)
-                obj = self.create_obj_from_xml(id, xml)
-                self.cache(obj) # Will cache either a real object, or a BioCycEntityNotFound
-                
-            if obj: # Found
-                objs.append(obj)
-            else:  # Not found (BioCycEntityNotFound)
-                objs.append(None)
-                
-        if t != list:
+        if skip_cache == False:
+            objs = self.get_many_from_cache(org_id, valid)
+        else:
+            objs = {}
+
+        missing = [id for id in valid if id not in objs]
+        if missing:
+            objs.update( self._fetch_single_flight(org_id, missing, workers, recheck=not skip_cache) )
+
+        objs = [returned(objs.get(id)) for id in ids]
+
+        if single:
             return objs[0] 
         else:
             return objs
             
             
-    def create_obj_from_xml(self, id, xml):
-        # Get the object type from the returned XML
-        # by matching the provided lists for schema-id
-        for o in AVAILABLE_OBJECT_TYPES:
-            if o.xml_schema_id:
-                x = xml.find(o.xml_schema_id)
-                if x: # Found it
-                    # Create the base object, populating from the xml
-                    # Import the xml to the object (using object specific import_from_xml)
-                    obj = o( id=id, from_xml=x)
-                    return obj
-        else:
-            return BioCycEntityNotFound(id, self.org_id)
+    def prefetch(self, objs, relations, depth=1, workers=None):
+        '''
+        Load the objects reachable from objs through relations (relationship property
+        names, e.g. ['reactions', 'compounds']) up to depth levels, so that reading the
+        properties afterwards is served from the cache
+
+        At each level the identifiers for the whole frontier are gathered and resolved
+        together, one get_for_org per organism (batched and concurrent with workers).
+        Derived relationships (e.g. Pathway.compounds) are followed along their paths,
+        one step per level. Returns the number of objects loaded.
+        '''
+        if not isinstance(objs, (list, tuple)):
+            objs = [objs]
+
+        frontier = clean(objs)
+        relations = set(relations)
+        seen = set( (o.org_id, o.id) for o in frontier )
+        count = 0
+
+        for _ in range(depth):
+            ids = defaultdict(list)
+            next_relations = set(relations)
+
+            for obj in frontier:
+                for name in relations:
+                    if name in obj.derived_relationships:
+                        steps = [path for path in obj.derived_relationships[name]]
+                    else:
+                        steps = [(name,)]
+
+                    for path in steps:
+                        next_relations.update(path[1:])
+                        if path[0] not in obj.relationships:
+                            continue
+
+                        value = getattr(obj, obj.relationships[path[0]], None)
+                        for id in (value if isinstance(value, (list, tuple)) else [value]):
+                            if id and (obj.org_id, id) not in seen:
+                                seen.add( (obj.org_id, id) )
+                                ids[obj.org_id].append(id)
+
+            frontier = []
+            for org_id, org_ids in ids.items():
+                frontier.extend( clean( self.get_for_org(org_id, org_ids, workers=workers) ) )
+
+            if not frontier:
+                break
+
+            count += len(frontier)
+            relations = next_relations
+
+        return count
+
+    def _claim_path(self, org_id, id):
+        return os.path.join( self.cache_path, org_id, '.claims', id )
+
+    def _fetch_single_flight(self, org_id, ids, workers=None, recheck=True):
+        '''
+        Fetch ids, making sure only one thread or process sharing the cache requests each one
+
+        Each id is claimed before it is requested. Ids already claimed elsewhere are waited
+        for until they appear in the cache. If a claim goes away without the object being
+        cached (e.g. the other request failed), the id is claimed and fetched here instead.
+        '''
+        claimed = [id for id in ids if claim( self._claim_path(org_id, id), self.claim_timeout )]
+        objs = self._fetch_claimed(org_id, claimed, workers, recheck)
+        waiting = [id for id in ids if id not in objs]
+
+        while waiting:
+            time.sleep(self.claim_poll_interval)
+            objs.update( self.get_many_from_cache(org_id, waiting, stale=False) )
+            waiting = [id for id in waiting if id not in objs]
+
+            claimed = [id for id in waiting if claim( self._claim_path(org_id, id), self.claim_timeout )]
+            objs.update( self._fetch_claimed(org_id, claimed, workers, recheck=True) )
+            waiting = [id for id in waiting if id not in objs]
+
+        return objs
+
+    def _fetch_claimed(self, org_id, ids, workers=None, recheck=True):
+        '''
+        Fetch ids that have been claimed, releasing the claims once they are cached
+        '''
+        try:
+            # Another process may have cached them between our cache check and the claim
+            objs = self.get_many_from_cache(org_id, ids, stale=False) if recheck and ids else {}
+            missing = [id for id in ids if id not in objs]
+
+            batches = [missing[n:n + self.max_ids_per_request] for n in range(0, len(missing), self.max_ids_per_request)]
+            workers = min(workers or self.max_workers, len(batches))
+
+            # Written before the claims are released (unless within an outer buffered_writes)
+            with self.buffered_writes():
+                if workers > 1:
+                    from concurrent.futures import ThreadPoolExecutor
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        for fetched in executor.map(lambda batch: self._fetch_batch(org_id, batch), batches):
+                            objs.update(fetched)
+                else:
+                    for batch in batches:
+                        objs.update( self._fetch_batch(org_id, batch) )
+
+            return objs
+
+        finally:
+            for id in ids:
+                release( self._claim_path(org_id, id) )
+
+    def _fetch_batch(self, org_id, ids):
+        '''
+        Request a batch of objects from the server, caching and returning a dict of id: obj
+        '''
+        try:
+            xml = self.request_objs(org_id, ids)
+        except BioCycOfflineError:
+            if not self.unavailable_markers:
+                raise
+            return dict( (id, BioCycEntityUnavailable(id, org_id)) for id in ids )
+
+        # Objects are written together with those embedded in them (e.g. enzymatic reactions)
+        with self.buffered_writes():
+            with self.metrics.timer('xml.import'):
+                objs = self.create_objs_from_xml(ids, xml, org_id)
+            with self.metrics.timer('cache.write'):
+                for obj in objs.values():
+                    self.cache(obj) # Will cache either a real object, or a BioCycEntityNotFound
+            self.metrics.count('xml.import.objects', len(objs))
+            self.metrics.count('cache.write.objects', len(objs))
+        return objs
+
+    def create_obj_from_xml(self, id, xml, org_id=None):
+        '''
+        Create the object for id from the returned XML, which may hold multiple objects
+        '''
+        return self.create_objs_from_xml([id], xml, org_id)[id]
+
+    def create_objs_from_xml(self, ids, xml, org_id=None):
+        '''
+        Create the objects for ids from the returned XML, returning a dict of id: obj
+        
+        The elements are indexed by frameid in a single pass over the document, and the
+        object type picked from the element tag (see OBJECT_TYPES_BY_TAG). Objects not
+        in the XML are returned as BioCycEntityNotFound. An element without a frameid is
+        only taken as the object for a single requested id
+        '''
+        org_id = org_id or self.org_id
+        elements = index_xml(xml) if xml is not None else {}
+        anonymous = elements.get(None) if len(ids) == 1 else None
+
+        objs = {}
+        for id in ids:
+            x = elements.get(id.upper(), anonymous)
+            if x is None:
+                objs[id] = BioCycEntityNotFound(id, org_id, biocyc=self)
+            else:
+                # Create the object, importing the xml with its single-pass import_from_xml
+                objs[id] = OBJECT_TYPES_BY_TAG[x.tag]( id=id, from_xml=x, biocyc=self)
+        return objs
             
     def biocyc_obj_url(self, obj):
         return "http://www.biocyc.org/%s/NEW-IMAGE?object=%s"  % (self.org_id, obj)
 
 biocyc = BioCyc()
 
-class BioCycEntityNotFound(object):
-    def __init__(self, id=None, org_id=None, *args, **kwargs):
-        self.type = type(self).__name__.lower()
-        self.id = id
+class KnownObjects(object):
+    '''
+    Lazy collection of the known objects of one type for an organism
+
+    Holds only the identifiers (see ids), objects are loaded in batches when
+    iterated or indexed. len() and membership tests do not load any objects.
+    '''
+    batch_size = 500
+
+    def __init__(self, biocyc, org_id, ids):
+        self.biocyc = biocyc
         self.org_id = org_id
-        self.created_at = datetime.now()
+        self.ids = ids
+        self._id_set = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item):
+        if self._id_set is None:
+            self._id_set = frozenset(self.ids)
+        return getattr(item, 'id', item) in self._id_set
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.biocyc.get_for_org(self.org_id, list(self.ids[i]))
+        return self.biocyc.get_for_org(self.org_id, self.ids[i])
+
+    def __iter__(self):
+        return self.iter_objects()
+
+    def __repr__(self):
+        return '<KnownObjects %s: %d>' % (self.org_id, len(self))
+
+    def iter_objects(self, batch_size=None):
+        '''
+        Stream the objects, loading batch_size at a time. Identifiers that are no
+        longer found are skipped
+        '''
+        batch_size = batch_size or self.batch_size
+        for n in range(0, len(self.ids), batch_size):
+            for obj in self.biocyc.get_for_org(self.org_id, list(self.ids[n:n + batch_size])):
+                if obj is not None:
+                    yield obj
+
+
+class BioCycObject(object):
+    '''
+    Compact base for cached objects
+
+    Attributes are held in __slots__ (no per-instance __dict__), frame IDs are interned
+    and kept in tuples, and the creation time is stored as a float timestamp. Pickles
+    of the earlier __dict__-based classes are converted on load by __setstate__.
+
+    Each object keeps the BioCyc instance that created or loaded it (see biocyc), which
+    relationship properties resolve through. It is not part of the cached state.
+    '''
+    __slots__ = ('id', 'org_id', '_created_at', '_biocyc')
+
+    # Attributes holding frame ID(s) of related objects, stored as interned strings/tuples
+    id_attributes = ()
+
+    def __init__(self, id=None, org_id=None, biocyc=None):
+        self.id = intern_id(id)
+        self.org_id = org_id
+        self._biocyc = biocyc
+        # Timestamp object on creation
+        self._created_at = time.time()
+
+    @property
+    def biocyc(self):
+        # The instance that created or loaded the object, else the module-level one
+        return getattr(self, '_biocyc', None) or biocyc
+
+    @property
+    def type(self):
+        return type(self).__name__.lower()
+
+    @property
+    def created_at(self):
+        return datetime.fromtimestamp(self._created_at)
+
+    @created_at.setter
+    def created_at(self, dt):
+        self._created_at = time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+    @classmethod
+    def _all_slots(cls):
+        if '_slots_cache' not in cls.__dict__:
+            cls._slots_cache = tuple( s for c in reversed(cls.__mro__) for s in c.__dict__.get('__slots__', ()) )
+        return cls._slots_cache
+
+    def __getstate__(self):
+        return dict( (s, getattr(self, s)) for s in self._all_slots() if s != '_biocyc' and hasattr(self, s) )
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple): # (__dict__, slots) from the default reduce
+            state = dict( state[0] or {}, **(state[1] or {}) )
+
+        slots = self._all_slots()
+        for k, v in state.items():
+            if k == 'created_at':
+                self.created_at = v
+                continue
+
+            k = RENAMED_ATTRIBUTES.get(k, k)
+            if k not in slots or k == '_biocyc':
+                continue # e.g. type, now derived from the class
+
+            if k in self.id_attributes:
+                v = intern_ids(v) if isinstance(v, (list, tuple)) else intern_id(v)
+            setattr(self, k, v)
+
+
+class BioCycEntityNotFound(BioCycObject):
+    __slots__ = ()
+
+    def __init__(self, id=None, org_id=None, biocyc=None, *args, **kwargs):
+        super(BioCycEntityNotFound, self).__init__(id, org_id, biocyc)
 
     def __bool__(self):
         return False
@@ -468,9 +1443,18 @@ class BioCycEntityNotFound(object):
     def __nonzero__(self):
         return False
 
+class BioCycEntityUnavailable(BioCycEntityNotFound):
+    '''
+    Placeholder for an object that could not be requested (offline), never cached
+    '''
+    __slots__ = ()
+
 # Global Pathomx db object class to simplify object display, synonym referencing, etc.
-class BioCycEntityBase(object):
+class BioCycEntityBase(BioCycObject):
+    __slots__ = ('name', 'name_as_html', 'synonyms', 'dblinks', '_parents', '_instances')
+
     xml_schema_id = None
+    organism_independent = False # The same in every organism database, see BioCyc.get_multi
     ipython_attribs = [
         ('Name', 'name_as_html'),
         ('BioCyc ID', 'biocyc_link_html'),
@@ -487,25 +1471,42 @@ class BioCycEntityBase(object):
         ('Species', '_species'),
         ('Taxonomic range', '_taxonomic_range'),
         ('Database links', 'dblinks_link_html')]
-    
-    def __init__(self, id=None, from_xml=None, *args, **kwargs):
-        self.type = type(self).__name__.lower()
 
-        self.id = id
+    # Relationship properties mapped to the attribute holding their frame ID(s)
+    relationships = {
+        'parents': '_parents',
+        'instances': '_instances',
+    }
+    # Relationship properties derived by following one or more paths of other
+    # relationships, the results of each path are concatenated
+    derived_relationships = {}
+
+    id_attributes = ('_parents', '_instances')
+
+    # Child element tags mapped to the fields they set, as (kind, path, attribute)
+    # with the kinds XML_TEXT, XML_ID, XML_IDS and XML_CALL
+    xml_fields = {
+        'parent': ((XML_IDS, None, '_parents'),),
+        'instance': ((XML_IDS, None, '_instances'),),
+        'common-name': ((XML_CALL, None, '_import_common_name'),),
+        'synonym': ((XML_CALL, None, '_import_synonym'),),
+        'dblink': ((XML_CALL, None, '_import_dblink'),),
+    }
+    xml_id_lists = id_list_fields(xml_fields)
+    
+    def __init__(self, id=None, from_xml=None, biocyc=None, *args, **kwargs):
+        super(BioCycEntityBase, self).__init__(id, biocyc=biocyc)
 
         # Parent and child relationships
-        self._parents = []
-        self._instances = []
+        self._parents = ()
+        self._instances = ()
         self.name = None
         self.name_as_html = None
         self.synonyms = []
         
         self.dblinks = {}
         
-        # Timestamp object on creation
-        self.created_at = datetime.now()
-        
-        if from_xml:
+        if from_xml is not None:
             self.import_from_xml(from_xml)
         
     def __unicode__(self):
@@ -526,7 +1527,7 @@ class BioCycEntityBase(object):
             val = getattr(self, attr, None)
             if val:
                 # Manipulate to text
-                if type(val) == list:
+                if type(val) in (list, tuple):
                     val = ', '.join(val)
                 elif type(val) == dict:
                     val = ', '.join( ['%s: %s' % (k,v) for k,v in val.items() ] )
@@ -550,119 +1551,59 @@ class BioCycEntityBase(object):
 
     def import_from_xml(self, xml):
         '''
-        Standard imports for all types of object
+        Import the object from its xml element in a single pass over the children,
+        dispatching each by tag to the fields it sets (see xml_fields)
         These must fail gracefully, skip if not found
         '''
-        self._import_orgid(xml)
-        self._import_parents_from_xml(xml)
-        self._import_instances_from_xml(xml)
-        self._import_common_name(xml)
-        self._import_synonyms(xml)
-        self._import_dblinks(xml)
-        
-    def _import_orgid(self, xml):
         self.org_id = xml.attrib['orgid']
 
-    def _import_parents_from_xml(self, xml):
-        parents = xml.iterfind('parent')
-        for p in parents:
-            for o in p:
-                # Store a tuple of orgid, identifier
-                self._parents.append( o.attrib['frameid'] ) #( o.attrib['orgid'],  ) )
-
-    def _import_instances_from_xml(self, xml):
-        instances = xml.iterfind('instance')
-        for p in instances:
-            for o in p:
-                # Store a tuple of orgid, identifier
-                self._instances.append( o.attrib['frameid'] ) #( o.attrib['orgid'],  ) )
-
-    def _import_common_name(self, xml):
-        e = xml.find('common-name')
-        if e is not None:
-            self.name_as_html = e.text
-            self.name = to_plain_text(self.name_as_html)
-        
-    def _import_synonyms(self, xml):
-        es = xml.iterfind('synonym')
-        for e in es:
-            self.synonyms.append(e.text)
-            
+        fields = self.xml_fields
+        ids = dict( (var, []) for var in self.xml_id_lists )
+        found = set()
+        for e in xml:
+            for kind, path, var in fields.get(e.tag, ()):
+                if kind == XML_IDS:
+                    ids[var].extend( c.attrib['frameid'] for c in e if path is None or c.tag == path )
+
+                elif kind == XML_CALL:
+                    getattr(self, var)(e)
+
+                elif var not in found: # First match only
+                    c = e if path is None else e.find(path)
+                    if c is None:
+                        continue
+                    if kind == XML_TEXT:
+                        setattr(self, var, type_converter[ c.attrib.get('datatype', 'string') ]( c.text ))
+                    else:
+                        setattr(self, var, intern_id(c.attrib['frameid']))
+                    found.add(var)
+
+        for var, l in ids.items():
+            setattr(self, var, intern_ids(l))
+
         if self.name is None and self.synonyms:
             self.name_as_html = self.synonyms[-1] # Apply last synonym if common name not defined
             self.name = to_plain_text(self.name_as_html)
-            
-    def _import_dblinks(self, xml):
-        es = xml.iterfind('dblink')
-        for e in es:
-            #<dblink-db>LIGAND-CPD</dblink-db><dblink-oid>C00186</dblink-oid>
-            self.dblinks[ e.find('dblink-db').text ] = e.find('dblink-oid').text
-
-    def _import_inchi(self, xml):
-        self._set_var_from_xml_text( xml, 'inchi', 'inchi') 
-
-    def _import_molecular_weight(self, xml):
-        self._set_var_from_xml_text( xml, 'molecular-weight', 'molecular_weight') 
-
-    def _import_gibbs0(self, xml):
-        self._set_var_from_xml_text( xml, 'gibbs-0', 'gibbs0' )
-    
-    def _import_reactions(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'appears-in-right-side-of/Reaction', 'reactions_in_right')
-        self._set_list_ids_from_xml_iter(xml, 'appears-in-left-side-of/Reaction', 'reactions_in_left')
-
-    def _import_reaction_list(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'reaction-list/Reaction', '_reactions')
-
-    def _import_super_pathways(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'super-pathways/Pathway', '_super_pathways')
-
-    def _import_pathways(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'in-pathway/Pathway', '_pathways')
-
-    def _import_species(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'species/Organism', '_species')
-    
-    def _import_taxonomic_range(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'taxonomic-range/Organism', '_taxonomic_range')
 
-    
-    def _set_var_from_xml_text(self, xml, xmlpath, var):
-        '''
-        Sets a object variable from the xml if it is there
-        and passing it through a data conversion based on the variable datatype
-        '''
-        xmle = xml.find(xmlpath)
-        if xmle is not None:
-            setattr(self, var, type_converter[ xmle.attrib.get('datatype', 'string') ]( xmle.text )) 
-    
-    def _set_list_ids_from_xml_iter(self, xml, xmlpath, var):
-        '''
-        Set a list variable from the frameids of matching xml entities
-        '''
-        es = xml.iterfind(xmlpath)
-        if es is not None:
-            l = []
-            for e in es:
-                l.append( e.attrib['frameid'] )
-            
-            setattr(self, var, l)
+    def _import_common_name(self, e):
+        if self.name_as_html is None:
+            self.name_as_html = e.text
+            self.name = to_plain_text(self.name_as_html)
+        
+    def _import_synonym(self, e):
+        self.synonyms.append(e.text)
             
-    def _set_id_from_xml_frameid(self, xml, xmlpath, var):
-        '''
-        Set a single variable with the frameids of matching entity
-        '''
-        e = xml.find(xmlpath)
-        if e is not None:
-            setattr(self, var, e.attrib['frameid'])
+    def _import_dblink(self, e):
+        #<dblink-db>LIGAND-CPD</dblink-db><dblink-oid>C00186</dblink-oid>
+        self.dblinks[ e.find('dblink-db').text ] = e.find('dblink-oid').text
 
     @property
     def parents(self):
-        return biocyc.get_for_org( self.org_id, self._parents )
+        return self.biocyc.get_for_org( self.org_id, self._parents )
 
     @property
     def instances(self):
-        return biocyc.get_for_org( self.org_id, self._instances )
+        return self.biocyc.get_for_org( self.org_id, self._instances )
 
     @property
     def dblinks_link_html(self):
@@ -676,39 +1617,51 @@ class BioCycEntityBase(object):
 
     @property
     def biocyc_link_html(self):
-        return '<a href="%s">%s</a>' % (biocyc.biocyc_obj_url(self.id), self.id )
+        return '<a href="%s">%s</a>' % (self.biocyc.biocyc_obj_url(self.id), self.id )
 
 
 
 class Compound(BioCycEntityBase):
+    __slots__ = ('inchi', 'molecular_weight', 'gibbs0', 'reactions_in_right', 'reactions_in_left')
+    id_attributes = BioCycEntityBase.id_attributes + ('reactions_in_right', 'reactions_in_left')
     xml_schema_id = 'Compound'
     localstore = 'compounds'
+    organism_independent = True
+
+    xml_fields = extend_xml_fields(BioCycEntityBase.xml_fields, {
+        'inchi': ((XML_TEXT, None, 'inchi'),),
+        'molecular-weight': ((XML_TEXT, None, 'molecular_weight'),),
+        'gibbs-0': ((XML_TEXT, None, 'gibbs0'),),
+        'appears-in-right-side-of': ((XML_IDS, 'Reaction', 'reactions_in_right'),),
+        'appears-in-left-side-of': ((XML_IDS, 'Reaction', 'reactions_in_left'),),
+    })
+    xml_id_lists = id_list_fields(xml_fields)
+
+    relationships = dict(BioCycEntityBase.relationships,
+        reactions='_reactions',
+    )
+    derived_relationships = {
+        'pathways': [('reactions', 'pathways')],
+    }
 
     def __init__(self, *args, **kwargs):
         self.inchi = ''
         self.molecular_weight = None
         self.gibbs0 = None
         
-        self.reactions_in_right = []
-        self.reactions_in_left = []
+        self.reactions_in_right = ()
+        self.reactions_in_left = ()
         
         super(Compound, self).__init__(*args, **kwargs)
     
-    def import_from_xml(self, xml):
-        super(Compound, self).import_from_xml(xml)
-        self._import_inchi(xml)
-        self._import_molecular_weight(xml)
-        self._import_gibbs0(xml)
-        self._import_reactions(xml)
-    
-                    
+
     @property
     def _reactions(self):
         return self.reactions_in_right + self.reactions_in_left
        
     @property
     def reactions(self):
-        return biocyc.get_for_org( self.org_id, self._reactions )
+        return self.biocyc.get_for_org( self.org_id, self._reactions )
 
     @property
     def pathways(self):
@@ -716,40 +1669,55 @@ class Compound(BioCycEntityBase):
     
     
 class Pathway(BioCycEntityBase):
+    __slots__ = ('_parent', '_reactions', '_species', '_super_pathways', '_subclasses', '_taxonomic_range')
+    id_attributes = BioCycEntityBase.id_attributes + ('_parent', '_reactions', '_species', '_super_pathways', '_subclasses', '_taxonomic_range')
     xml_schema_id = 'Pathway'
     localstore = 'pathways'
 
+    xml_fields = extend_xml_fields(BioCycEntityBase.xml_fields, {
+        'parent': ((XML_ID, 'Pathway', '_parent'),),
+        'subclass': ((XML_IDS, 'Pathway', '_subclasses'),),
+        'reaction-list': ((XML_IDS, 'Reaction', '_reactions'),),
+        'species': ((XML_IDS, 'Organism', '_species'),),
+        'super-pathways': ((XML_IDS, 'Pathway', '_super_pathways'),),
+        'taxonomic-range': ((XML_IDS, 'Organism', '_taxonomic_range'),),
+    })
+    xml_fields['instance'] = ((XML_IDS, 'Pathway', '_instances'),) # Only pathway instances
+    xml_id_lists = id_list_fields(xml_fields)
+
+    relationships = dict(BioCycEntityBase.relationships,
+        parent='_parent',
+        subclasses='_subclasses',
+        reactions='_reactions',
+        species='_species',
+        super_pathways='_super_pathways',
+        taxonomic_range='_taxonomic_range',
+    )
+    derived_relationships = {
+        'compounds': [('reactions', 'compounds')],
+    }
+
     def __init__(self, *args, **kwargs):
         self._parent = None
-        self._reactions = []
-        self._species = []
-        self._super_pathways = []
-        self._instances = []
-        self._subclasses = []
-        self._taxonomic_range = []
+        self._reactions = ()
+        self._species = ()
+        self._super_pathways = ()
+        self._instances = ()
+        self._subclasses = ()
+        self._taxonomic_range = ()
         super(Pathway, self).__init__(*args, **kwargs)
 
-    def import_from_xml(self, xml):
-        super(Pathway, self).import_from_xml(xml)
-        self._import_parent(xml)
-        self._import_instances(xml)
-        self._import_subclasses(xml)
-        self._import_reaction_list(xml)
-        self._import_species(xml)
-        self._import_super_pathways(xml)
-        self._import_taxonomic_range(xml)
-
     @property
     def parent(self):
-        return biocyc.get_for_org( self.org_id, self._parent )
+        return self.biocyc.get_for_org( self.org_id, self._parent )
 
     @property
     def instances(self):
-        return biocyc.get_for_org( self.org_id, self._instances )
+        return self.biocyc.get_for_org( self.org_id, self._instances )
 
     @property
     def subclasses(self):
-        return biocyc.get_for_org( self.org_id, self._subclasses )
+        return self.biocyc.get_for_org( self.org_id, self._subclasses )
 
     @property
     def compounds(self):
@@ -757,56 +1725,66 @@ class Pathway(BioCycEntityBase):
 
     @property
     def reactions(self):
-        return biocyc.get_for_org( self.org_id, self._reactions )
+        return self.biocyc.get_for_org( self.org_id, self._reactions )
 
     @property
     def species(self):
-        return biocyc.get_for_org( self.org_id, self._species )
+        return self.biocyc.get_for_org( self.org_id, self._species )
 
     @property
     def super_pathways(self):
-        return biocyc.get_for_org( self.org_id, self._super_pathways )
+        return self.biocyc.get_for_org( self.org_id, self._super_pathways )
 
     @property
     def taxonomic_range(self):
-        return biocyc.get_for_org( self.org_id, self._taxonomic_range )
-
-    def _import_parent(self, xml):
-        self._set_id_from_xml_frameid(xml, 'parent/Pathway', '_parent')
-
-    def _import_instances(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'instance/Pathway', '_instances')
-
-    def _import_subclasses(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'subclass/Pathway', '_subclasses')
+        return self.biocyc.get_for_org( self.org_id, self._taxonomic_range )
 
 
 class Reaction(BioCycEntityBase):
+    __slots__ = ('_pathways', '_compounds_left', '_compounds_right', '_enzymatic_reactions', 'direction')
+    id_attributes = BioCycEntityBase.id_attributes + ('_pathways', '_compounds_left', '_compounds_right', '_enzymatic_reactions')
     xml_schema_id = 'Reaction'
     localstore = 'reactions'
 
+    xml_fields = extend_xml_fields(BioCycEntityBase.xml_fields, {
+        'enzymatic-reaction': ((XML_IDS, 'Enzymatic-Reaction', '_enzymatic_reactions'), (XML_CALL, None, '_import_enzymatic_reaction_objects')),
+        'in-pathway': ((XML_IDS, 'Pathway', '_pathways'),),
+        'left': ((XML_IDS, 'Compound', '_compounds_left'),),
+        'right': ((XML_IDS, 'Compound', '_compounds_right'),),
+        'reaction-direction': ((XML_TEXT, None, 'direction'),),
+    })
+    xml_id_lists = id_list_fields(xml_fields)
+
+    relationships = dict(BioCycEntityBase.relationships,
+        compounds_left='_compounds_left',
+        compounds_right='_compounds_right',
+        compounds='_compounds',
+        enzymatic_reactions='_enzymatic_reactions',
+        pathways='_pathways',
+    )
+    derived_relationships = {
+        'enzymes': [('enzymatic_reactions', 'enzyme')],
+    }
+
     def __init__(self, *args, **kwargs):
-        self._pathways = []
-        self._compounds_left = []
-        self._compounds_right = []
-        self._enzymatic_reactions = []
+        self._pathways = ()
+        self._compounds_left = ()
+        self._compounds_right = ()
+        self._enzymatic_reactions = ()
+        self.direction = None
         super(Reaction, self).__init__(*args, **kwargs)
 
-    def import_from_xml(self, xml):
-        super(Reaction, self).import_from_xml(xml)
-        self._import_enzymatic_reaction_objects(xml)
-        self._import_pathways(xml)
-        self._import_compounds_left(xml)
-        self._import_compounds_right(xml)
-        self._import_reaction_direction(xml)
-        
     @property
     def compounds_left(self):
-        return biocyc.get_for_org( self.org_id, self._compounds_left )
+        return self.biocyc.get_for_org( self.org_id, self._compounds_left )
 
     @property
     def compounds_right(self):
-        return biocyc.get_for_org( self.org_id, self._compounds_right )
+        return self.biocyc.get_for_org( self.org_id, self._compounds_right )
+
+    @property
+    def _compounds(self):
+        return self._compounds_left + self._compounds_right
 
     @property
     def compounds(self):
@@ -814,7 +1792,7 @@ class Reaction(BioCycEntityBase):
 
     @property
     def enzymatic_reactions(self):
-        return biocyc.get_for_org( self.org_id, self._enzymatic_reactions )
+        return self.biocyc.get_for_org( self.org_id, self._enzymatic_reactions )
 
     @property
     def enzymes(self):
@@ -822,58 +1800,49 @@ class Reaction(BioCycEntityBase):
 
     @property
     def pathways(self):
-        return biocyc.get_for_org( self.org_id, self._pathways )
+        return self.biocyc.get_for_org( self.org_id, self._pathways )
 
-    def _import_enzymatic_reaction_objects(self, xml):
+    def _import_enzymatic_reaction_objects(self, e):
         # The EnzymaticReaction data in the Reaction XML contains all the information we need
         # to create an EnzymaticReaction object, despite being detail=low.
         # Auto-create them here to avoid unnecessary request
-        enzyme_reaction_list = []
-        for er in xml.iterfind('enzymatic-reaction/Enzymatic-Reaction'):
-            id = er.attrib['frameid']
-            enzyme_reaction_list.append(id)
-            obj = EnzymaticReaction( id=id, from_xml=er)
-            biocyc.cache(obj)
-            
-        self._enzymatic_reactions = enzyme_reaction_list
-
-    def _import_compounds_left(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'left/Compound', '_compounds_left')
-
-    def _import_compounds_right(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'right/Compound', '_compounds_right')
-
-    def _import_reaction_direction(self, xml):
-        self._set_var_from_xml_text( xml, 'reaction-direction', 'direction') 
+        for er in e.iterfind('Enzymatic-Reaction'):
+            obj = EnzymaticReaction( id=er.attrib['frameid'], from_xml=er, biocyc=self.biocyc)
+            self.biocyc.cache(obj)
 
     
 class EnzymaticReaction(BioCycEntityBase):
+    __slots__ = ('_enzyme', '_reaction')
+    id_attributes = BioCycEntityBase.id_attributes + ('_enzyme', '_reaction')
     xml_schema_id = 'Enzymatic-Reaction'
     localstore = 'enzymaticreactions'
 
+    xml_fields = extend_xml_fields(BioCycEntityBase.xml_fields, {
+        'enzyme': ((XML_ID, 'Protein', '_enzyme'),),
+        'reaction': ((XML_ID, 'Reaction', '_reaction'),),
+    })
+    xml_id_lists = id_list_fields(xml_fields)
+
+    relationships = dict(BioCycEntityBase.relationships,
+        enzyme='_enzyme',
+        reaction='_reaction',
+    )
+    derived_relationships = {
+        'pathways': [('reaction', 'pathways')],
+    }
+
     def __init__(self, *args, **kwargs):
         self._enzyme = None
         self._reaction = None
         super(EnzymaticReaction, self).__init__(*args, **kwargs)
 
-    def import_from_xml(self, xml):
-        super(EnzymaticReaction, self).import_from_xml(xml)
-        self._import_enzyme(xml)
-        self._import_reaction(xml)
-
-    def _import_enzyme(self, xml):
-        self._set_id_from_xml_frameid(xml, 'enzyme/Protein', '_enzyme')
-
-    def _import_reaction(self, xml):
-        self._set_id_from_xml_frameid(xml, 'reaction/Reaction', '_reaction')
-
     @property
     def enzyme(self):
-        return biocyc.get_for_org( self.org_id, self._enzyme )
+        return self.biocyc.get_for_org( self.org_id, self._enzyme )
 
     @property
     def reaction(self):
-        return biocyc.get_for_org( self.org_id, self._reaction )
+        return self.biocyc.get_for_org( self.org_id, self._reaction )
 
     @property
     def pathways(self):
@@ -881,34 +1850,51 @@ class EnzymaticReaction(BioCycEntityBase):
 
 
 class Protein(BioCycEntityBase):
+    __slots__ = ('_parent', '_gene', '_location', '_components', '_complexes', '_catalyzes', 'component_coefficient')
+    id_attributes = BioCycEntityBase.id_attributes + ('_parent', '_gene', '_location', '_components', '_complexes', '_catalyzes')
     xml_schema_id = 'Protein'
     localstore = 'proteins'
 
+    xml_fields = extend_xml_fields(BioCycEntityBase.xml_fields, {
+        'parent': ((XML_ID, 'Protein', '_parent'),),
+        'gene': ((XML_ID, 'Gene', '_gene'),),
+        'component': ((XML_IDS, 'Protein', '_components'), (XML_TEXT, 'coefficient', 'component_coefficient')),
+        'component-of': ((XML_IDS, 'Protein', '_complexes'),),
+        'catalyzes': ((XML_IDS, 'Enzymatic-Reaction', '_catalyzes'),),
+    })
+    xml_id_lists = id_list_fields(xml_fields)
+
+    relationships = dict(BioCycEntityBase.relationships,
+        parent='_parent',
+        gene='_gene',
+        location='_location',
+        components='_components',
+        complexes='_complexes',
+        catalyzes='_catalyzes',
+    )
+    derived_relationships = {
+        'genes': [('components', 'gene'), ('gene',)],
+        'reactions': [('catalyzes', 'reaction')],
+        'pathways': [('catalyzes', 'reaction', 'pathways'), ('complexes', 'catalyzes', 'reaction', 'pathways')],
+    }
+
     def __init__(self, *args, **kwargs):
         self._parent = None
         self._gene = None
         self._location = None
-        self._components = [] # Subunits
-        self._complexes = [] # Subunits of
-        self._catalyzes = []
+        self._components = () # Subunits
+        self._complexes = () # Subunits of
+        self._catalyzes = ()
         self.component_coefficient = None
         super(Protein, self).__init__(*args, **kwargs)
 
-    def import_from_xml(self, xml):
-        super(Protein, self).import_from_xml(xml)
-        self._import_parent(xml)
-        self._import_gene(xml)
-        self._import_components(xml)
-        self._import_complexes(xml)
-        self._import_enzymatic_reactions(xml)
-
     @property
     def parent(self):
-        return biocyc.get_for_org( self.org_id, self._parent )
+        return self.biocyc.get_for_org( self.org_id, self._parent )
         
     @property
     def gene(self):
-        return biocyc.get_for_org( self.org_id, self._gene )
+        return self.biocyc.get_for_org( self.org_id, self._gene )
         
     @property
     def genes(self): # Including subunits
@@ -919,38 +1905,22 @@ class Protein(BioCycEntityBase):
         
     @property
     def location(self):
-        return biocyc.get_for_org( self.org_id, self._location )
+        return self.biocyc.get_for_org( self.org_id, self._location )
     
-    def _import_gene(self, xml):
-        self._set_id_from_xml_frameid(xml, 'gene/Gene', '_gene')
-
-    def _import_location(self, xml):
-        self._set_id_from_xml_frameid(xml, 'location/cco', '_location')
-
-    def _import_parent(self, xml):
-        self._set_id_from_xml_frameid(xml, 'parent/Protein', '_parent')
-
     @property
     def components(self):
-        return biocyc.get_for_org( self.org_id, self._components )
-
-    def _import_components(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'component/Protein', '_components')
-        self._set_var_from_xml_text( xml, 'component/coefficient', 'component_coeffecient') 
+        return self.biocyc.get_for_org( self.org_id, self._components )
 
     @property
     def complexes(self):
         if hasattr(self, '_complexes'):
-            return biocyc.get_for_org( self.org_id, self._complexes )
+            return self.biocyc.get_for_org( self.org_id, self._complexes )
         else:
             return []
 
-    def _import_complexes(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'component-of/Protein', '_complexes')
-
     @property
     def catalyzes(self):
-        return biocyc.get_for_org( self.org_id, self._catalyzes )
+        return self.biocyc.get_for_org( self.org_id, self._catalyzes )
 
     @property
     def reactions(self):
@@ -965,27 +1935,32 @@ class Protein(BioCycEntityBase):
             pathway_lists += [er.reaction.pathways for er in clean(c.catalyzes)]
         return [p for pl in pathway_lists for p in pl]
 
-    def _import_enzymatic_reactions(self, xml):
-        self._set_list_ids_from_xml_iter(xml, 'catalyzes/Enzymatic-Reaction', '_catalyzes')
-
 class Gene(BioCycEntityBase):
+    __slots__ = ('_protein',)
+    id_attributes = BioCycEntityBase.id_attributes + ('_protein',)
     xml_schema_id = 'Gene'
     localstore = 'genes'
 
+    xml_fields = extend_xml_fields(BioCycEntityBase.xml_fields, {
+        'product': ((XML_ID, 'Protein', '_protein'),),
+    })
+    xml_id_lists = id_list_fields(xml_fields)
+
+    relationships = dict(BioCycEntityBase.relationships,
+        protein='_protein',
+    )
+    derived_relationships = {
+        'reactions': [('protein', 'reactions')],
+        'pathways': [('protein', 'pathways')],
+    }
+
     def __init__(self, *args, **kwargs):
         self._protein = None
         super(Gene, self).__init__(*args, **kwargs)
 
-    def import_from_xml(self, xml):
-        super(Gene, self).import_from_xml(xml)
-        self._import_protein(xml)
-
-    def _import_protein(self, xml):
-        self._set_id_from_xml_frameid(xml, 'product/Protein', '_protein')
-        
     @property
     def protein(self):
-        return biocyc.get_for_org( self.org_id, self._protein )
+        return self.biocyc.get_for_org( self.org_id, self._protein )
 
     @property
     def reactions(self):
@@ -997,37 +1972,43 @@ class Gene(BioCycEntityBase):
 
 
 class DNABindingSite(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class Organism(BioCycEntityBase):
+    __slots__ = ()
     xml_schema_id = 'Organism'
-    pass
 
 class Polypeptides(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class Promoter(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class Complex(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class ProteinFeature(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class TranscriptionUnit(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class tRNA(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class Regulation(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 class Chromosome(BioCycEntityBase):
-    pass
+    __slots__ = ()
 
 
 AVAILABLE_OBJECT_TYPES = [Compound, Pathway, Reaction, Protein, Gene, DNABindingSite, \
 EnzymaticReaction, Organism, Polypeptides, Promoter, Complex, ProteinFeature, \
-TranscriptionUnit, tRNA, Regulation]
\ No newline at end of file
+TranscriptionUnit, tRNA, Regulation]
+
+# Object types by the tag of their XML element, and their order of precedence, for create_objs_from_xml
+OBJECT_TYPES_BY_TAG = dict( (o.xml_schema_id, o) for o in AVAILABLE_OBJECT_TYPES if o.xml_schema_id )
+OBJECT_TYPE_RANKS = dict( (o.xml_schema_id, n) for n, o in enumerate(AVAILABLE_OBJECT_TYPES) if o.xml_schema_id )
+
+serialize.register(BioCycEntityNotFound, *AVAILABLE_OBJECT_TYPES)
\ No newline at end of file
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only cache bundles
+
+A bundle packs the cached objects of one organism into a single immutable file,
+which worker processes open through mmap and share via the OS page cache. Objects
+are decoded on demand straight from the mapped file, so opening a bundle costs
+nothing however many objects it holds.
+
+Layout (little-endian):
+
+    header    magic, version, entry count, org_id length, org_id, index offset, ids offset
+    data      serialized objects, back to back
+    ids       frame IDs (UTF-8), back to back
+    index     fixed-size entries sorted by frame ID:
+              id offset, id length, data offset, data length, created_at
+
+"""
+import os
+import mmap
+import struct
+
+from . import serialize
+from .stores import CacheStore, timestamp, from_timestamp
+
+BUNDLE_MAGIC = b'BCYB'
+BUNDLE_VERSION = 1
+
+HEADER = struct.Struct('<4sII')
+OFFSETS = struct.Struct('<QQ')
+ENTRY = struct.Struct('<QIQId')
+
+
+def export_bundle(stores, org_id, path, batch_size=1000, compression=None):
+    '''
+    Write all objects for org_id from stores (first store wins for duplicates) to a bundle
+    at path, as records (see biocyc.serialize) compressed with compression
+
+    Returns the number of objects written.
+    '''
+    ids = []
+    seen = set()
+    for store in stores:
+        for id, _ in store.iter_created(org_id):
+            if id not in seen:
+                seen.add(id)
+                ids.append(id)
+
+    entries = []
+    org = org_id.encode('utf-8')
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write( HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, 0) ) # Count rewritten below
+        f.write( struct.pack('<H', len(org)) + org )
+        f.write( OFFSETS.pack(0, 0) )
+
+        for n in range(0, len(ids), batch_size):
+            batch = ids[n:n + batch_size]
+            objs = {}
+            for store in stores:
+                missing = [id for id in batch if id not in objs]
+                if not missing:
+                    break
+                objs.update( store.get_many(org_id, missing) )
+
+            for id in batch:
+                obj = objs.get(id)
+                if obj is None or not hasattr(obj, 'created_at'): # Not an object, e.g. an index file
+                    continue
+                data = serialize.dumps(obj, compression)
+                entries.append( (id.encode('utf-8'), f.tell(), len(data), timestamp(obj.created_at)) )
+                f.write(data)
+
+        entries.sort()
+
+        ids_offset = f.tell()
+        id_offsets = []
+        for id, _, _, _ in entries:
+            id_offsets.append( f.tell() )
+            f.write(id)
+
+        index_offset = f.tell()
+        for id_offset, (id, offset, length, created_at) in zip(id_offsets, entries):
+            f.write( ENTRY.pack(id_offset, len(id), offset, length, created_at) )
+
+        f.seek(0)
+        f.write( HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(entries)) )
+        f.seek(HEADER.size + 2 + len(org))
+        f.write( OFFSETS.pack(index_offset, ids_offset) )
+
+    os.replace(tmp, path)
+    return len(entries)
+
+
+class BundleStore(CacheStore):
+    '''
+    Read-only store for a bundle file, for use as a secondary cache
+    '''
+    name = 'bundle'
+    read_only = True
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, version, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            raise ValueError('%s is not a version %d bundle' % (path, BUNDLE_VERSION))
+
+        org_length = struct.unpack_from('<H', self._mmap, HEADER.size)[0]
+        self.org_id = bytes(self._mmap[HEADER.size + 2:HEADER.size + 2 + org_length]).decode('utf-8')
+        self._index_offset, _ = OFFSETS.unpack_from(self._mmap, HEADER.size + 2 + org_length)
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, n):
+        return ENTRY.unpack_from(self._mmap, self._index_offset + n * ENTRY.size)
+
+    def _entry_id(self, entry):
+        return self._mmap[entry[0]:entry[0] + entry[1]]
+
+    def _find(self, id):
+        key = id.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi: # Binary search over the sorted index
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            entry_id = self._entry_id(entry)
+            if entry_id < key:
+                lo = mid + 1
+            elif entry_id > key:
+                hi = mid
+            else:
+                return entry
+        return None
+
+    def get(self, org_id, id, sized=False):
+        if org_id != self.org_id:
+            return None
+
+        entry = self._find(id)
+        if entry is not None:
+            return self.load_record( org_id, id, self._view[entry[2]:entry[2] + entry[3]], sized )
+
+    def put(self, obj):
+        raise IOError('Bundle %s is read-only' % self.path)
+
+    def iter_created(self, org_id, before=None):
+        if org_id != self.org_id:
+            return
+
+        for n in range(self.count):
+            entry = self._entry(n)
+            created_at = from_timestamp(entry[4])
+            if before is None or created_at < before:
+                yield self._entry_id(entry).decode('utf-8'), created_at
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
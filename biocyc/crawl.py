@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable whole-organism mirror
+
+Starting from the organism's pathway and compound lists, walk breadth-first over
+every relationship ID field, loading each object through the cache. Objects that
+are already cached (and not expired) are not requested again, but are still followed.
+The frontier is checkpointed after every batch so an interrupted crawl resumes where
+it stopped.
+
+    python -m biocyc.crawl ECOLI --checkpoint ecoli.json --workers 4 --rate 2 --burst 4
+
+"""
+import os
+import json
+import time
+import logging
+import argparse
+
+from .biocyc import biocyc as default_biocyc, clean
+
+DEFAULT_SEEDS = ['Pathways', 'Compounds']
+
+
+class Crawler(object):
+    '''
+    Breadth-first crawl of all objects reachable from seeds (class frames whose instances
+    start the crawl) for one organism, optionally following only the named relationships
+    '''
+    def __init__(self, org_id, biocyc=None, checkpoint=None, seeds=DEFAULT_SEEDS, relations=None,
+                 batch_size=500, workers=None, progress=None):
+        self.biocyc = biocyc or default_biocyc
+        self.org_id = org_id.upper()
+        self.checkpoint = checkpoint
+        self.seeds = seeds
+        self.relations = relations
+        self.batch_size = batch_size
+        self.workers = workers
+        self.progress = progress # Called with the stats dict after each batch
+
+        self.frontier = []
+        self.seen = set()
+        self.stats = {'loaded': 0, 'requested': 0, 'not_found': 0, 'elapsed': 0.0}
+
+    def list_instances(self, cls):
+        '''
+        Return the frame IDs of all instances of the class frame cls, e.g. Pathways
+        '''
+        xml = self.biocyc.request_api('get-class-all-instances', self.org_id, cls, detail='none')
+        if xml is None:
+            return []
+        return [e.attrib['frameid'] for e in xml if 'frameid' in e.attrib]
+
+    def load_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint, 'r') as f:
+                state = json.load(f)
+            if state['org_id'] == self.org_id:
+                self.frontier = state['frontier']
+                self.seen = set(state['seen'])
+                self.stats.update(state['stats'])
+                return True
+        return False
+
+    def save_checkpoint(self):
+        if self.checkpoint:
+            tmp = self.checkpoint + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'org_id': self.org_id, 'frontier': self.frontier, 'seen': sorted(self.seen), 'stats': self.stats}, f)
+            os.replace(tmp, self.checkpoint)
+
+    def _queue(self, ids):
+        for id in ids:
+            if id and id not in self.seen:
+                self.seen.add(id)
+                self.frontier.append(id)
+
+    def _related_ids(self, obj):
+        for name, attr in obj.relationships.items():
+            if self.relations is None or name in self.relations:
+                value = getattr(obj, attr, None)
+                for id in (value if isinstance(value, (list, tuple)) else [value]):
+                    yield id
+
+    def run(self):
+        '''
+        Crawl until the frontier is empty, returning the stats
+        '''
+        if not self.load_checkpoint():
+            for cls in self.seeds:
+                self._queue( self.list_instances(cls) )
+            self.save_checkpoint()
+
+        while self.frontier:
+            started = time.time()
+            batch = self.frontier[:self.batch_size]
+
+            cached = self.biocyc.get_many_from_cache(self.org_id, batch)
+            objs = self.biocyc.get_for_org(self.org_id, batch, workers=self.workers)
+            for obj in clean(objs):
+                self._queue( self._related_ids(obj) )
+
+            self.frontier = self.frontier[len(batch):]
+
+            self.stats['loaded'] += len(batch)
+            self.stats['requested'] += len(batch) - len(cached)
+            self.stats['not_found'] += len(batch) - len(clean(objs))
+            self.stats['elapsed'] += time.time() - started
+            self.save_checkpoint()
+            self.report()
+
+        return self.stats
+
+    def report(self):
+        stats = dict(self.stats, remaining=len(self.frontier))
+        stats['rate'] = stats['requested'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        logging.info('%s: %d loaded (%d requested, %d not found), %d remaining, %.1f requested objects/s' % (
+            self.org_id, stats['loaded'], stats['requested'], stats['not_found'], stats['remaining'], stats['rate']))
+        if self.progress is not None:
+            self.progress(stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mirror a BioCyc organism database into the local cache')
+    parser.add_argument('org_id', help='organism database identifier, e.g. ECOLI')
+    parser.add_argument('--checkpoint', help='file to checkpoint the crawl to (and resume from)')
+    parser.add_argument('--cache-path', help='cache folder (default ~/.biocyc)')
+    parser.add_argument('--seeds', nargs='+', default=DEFAULT_SEEDS, help='classes whose instances start the crawl')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--rate', type=float, help='requests per second')
+    parser.add_argument('--burst', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    biocyc = default_biocyc
+    if args.cache_path:
+        biocyc.cache_path = args.cache_path
+    if args.rate:
+        biocyc.set_rate_limit(args.rate, args.burst)
+
+    crawler = Crawler(args.org_id, biocyc=biocyc, checkpoint=args.checkpoint, seeds=args.seeds,
+                      batch_size=args.batch_size, workers=args.workers)
+    crawler.run()
+
+
+if __name__ == '__main__':
+    main()
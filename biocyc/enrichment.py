@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Pathway over-representation analysis
+
+The membership of compounds (or genes) in pathways is built once per organism from
+the network index into a sparse entity-by-pathway matrix (CSR, int32 arrays), so
+testing a query set touches only the rows of its members and loads no objects:
+
+    membership = biocyc.pathway_membership('compound', rollup=True)
+    results = membership.test(['PYRUVATE', 'ACETYL-COA', 'CIT'])
+    results = membership.test_many(query_sets, background=measured)
+
+Each pathway hit by a query set is tested with the hypergeometric upper tail, which
+is the one-sided Fisher's exact test (alternative='two-sided' for the two-sided
+test), and q-values are computed by Benjamini-Hochberg over all tested pathways.
+Probabilities for the same (overlap, pathway size, query size) are computed once
+per batch, so large batches of query sets cost little more than their overlaps.
+
+With rollup, super-pathways also contain the members of their sub-pathways
+(following Pathway.super_pathways at every level).
+
+"""
+import math
+
+from array import array
+from collections import namedtuple, defaultdict
+
+ALTERNATIVES = ['greater', 'two-sided']
+
+EnrichmentResult = namedtuple('EnrichmentResult', [
+    'pathway', 'overlap', 'pathway_size', 'query_size', 'universe_size', 'p_value', 'q_value', 'members'])
+
+
+def _log_choose(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+def hypergeometric_pmfs(N, K, n):
+    '''
+    Return (lowest overlap, probabilities of each overlap from there) for a random
+    n-subset of N items containing K marked ones
+    '''
+    lo, hi = max(0, n - (N - K)), min(K, n)
+    log_p = _log_choose(K, lo) + _log_choose(N - K, n - lo) - _log_choose(N, n)
+    log_pmfs = [log_p]
+    for x in range(lo, hi): # In logs, as the first may be too small for a float
+        log_p += math.log( (K - x) * (n - x) / ((x + 1) * (N - K - n + x + 1)) )
+        log_pmfs.append(log_p)
+    return lo, [math.exp(l) for l in log_pmfs]
+
+
+def hypergeometric_sf(k, N, K, n):
+    '''
+    Probability of an overlap of k or more, i.e. the one-sided Fisher's exact test
+    '''
+    lo, pmfs = hypergeometric_pmfs(N, K, n)
+    return min(1.0, sum( pmfs[max(k - lo, 0):] ))
+
+
+def fisher_two_sided(k, N, K, n):
+    '''
+    Probability of an overlap as or less likely than k (two-sided Fisher's exact test)
+    '''
+    lo, pmfs = hypergeometric_pmfs(N, K, n)
+    if not lo <= k < lo + len(pmfs):
+        return 0.0
+    observed = pmfs[k - lo] * (1 + 1e-7) # Allow for rounding of equal probabilities
+    return min(1.0, sum( p for p in pmfs if p <= observed ))
+
+
+def benjamini_hochberg(p_values, m=None):
+    '''
+    Return the Benjamini-Hochberg q-values (FDR) for p_values, in the same order, out of
+    m tests in total (default len(p_values); the others are taken as p = 1)
+    '''
+    m = m or len(p_values)
+    order = sorted( range(len(p_values)), key=lambda i: p_values[i] )
+    q_values = [1.0] * len(p_values)
+    q = 1.0
+    for rank in range(len(order), 0, -1):
+        i = order[rank - 1]
+        q = min(q, p_values[i] * m / rank)
+        q_values[i] = q
+    return q_values
+
+
+class PathwayMembership(object):
+    '''
+    Sparse entity-by-pathway membership matrix for one organism, see build
+
+    Row r lists the pathways (column numbers, into pathways) of entities[r], in
+    indices[indptr[r]:indptr[r + 1]].
+    '''
+    def __init__(self, entities, pathways, indptr, indices):
+        self.entities = entities
+        self.pathways = pathways
+        self.indptr = indptr
+        self.indices = indices
+
+        self._rows = dict( (id, r) for r, id in enumerate(entities) )
+        self.sizes = array('i', [0]) * len(pathways) # Members of each pathway
+        for c in indices:
+            self.sizes[c] += 1
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def pathways_of(self, id):
+        r = self._rows.get(id)
+        if r is None:
+            return []
+        return [self.pathways[c] for c in self.indices[self.indptr[r]:self.indptr[r + 1]]]
+
+    @classmethod
+    def build(cls, network, kind='compound', rollup=False):
+        '''
+        Build the matrix for kind ('compound' or 'gene') from a NetworkIndex
+
+        Compounds are members of the pathways of the reactions they take part in, genes of
+        the pathways of the reactions catalysed by their proteins (or the complexes those
+        are subunits of), as for Compound.pathways and Gene.pathways.
+        '''
+        if kind not in ('compound', 'gene'):
+            raise ValueError('Membership kind must be compound or gene')
+
+        neighbors = network._neighbors
+        members = defaultdict(set) # Pathway node: entity nodes
+
+        for p in range(len(network)):
+            reactions = neighbors(p, 'reaction-pathway', True)
+            if not reactions:
+                continue
+
+            if kind == 'compound':
+                for r in reactions:
+                    members[p].update( neighbors(r, 'reaction-compound-left', False) )
+                    members[p].update( neighbors(r, 'reaction-compound-right', False) )
+            else:
+                proteins = set( e for r in reactions for er in neighbors(r, 'reaction-enzrxn', False) for e in neighbors(er, 'enzrxn-protein', False) )
+                proteins.update( s for c in list(proteins) for s in neighbors(c, 'protein-complex', True) ) # Subunits
+                members[p].update( g for protein in proteins for g in neighbors(protein, 'protein-gene', False) )
+
+        if rollup:
+            for p, entities in list(members.items()):
+                seen = set()
+                queue = list( neighbors(p, 'pathway-super', False) )
+                while queue:
+                    s = queue.pop()
+                    if s not in seen:
+                        seen.add(s)
+                        members[s].update(entities)
+                        queue.extend( neighbors(s, 'pathway-super', False) )
+
+        frame_id = network.frame_id
+        pathways = sorted( (frame_id(p), p) for p, entities in members.items() if entities )
+        rows = defaultdict(list) # Entity frame ID: columns
+        for c, (_, p) in enumerate(pathways):
+            for e in members[p]:
+                rows[frame_id(e)].append(c)
+
+        entities = sorted(rows)
+        indptr, indices = array('i', [0]), array('i')
+        for id in entities:
+            indices.extend( sorted(rows[id]) )
+            indptr.append( len(indices) )
+
+        return cls(entities, [id for id, _ in pathways], indptr, indices)
+
+    def restrict(self, background):
+        '''
+        Return the matrix for the entities in background only, e.g. those measured
+        '''
+        background = set(background)
+        entities = [id for id in self.entities if id in background]
+        indptr, indices = array('i', [0]), array('i')
+        for id in entities:
+            r = self._rows[id]
+            indices.extend( self.indices[self.indptr[r]:self.indptr[r + 1]] )
+            indptr.append( len(indices) )
+        return PathwayMembership(entities, self.pathways, indptr, indices)
+
+    def test(self, ids, **kwargs):
+        '''
+        Test one query set, see test_many
+        '''
+        return self.test_many([ids], **kwargs)[0]
+
+    def test_many(self, sets, background=None, alternative='greater', min_size=1, max_size=None):
+        '''
+        Test each query set (of entity frame IDs) for over-representation in each pathway,
+        returning a list of EnrichmentResult per set, most significant first
+
+        Only entities in the matrix (or background, if given) count, and only pathways
+        with min_size to max_size of those are tested. With alternative 'greater' pathways
+        without any of the query are not returned (p = 1), but do count as tests for the
+        q-values.
+        '''
+        if alternative not in ALTERNATIVES:
+            raise ValueError('Alternative must be one of %s' % ', '.join(ALTERNATIVES))
+        if background is not None:
+            return self.restrict(background).test_many(sets, alternative=alternative, min_size=min_size, max_size=max_size)
+
+        test = hypergeometric_sf if alternative == 'greater' else fisher_two_sided
+        N = len(self.entities)
+        sizes = self.sizes
+        tested = [c for c in range(len(self.pathways)) if sizes[c] >= min_size and (max_size is None or sizes[c] <= max_size)]
+        is_tested = set(tested)
+
+        p_cache = {} # (overlap, pathway size, query size): p
+        results = []
+        for ids in sets:
+            rows = set( self._rows[id] for id in ids if id in self._rows )
+            n = len(rows)
+
+            hits = defaultdict(list) # Column: member rows
+            for r in rows:
+                for c in self.indices[self.indptr[r]:self.indptr[r + 1]]:
+                    if c in is_tested:
+                        hits[c].append(r)
+
+            columns = tested if alternative == 'two-sided' else list(hits)
+            p_values = []
+            for c in columns:
+                key = (len(hits.get(c, ())), sizes[c], n)
+                if key not in p_cache:
+                    p_cache[key] = test(key[0], N, key[1], n)
+                p_values.append( p_cache[key] )
+
+            q_values = benjamini_hochberg(p_values, len(tested))
+            result = [
+                EnrichmentResult(self.pathways[c], len(hits.get(c, ())), sizes[c], n, N, p, q, sorted( self.entities[r] for r in hits.get(c, ()) ))
+                for c, p, q in zip(columns, p_values, q_values)
+            ]
+            result.sort(key=lambda r: (r.p_value, r.pathway))
+            results.append(result)
+
+        return results
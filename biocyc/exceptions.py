@@ -5,4 +5,10 @@ class BioCycInvalidExpiry(Exception):
     pass
     
 class BioCycInvalidDetailLevel(Exception):
-    pass
\ No newline at end of file
+    pass
+    
+class BioCycRequestError(Exception):
+    pass
+
+class BioCycOfflineError(BioCycRequestError):
+    pass
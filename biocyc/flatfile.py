@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Load Pathway Tools flat files into the cache, without the web service
+
+BioCyc distributes organism databases as attribute-value flat files (the data/
+folder of a flat-file download). load_flat_files streams those found in a folder
+and caches the same objects, with the same relationship ID fields, as getxml:
+
+    reactions.dat   Reaction            enzrxns.dat     EnzymaticReaction
+    pathways.dat    Pathway             proteins.dat    Protein
+    genes.dat       Gene                compounds.dat   Compound
+
+    python -m biocyc.flatfile ecoli/data ECOLI
+
+Records are read one at a time and cached in batches with BioCyc.bulk_cache, so
+memory use does not grow with the size of the files. The reactions each compound
+appears in are not listed in compounds.dat; they are collected from reactions.dat
+in a temporary SQLite file. Attributes without a getxml equivalent are skipped.
+
+"""
+import os
+import re
+import sqlite3
+import logging
+import argparse
+import tempfile
+
+from collections import OrderedDict
+
+from .biocyc import biocyc as default_biocyc, intern_id, intern_ids, to_plain_text, \
+    Compound, Pathway, Reaction, EnzymaticReaction, Protein, Gene
+
+# Kinds of field, see FIELDS
+TEXT = 'text' # First value, converted
+ID = 'id' # First value, a frame ID
+IDS = 'ids' # All values, frame IDs
+
+# Attributes of each object type to the fields they set, as (kind, attribute, converter).
+# Annotations are keyed ATTRIBUTE^ANNOTATION, e.g. the coefficient of a component
+COMMON_FIELDS = {
+    'TYPES': ((IDS, '_parents', None),),
+}
+
+FIELDS = {
+    Compound: {
+        'INCHI': ((TEXT, 'inchi', str),),
+        'MOLECULAR-WEIGHT': ((TEXT, 'molecular_weight', float),),
+        'GIBBS-0': ((TEXT, 'gibbs0', float),),
+        'APPEARS-IN-LEFT-SIDE-OF': ((IDS, 'reactions_in_left', None),),
+        'APPEARS-IN-RIGHT-SIDE-OF': ((IDS, 'reactions_in_right', None),),
+    },
+    Pathway: {
+        'TYPES': ((IDS, '_parents', None), (ID, '_parent', None)),
+        'REACTION-LIST': ((IDS, '_reactions', None),),
+        'SPECIES': ((IDS, '_species', None),),
+        'SUPER-PATHWAYS': ((IDS, '_super_pathways', None),),
+        'TAXONOMIC-RANGE': ((IDS, '_taxonomic_range', None),),
+    },
+    Reaction: {
+        'ENZYMATIC-REACTION': ((IDS, '_enzymatic_reactions', None),),
+        'IN-PATHWAY': ((IDS, '_pathways', None),),
+        'LEFT': ((IDS, '_compounds_left', None),),
+        'RIGHT': ((IDS, '_compounds_right', None),),
+        'REACTION-DIRECTION': ((TEXT, 'direction', str),),
+    },
+    EnzymaticReaction: {
+        'ENZYME': ((ID, '_enzyme', None),),
+        'REACTION': ((ID, '_reaction', None),),
+    },
+    Protein: {
+        'TYPES': ((IDS, '_parents', None), (ID, '_parent', None)),
+        'GENE': ((ID, '_gene', None),),
+        'COMPONENTS': ((IDS, '_components', None),),
+        'COMPONENTS^COEFFICIENT': ((TEXT, 'component_coefficient', int),),
+        'COMPONENT-OF': ((IDS, '_complexes', None),),
+        'CATALYZES': ((IDS, '_catalyzes', None),),
+    },
+    Gene: {
+        'PRODUCT': ((ID, '_protein', None),),
+    },
+}
+
+# In load order: compounds last, once the reactions they appear in are known
+FILES = [
+    ('reactions.dat', Reaction),
+    ('enzrxns.dat', EnzymaticReaction),
+    ('pathways.dat', Pathway),
+    ('proteins.dat', Protein),
+    ('genes.dat', Gene),
+    ('compounds.dat', Compound),
+]
+
+# Compound fields filled from reactions.dat, by the reaction field listing the compound
+COMPOUND_SIDES = {
+    '_compounds_left': 'reactions_in_left',
+    '_compounds_right': 'reactions_in_right',
+}
+
+dblink_re = re.compile(r'^\((\S+)\s+"([^"]*)"')
+
+
+def _decode(line):
+    # Older files are Latin-1, newer UTF-8
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        return line.decode('latin-1')
+
+
+def read_records(f):
+    '''
+    Iterate the records of an attribute-value file (opened in binary mode), each as a
+    list of (attribute, value)
+
+    Continuation lines (/...) are joined to the value before them, and annotations
+    (^NAME - value) follow the value they annotate as (ATTRIBUTE^NAME, value)
+    '''
+    record = []
+    attribute = None
+    for line in f:
+        line = _decode(line).rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+
+        if line == '//':
+            if record:
+                yield record
+            record = []
+            attribute = None
+
+        elif line.startswith('/'):
+            if record:
+                name, value = record[-1]
+                record[-1] = (name, value + '\n' + line[1:])
+
+        else:
+            name, sep, value = line.partition(' - ')
+            if not sep:
+                name, value = (line[:-2] if line.endswith(' -') else line), ''
+
+            if name.startswith('^'):
+                name = '%s%s' % (attribute, name)
+            else:
+                attribute = name
+            record.append( (name, value) )
+
+    if record:
+        yield record
+
+
+def _frame_id(value):
+    # Frame IDs with unusual characters are written |quoted|
+    if len(value) > 1 and value[0] == value[-1] == '|':
+        value = value[1:-1]
+    return intern_id(value)
+
+
+def create_obj(cls, record, org_id, related=None, biocyc=None):
+    '''
+    Create an object of type cls from a record, or return None if it has no UNIQUE-ID
+
+    related, if given, is called with the frame ID for a dict of ID list fields to use
+    where the record has none, e.g. the reactions a compound appears in. biocyc is the
+    instance the object's relationships are resolved through (default the global one)
+    '''
+    ids = [value for name, value in record if name == 'UNIQUE-ID']
+    if not ids:
+        return None
+
+    obj = cls(id=_frame_id(ids[0]), biocyc=biocyc)
+    obj.org_id = org_id
+
+    fields = dict(COMMON_FIELDS)
+    fields.update( FIELDS.get(cls, {}) )
+    lists = OrderedDict()
+    found = set()
+    for name, value in record:
+        if name == 'COMMON-NAME':
+            if obj.name_as_html is None:
+                obj.name_as_html = value
+                obj.name = to_plain_text(value)
+
+        elif name == 'SYNONYMS':
+            obj.synonyms.append(value)
+
+        elif name == 'DBLINKS':
+            #(LIGAND-CPD "C00186" NIL |kaipa| 3352919089 NIL NIL)
+            m = dblink_re.match(value)
+            if m:
+                obj.dblinks[ m.group(1) ] = m.group(2)
+
+        for kind, var, converter in fields.get(name, ()):
+            if kind == IDS:
+                lists.setdefault(var, []).append( _frame_id(value) )
+
+            elif var not in found: # First value only
+                if kind == TEXT:
+                    try:
+                        value = converter(value)
+                    except ValueError: # Fail gracefully, skip
+                        continue
+                else:
+                    value = _frame_id(value)
+                setattr(obj, var, value)
+                found.add(var)
+
+    for var, values in (related(obj.id) if related else {}).items():
+        if var not in lists:
+            lists[var] = values
+
+    for var, values in lists.items():
+        setattr(obj, var, intern_ids(values))
+
+    if obj.name is None and obj.synonyms:
+        obj.name_as_html = obj.synonyms[-1] # Apply last synonym if common name not defined
+        obj.name = to_plain_text(obj.name_as_html)
+
+    return obj
+
+
+class _CompoundSides(object):
+    '''
+    The reactions each compound appears in, collected from reactions.dat in a temporary SQLite file
+    '''
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='biocyc-', suffix='.sqlite')
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE sides (compound TEXT NOT NULL, field TEXT NOT NULL, reaction TEXT NOT NULL)')
+        self.indexed = False
+
+    def add(self, reaction):
+        self.db.executemany('INSERT INTO sides (compound, field, reaction) VALUES (?, ?, ?)', [
+            (compound, field, reaction.id) for attr, field in COMPOUND_SIDES.items() for compound in getattr(reaction, attr)
+        ])
+
+    def get(self, compound):
+        if not self.indexed:
+            self.db.execute('CREATE INDEX sides_compound ON sides (compound)')
+            self.indexed = True
+
+        related = dict( (field, []) for field in COMPOUND_SIDES.values() )
+        for field, reaction in self.db.execute('SELECT field, reaction FROM sides WHERE compound=? ORDER BY rowid', (compound,)):
+            related[field].append(reaction)
+        return related
+
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
+
+
+def load_flat_files(path, org_id, biocyc=None, batch_size=1000):
+    '''
+    Cache the objects in the flat files (see FILES) found in the folder path as org_id,
+    returning a dict of file name: number of objects cached
+    '''
+    biocyc = biocyc or default_biocyc
+    org_id = org_id.upper()
+    counts = OrderedDict()
+    sides = _CompoundSides()
+
+    try:
+        for filename, cls in FILES:
+            file_path = os.path.join(path, filename)
+            if not os.path.exists(file_path):
+                continue
+
+            count = 0
+            batch = []
+            with open(file_path, 'rb') as f:
+                for record in read_records(f):
+                    obj = create_obj(cls, record, org_id, sides.get if cls is Compound else None, biocyc=biocyc)
+                    if obj is None:
+                        continue
+                    if cls is Reaction:
+                        sides.add(obj)
+
+                    batch.append(obj)
+                    if len(batch) >= batch_size:
+                        biocyc.bulk_cache(batch)
+                        count += len(batch)
+                        batch = []
+
+            if batch:
+                biocyc.bulk_cache(batch)
+            counts[filename] = count + len(batch)
+            logging.info('%s: %d objects cached from %s' % (org_id, counts[filename], filename))
+
+    finally:
+        sides.close()
+
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load Pathway Tools flat files into the local cache')
+    parser.add_argument('path', help='folder holding the .dat files')
+    parser.add_argument('org_id', help='organism database identifier, e.g. ECOLI')
+    parser.add_argument('--cache-path', help='cache folder (default ~/.biocyc)')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    biocyc = default_biocyc
+    if args.cache_path:
+        biocyc.cache_path = args.cache_path
+
+    counts = load_flat_files(args.path, args.org_id, biocyc=biocyc, batch_size=args.batch_size)
+    print('%d objects cached' % sum(counts.values()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-process locking for a shared cache folder
+
+file_lock serialises writers of index files with an advisory lock (fcntl.flock,
+where available). Claims give single-flight fetching: a process creates the claim
+file for an ID before requesting it, and other processes wait for the object to
+appear in the cache instead of requesting it too. Claims older than their timeout
+are assumed to belong to a process that died and are broken.
+
+"""
+import os
+import time
+import errno
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows, advisory locking unavailable
+    fcntl = None
+
+from .stores import mkdir_p
+
+
+@contextmanager
+def file_lock(path):
+    '''
+    Hold an exclusive advisory lock on path (created if needed) for the duration of the block
+    '''
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def claim(path, timeout):
+    '''
+    Try to claim path, returning True if it is ours. Claims older than timeout seconds are broken
+    '''
+    for attempt in range(3):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                mkdir_p(os.path.dirname(path))
+                continue
+            if e.errno != errno.EEXIST:
+                raise
+
+            try:
+                if time.time() - os.path.getmtime(path) > timeout:
+                    release(path) # Stale, retry
+                    continue
+            except OSError:
+                continue # Released meanwhile, retry
+            return False
+
+        else:
+            os.write(fd, str(os.getpid()).encode('ascii'))
+            os.close(fd)
+            return True
+
+    return False
+
+
+def release(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation for cache tiers, network requests and XML parsing
+
+Each BioCyc instance has a Metrics object (biocyc.metrics) that reports counters
+and timings to any number of hooks, and to statistics collectors:
+
+    def hook(name, value, kind): # kind is 'count' or 'timing' (seconds)
+        statsd.incr(name, value) if kind == 'count' else statsd.timing(name, value * 1000)
+
+    biocyc.metrics.add_hook(hook)
+
+    with biocyc.metrics.collect() as stats:
+        biocyc.get(['PWY-6713', 'PWY-5481'])
+    print(stats.report())
+
+While there are no hooks or collectors recording costs one attribute check. Batched
+steps are timed per batch with a separate object count, so the time per object is
+the total time divided by the count.
+
+Metrics recorded:
+
+    cache.memory.hit, cache.memory.miss     count
+    cache.<store>.read                      timing, batched store read including unpickling
+    cache.<store>.hit                       count
+    cache.expired                           count
+    cache.write                             timing, per batch of objects from one response
+    cache.write.objects                     count, objects written
+    cache.flush                             timing, per write-behind flush
+    cache.flush.objects                     count, objects flushed
+    ratelimit.wait                          timing, time spent waiting for the rate limit
+    http.request                            timing, per request (attempt)
+    http.bytes                              count, response bytes
+    http.retry                              count
+    xml.parse                               timing, per response
+    xml.import                              timing, per batch of objects created from one response
+    xml.import.objects                      count, objects created from XML
+
+"""
+import bisect
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the timing histogram buckets, the last bucket is unbounded
+TIMING_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+
+class Histogram(object):
+    '''
+    Count, total, min, max and bucketed distribution of a timing
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(TIMING_BUCKETS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[bisect.bisect_left(TIMING_BUCKETS, value)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        '''
+        Return the upper bound of the bucket holding the p-th percentile (max for the last bucket)
+        '''
+        rank = p / 100.0 * self.count
+        seen = 0
+        for n, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return TIMING_BUCKETS[n] if n < len(TIMING_BUCKETS) else self.max
+        return 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class Stats(object):
+    '''
+    Counters and timing histograms collected by Metrics.collect
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, value, kind):
+        with self._lock:
+            if kind == 'count':
+                self.counters[name] = self.counters.get(name, 0) + value
+            else:
+                if name not in self.timings:
+                    self.timings[name] = Histogram()
+                self.timings[name].add(value)
+
+    def as_dict(self):
+        return {
+            'counters': dict(self.counters),
+            'timings': dict( (name, h.as_dict()) for name, h in self.timings.items() ),
+        }
+
+    def report(self):
+        '''
+        Return a plain text summary, one line per metric
+        '''
+        lines = ['%-28s %12d' % (name, value) for name, value in sorted(self.counters.items())]
+        for name, h in sorted(self.timings.items()):
+            lines.append('%-28s %12d  total %.4fs  mean %.6fs  max %.6fs  p99 <= %.6fs' % (
+                name, h.count, h.total, h.mean, h.max, h.percentile(99)))
+        return '\n'.join(lines)
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.timing(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    '''
+    Dispatches counters and timings to hooks and active collectors
+
+    Hooks are called synchronously, from whichever (worker) thread recorded the
+    metric, with (name, value, kind), so should be quick and thread-safe.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._hooks = ()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        with self._lock:
+            self._hooks = self._hooks + (hook,)
+            self.enabled = True
+
+    def remove_hook(self, hook):
+        with self._lock:
+            hooks = list(self._hooks)
+            hooks.remove(hook)
+            self._hooks = tuple(hooks)
+            self.enabled = bool(hooks)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            for hook in self._hooks:
+                hook(name, value, 'count')
+
+    def timing(self, name, seconds):
+        if self.enabled:
+            for hook in self._hooks:
+                hook(name, seconds, 'timing')
+
+    def timer(self, name):
+        '''
+        Context manager recording the time spent in the block as a timing
+        '''
+        return _Timer(self, name) if self.enabled else NULL_TIMER
+
+    @contextmanager
+    def collect(self):
+        '''
+        Collect the metrics recorded (by all threads) during the block into a Stats object
+        '''
+        stats = Stats()
+        self.add_hook(stats)
+        try:
+            yield stats
+        finally:
+            self.remove_hook(stats)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent name/synonym index
+
+Names are stored against object identifiers only, so lookups never need to load
+the objects themselves. Names are normalised (unicode NFKC, case-folded, whitespace
+collapsed) for matching, with exact, prefix and bounded edit-distance queries
+across any or all object tables of an organism.
+
+For edit-distance queries each distinct normalised name is also indexed by its
+trigrams. A name within d edits of the query shares all but at most 3d of the
+query's distinct trigrams, so candidates are found by counting shared trigrams in
+SQL, and the edit distance is computed for those candidates only. Trigrams are
+indexed in batches by the first fuzzy query after names are added, keeping adds cheap.
+
+"""
+import unicodedata
+
+from collections import namedtuple, defaultdict
+
+from .stores import SQLiteDatabase
+
+NameMatch = namedtuple('NameMatch', ['table', 'id', 'name', 'distance'])
+
+# Order in which tables are searched for the best match
+NAME_TABLES = ['pathways', 'genes', 'reactions', 'compounds', 'proteins']
+
+PREFIX_END = '\U0010ffff' # Sorts after any other character
+
+GRAM_SIZE = 3
+GRAM_PAD = '\x01' * (GRAM_SIZE - 1) # Marks the start and end of a name in its grams
+
+SCHEMA_VERSION = 1 # 1 adds the norms and grams tables
+
+
+def normalize_name(name):
+    return ' '.join(unicodedata.normalize('NFKC', name).casefold().split())
+
+
+def name_grams(norm):
+    '''
+    Return the set of trigrams of a normalised name, including those at its padded ends
+    '''
+    padded = GRAM_PAD + norm + GRAM_PAD
+    return set( padded[i:i + GRAM_SIZE] for i in range(len(padded) - GRAM_SIZE + 1) )
+
+
+def bounded_distance(a, b, max_distance):
+    '''
+    Levenshtein distance between a and b, or None if it is greater than max_distance
+    '''
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+
+        if min(current) > max_distance: # No way back under the bound
+            return None
+        previous = current
+
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+class NameIndex(SQLiteDatabase):
+    '''
+    Name index for all organisms in a single SQLite database
+    '''
+    max_candidates = 1000 # Most names checked by edit distance per fuzzy query, by trigrams shared
+    max_variables = 500 # Per IN (...) query
+
+    def __init__(self, path):
+        super(NameIndex, self).__init__(path)
+        db = self.db
+        db.execute('CREATE TABLE IF NOT EXISTS names (org_id TEXT NOT NULL, norm TEXT NOT NULL, tbl TEXT NOT NULL, id TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (org_id, norm, tbl, id)) WITHOUT ROWID')
+        db.execute('CREATE INDEX IF NOT EXISTS names_size ON names (org_id, size)')
+        db.execute('CREATE TABLE IF NOT EXISTS imported (org_id TEXT PRIMARY KEY)')
+        # Distinct normalised names, and the trigrams of those indexed so far, see fuzzy
+        db.execute('CREATE TABLE IF NOT EXISTS norms (norm_id INTEGER PRIMARY KEY, org_id TEXT NOT NULL, norm TEXT NOT NULL, indexed INTEGER NOT NULL DEFAULT 0, UNIQUE (org_id, norm))')
+        db.execute('CREATE INDEX IF NOT EXISTS norms_pending ON norms (org_id) WHERE indexed=0')
+        db.execute('CREATE TABLE IF NOT EXISTS grams (org_id TEXT NOT NULL, gram TEXT NOT NULL, size INTEGER NOT NULL, norm_id INTEGER NOT NULL, PRIMARY KEY (org_id, gram, size, norm_id)) WITHOUT ROWID')
+        db.commit()
+
+        if db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            with db: # Names added by earlier versions
+                db.execute('INSERT OR IGNORE INTO norms (org_id, norm) SELECT DISTINCT org_id, norm FROM names')
+                db.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+    def add(self, org_id, table, id, names):
+        self.add_many(org_id, [(table, id, name) for name in names])
+
+    def add_many(self, org_id, rows):
+        '''
+        Add (table, id, name) rows for org_id
+        '''
+        rows = [(org_id, norm, table, id, name, len(norm)) for table, id, name, norm in
+                ((table, id, name, normalize_name(name)) for table, id, name in rows) if norm]
+
+        with self.db as db:
+            db.executemany('INSERT OR IGNORE INTO names (org_id, norm, tbl, id, name, size) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            db.executemany('INSERT OR IGNORE INTO norms (org_id, norm) VALUES (?, ?)', set( (org_id, row[1]) for row in rows ))
+
+    def _index_grams(self, org_id):
+        '''
+        Index the trigrams of the names of org_id added since the last fuzzy query
+        '''
+        db = self.db
+        pending = db.execute('SELECT norm_id, norm FROM norms WHERE org_id=? AND indexed=0 ORDER BY norm_id', (org_id,)).fetchall()
+        if not pending:
+            return
+
+        postings = defaultdict(list) # (gram, size): norm_ids, inserted in key order as that is much faster
+        for norm_id, norm in pending:
+            for gram in name_grams(norm):
+                postings[gram, len(norm)].append(norm_id)
+
+        with db:
+            db.executemany('INSERT OR IGNORE INTO grams (org_id, gram, size, norm_id) VALUES (?, ?, ?, ?)', (
+                (org_id, gram, size, norm_id) for gram, size in sorted(postings) for norm_id in postings[gram, size]
+            ))
+            # Names added since are numbered after these, and left for the next query
+            db.execute('UPDATE norms SET indexed=1 WHERE org_id=? AND indexed=0 AND norm_id<=?', (org_id, pending[-1][0]))
+
+    def is_imported(self, org_id):
+        return self.db.execute('SELECT 1 FROM imported WHERE org_id=?', (org_id,)).fetchone() is not None
+
+    def set_imported(self, org_id):
+        with self.db as db:
+            db.execute('INSERT OR IGNORE INTO imported (org_id) VALUES (?)', (org_id,))
+
+    def _query(self, sql, params, tables):
+        if tables is not None:
+            sql += ' AND tbl IN (%s)' % ','.join('?' * len(tables))
+            params = list(params) + list(tables)
+        return self.db.execute(sql, params).fetchall()
+
+    def _ordered(self, matches, limit):
+        matches.sort(key=lambda m: (m.distance, NAME_TABLES.index(m.table) if m.table in NAME_TABLES else len(NAME_TABLES), m.name, m.id))
+        return matches[:limit] if limit else matches
+
+    def exact(self, org_id, name, tables=None, limit=None):
+        rows = self._query('SELECT tbl, id, name FROM names WHERE org_id=? AND norm=?', (org_id, normalize_name(name)), tables)
+        return self._ordered([NameMatch(t, i, n, 0) for t, i, n in rows], limit)
+
+    def prefix(self, org_id, prefix, tables=None, limit=20):
+        norm = normalize_name(prefix)
+        rows = self._query('SELECT tbl, id, name, size FROM names WHERE org_id=? AND norm>=? AND norm<?', (org_id, norm, norm + PREFIX_END), tables)
+        # Distance is the number of characters completed, so shorter completions come first
+        return self._ordered([NameMatch(t, i, n, s - len(norm)) for t, i, n, s in rows], limit)
+
+    def fuzzy(self, org_id, name, max_distance=2, tables=None, limit=20):
+        '''
+        Names within max_distance edits of name. Candidates are the names (within the length
+        bounds) sharing enough of its trigrams, at most max_candidates sharing the most. Short
+        names, where any name could be close enough without sharing a trigram, are all checked
+        '''
+        self._index_grams(org_id)
+        norm = normalize_name(name)
+        grams = sorted(name_grams(norm))
+        shared = len(grams) - GRAM_SIZE * max_distance # At least, by any name close enough
+        sizes = (len(norm) - max_distance, len(norm) + max_distance)
+
+        if shared <= 0:
+            rows = self._query('SELECT tbl, id, name, norm FROM names WHERE org_id=? AND size BETWEEN ? AND ?', (org_id,) + sizes, tables)
+        else:
+            candidates = self.db.execute(
+                'SELECT norm_id FROM grams WHERE org_id=? AND gram IN (%s) AND size BETWEEN ? AND ? GROUP BY norm_id HAVING COUNT(*) >= ? ORDER BY COUNT(*) DESC LIMIT ?' % ','.join('?' * len(grams)),
+                [org_id] + grams + list(sizes) + [shared, self.max_candidates]).fetchall()
+
+            rows = []
+            for n in range(0, len(candidates), self.max_variables):
+                batch = [norm_id for norm_id, in candidates[n:n + self.max_variables]]
+                rows.extend( self._query('SELECT tbl, id, name, names.norm FROM norms JOIN names ON names.org_id=norms.org_id AND names.norm=norms.norm WHERE norm_id IN (%s)' % ','.join('?' * len(batch)), batch, tables) )
+
+        matches = []
+        for t, i, n, candidate in rows:
+            d = bounded_distance(norm, candidate, max_distance)
+            if d is not None:
+                matches.append(NameMatch(t, i, n, d))
+        return self._ordered(matches, limit)
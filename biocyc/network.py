@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed metabolic network index
+
+Relationships between compounds, reactions, pathways, enzymatic reactions, proteins
+and genes are stored as integer-ID adjacency arrays in compressed sparse row (CSR)
+form, in both directions, so neighbour queries need no objects to be loaded.
+
+Files are kept under <cache_path>/<org_id>/network/:
+
+    nodes               frame IDs, one per line, line number is the integer ID
+    <relation>.indptr   int32 row offsets (forward, source -> targets)
+    <relation>.indices  int32 targets
+    <relation>.rindptr, <relation>.rindices  the same for the reverse direction
+    journal             edges added since the arrays were last written
+
+The arrays are memory-mapped read-only and exposed as memoryviews; with NumPy they
+can be wrapped without copying using numpy.frombuffer(view, dtype='int32').
+
+Several processes can share the files: edges are appended to the journal under a
+file lock, refresh() reloads an index when the files have changed on disk, and
+save() compacts the journal into the arrays.
+
+"""
+import os
+import csv
+import mmap
+
+from array import array
+from collections import defaultdict
+
+from .locking import file_lock
+from .stores import mkdir_p
+
+# Relation name: (source type, target type)
+RELATIONS = {
+    'reaction-compound-left': ('reaction', 'compound'),
+    'reaction-compound-right': ('reaction', 'compound'),
+    'reaction-pathway': ('reaction', 'pathway'),
+    'reaction-enzrxn': ('reaction', 'enzymaticreaction'),
+    'enzrxn-protein': ('enzymaticreaction', 'protein'),
+    'protein-gene': ('protein', 'gene'),
+    'protein-complex': ('protein', 'protein'), # Subunit -> complex
+    'pathway-super': ('pathway', 'pathway'), # Sub-pathway -> super-pathway
+    'pathway-subclass': ('pathway', 'pathway'), # Class -> subclass
+}
+
+# Object type: [(relation, attribute, reverse)] edges contributed by each object. The
+# same edge is often recorded on both objects, e.g. Reaction._pathways and Pathway._reactions
+EDGE_ATTRIBUTES = {
+    'reaction': [
+        ('reaction-compound-left', '_compounds_left', False),
+        ('reaction-compound-right', '_compounds_right', False),
+        ('reaction-pathway', '_pathways', False),
+        ('reaction-enzrxn', '_enzymatic_reactions', False),
+    ],
+    'compound': [
+        ('reaction-compound-left', 'reactions_in_left', True),
+        ('reaction-compound-right', 'reactions_in_right', True),
+    ],
+    'pathway': [
+        ('reaction-pathway', '_reactions', True),
+        ('pathway-super', '_super_pathways', False),
+        ('pathway-subclass', '_subclasses', False),
+    ],
+    'enzymaticreaction': [
+        ('reaction-enzrxn', '_reaction', True),
+        ('enzrxn-protein', '_enzyme', False),
+    ],
+    'protein': [
+        ('enzrxn-protein', '_catalyzes', True),
+        ('protein-gene', '_gene', False),
+        ('protein-complex', '_complexes', False),
+        ('protein-complex', '_components', True),
+    ],
+    'gene': [
+        ('protein-gene', '_protein', True),
+    ],
+}
+
+INDEX_TABLES = ['pathways', 'reactions', 'compounds', 'enzymaticreactions', 'proteins', 'genes']
+
+
+def object_edges(obj):
+    '''
+    Return the (relation, source frame ID, target frame ID) edges recorded on obj
+    '''
+    edges = []
+    for relation, attr, reverse in EDGE_ATTRIBUTES.get(obj.type, []):
+        value = getattr(obj, attr, None)
+        for id in (value if isinstance(value, (list, tuple)) else [value]):
+            if id:
+                edges.append( (relation, id, obj.id) if reverse else (relation, obj.id, id) )
+    return edges
+
+
+def read_array(path):
+    '''
+    Memory-map an int32 array file read-only, returning a memoryview (or an empty array)
+    '''
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return array('i')
+            return memoryview( mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) ).cast('i')
+    except IOError:
+        return array('i')
+
+
+def write_array(path, a):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        a.tofile(f)
+    os.replace(tmp, path)
+
+
+def merge_rows(indptr, indices, delta, n_nodes):
+    '''
+    Return new (indptr, indices) arrays for n_nodes rows, adding the targets in delta
+    ({source: set(targets)}) to the existing rows. Unchanged runs of rows are copied whole
+    '''
+    n_old = max(len(indptr) - 1, 0)
+    new_indptr, new_indices = array('i', [0]), array('i')
+    start = 0 # First row not yet copied
+    for s in sorted(delta) + [n_nodes]:
+        end = min(s, n_old)
+        if start < end:
+            shift = len(new_indices) - indptr[start]
+            new_indices.frombytes( indices[indptr[start]:indptr[end]].tobytes() )
+            new_indptr.extend( n + shift for n in indptr[start + 1:end + 1] )
+        new_indptr.extend( [len(new_indices)] * (s - max(start, end)) ) # Rows without edges
+        if s == n_nodes:
+            break
+
+        targets = set( indices[indptr[s]:indptr[s + 1]] ) if s < n_old else set()
+        targets.update( delta[s] )
+        new_indices.extend( sorted(targets) )
+        new_indptr.append( len(new_indices) )
+        start = s + 1
+    return new_indptr, new_indices
+
+
+class NetworkIndex(object):
+    '''
+    Adjacency index for one organism
+
+    Edges added with add() are held in memory and journalled to disk until save()
+    merges them into the arrays. Queries combine both, so the index is current with
+    this process' changes, and with those of other processes after refresh().
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+        self.version = 0 # Incremented on every change, e.g. to invalidate anything derived from the index
+        self._disk_state = None # Files as last loaded or written by this index, see refresh
+
+        self._nodes = []
+        self._node_ids = {}
+        self._arrays = {}
+        self._delta = {} # (relation, reverse): {source: set(targets)} not yet in the arrays
+
+        self.load()
+
+    def _stat(self):
+        state = []
+        for name in ['nodes', 'journal']:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+                state.append( (st.st_ino, st.st_size, st.st_mtime_ns) )
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    @property
+    def state(self):
+        '''
+        The in-memory version and the files on disk, changed by any change to the index
+        '''
+        return (self.version, self._stat())
+
+    def refresh(self):
+        '''
+        Reload the index if another process has changed the files since it was loaded,
+        returning True if it was reloaded
+        '''
+        if self._stat() == self._disk_state:
+            return False
+        self.load()
+        return True
+
+    def load(self):
+        self.version += 1
+        self._disk_state = self._stat() # Before reading, so changes made meanwhile are picked up again
+        self._nodes = []
+        try:
+            with open(os.path.join(self.path, 'nodes'), 'r') as f:
+                self._nodes = [l.rstrip('\n') for l in f]
+        except IOError:
+            pass
+        self._node_ids = dict( (id, n) for n, id in enumerate(self._nodes) )
+
+        self._arrays = {}
+        for relation in RELATIONS:
+            for prefix in ['', 'r']:
+                self._arrays[relation, bool(prefix)] = (
+                    read_array(os.path.join(self.path, '%s.%sindptr' % (relation, prefix))),
+                    read_array(os.path.join(self.path, '%s.%sindices' % (relation, prefix))),
+                )
+
+        # Replay edges added since the last save
+        self._delta = dict( (key, defaultdict(set)) for key in self._arrays )
+        self.pending = 0
+        try:
+            with open(os.path.join(self.path, 'journal'), 'r', newline='') as f:
+                self._add_edges( [tuple(row) for row in csv.reader(f) if len(row) == 3], journal=False )
+        except IOError:
+            pass
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, id):
+        return id in self._node_ids
+
+    def node_id(self, id, create=False):
+        if id not in self._node_ids:
+            if not create:
+                return None
+            self._node_ids[id] = len(self._nodes)
+            self._nodes.append(id)
+        return self._node_ids[id]
+
+    def frame_id(self, n):
+        return self._nodes[n]
+
+    def add(self, obj):
+        '''
+        Add the edges recorded on obj (e.g. when it is cached)
+        '''
+        self._add_edges( object_edges(obj) )
+
+    def add_many(self, objs):
+        '''
+        Add the edges recorded on objs, journalled with a single write
+        '''
+        self._add_edges( [edge for obj in objs for edge in object_edges(obj)] )
+
+    def _add_edges(self, edges, journal=True):
+        new = []
+        for relation, source, target in edges:
+            if relation not in RELATIONS:
+                continue
+            s, t = self.node_id(source, create=True), self.node_id(target, create=True)
+            if t in self._neighbors(s, relation, False):
+                continue
+            self._delta[relation, False][s].add(t)
+            self._delta[relation, True][t].add(s)
+            new.append( (relation, source, target) )
+
+        if new:
+            self.version += 1
+
+        if new and journal:
+            mkdir_p(self.path)
+            with file_lock(os.path.join(self.path, '.lock')):
+                current = self._stat() == self._disk_state
+                with open(os.path.join(self.path, 'journal'), 'a', newline='') as f:
+                    csv.writer(f).writerows(new)
+                if current: # Else leave other processes' changes for refresh
+                    self._disk_state = self._stat()
+        self.pending += len(new)
+
+    def _neighbors(self, n, relation, reverse):
+        indptr, indices = self._arrays[relation, reverse]
+        result = set()
+        if n + 1 < len(indptr):
+            result.update( indices[indptr[n]:indptr[n + 1]] )
+        result.update( self._delta[relation, reverse].get(n, ()) )
+        return result
+
+    def neighbors(self, id, relation, reverse=False):
+        '''
+        Return the frame IDs related to id by relation, from source to target
+        (or target to source with reverse=True), e.g.
+
+            neighbors('RXN-1', 'reaction-pathway')                  pathways of a reaction
+            neighbors('PWY-1', 'reaction-pathway', reverse=True)    reactions of a pathway
+        '''
+        n = self.node_id(id)
+        if n is None:
+            return []
+        return sorted( self._nodes[t] for t in self._neighbors(n, relation, reverse) )
+
+    def arrays(self, relation, reverse=False):
+        '''
+        Return the (indptr, indices) arrays for relation as last saved (see save)
+        '''
+        return self._arrays[relation, reverse]
+
+    def _expand(self, ids, steps):
+        for relation, reverse in steps:
+            ids = set( t for id in ids for t in self.neighbors(id, relation, reverse) )
+        return ids
+
+    def compound_reactions(self, id):
+        return sorted( self._expand([id], [('reaction-compound-left', True)]) | self._expand([id], [('reaction-compound-right', True)]) )
+
+    def compound_pathways(self, id):
+        return sorted( self._expand(self.compound_reactions(id), [('reaction-pathway', False)]) )
+
+    def pathway_compounds(self, id):
+        reactions = self._expand([id], [('reaction-pathway', True)])
+        return sorted( self._expand(reactions, [('reaction-compound-left', False)]) | self._expand(reactions, [('reaction-compound-right', False)]) )
+
+    def protein_reactions(self, id):
+        return sorted( self._expand([id], [('enzrxn-protein', True), ('reaction-enzrxn', True)]) )
+
+    def protein_pathways(self, id):
+        # Including the pathways of any complexes the protein is a subunit of
+        proteins = set([id]) | self._expand([id], [('protein-complex', False)])
+        return sorted( self._expand(proteins, [('enzrxn-protein', True), ('reaction-enzrxn', True), ('reaction-pathway', False)]) )
+
+    def gene_pathways(self, id):
+        return sorted( set( p for protein in self.neighbors(id, 'protein-gene', reverse=True) for p in self.protein_pathways(protein) ) )
+
+    def super_pathways(self, id):
+        return self.neighbors(id, 'pathway-super')
+
+    def sub_pathways(self, id):
+        return self.neighbors(id, 'pathway-super', reverse=True)
+
+    def save(self):
+        '''
+        Merge the pending edges into the arrays and write them, then clear the journal
+
+        The arrays, nodes and journal are reloaded from disk first, so edges saved or
+        journalled by other processes since this index was loaded are kept.
+        '''
+        mkdir_p(self.path)
+        with file_lock(os.path.join(self.path, '.lock')):
+            self._save()
+
+    def _save(self):
+        # Pending edges by frame ID, as node numbers differ from those on disk
+        edges = [
+            (relation, self._nodes[s], self._nodes[t])
+            for (relation, reverse), delta in self._delta.items() if not reverse
+            for s, targets in delta.items() for t in targets
+        ]
+        self.load() # Current arrays and journal on disk
+        self._add_edges(edges, journal=False)
+
+        n_nodes = len(self._nodes)
+
+        for relation in RELATIONS:
+            for reverse in [False, True]:
+                indptr, indices = self._arrays[relation, reverse]
+                delta = self._delta[relation, reverse]
+
+                new_indptr, new_indices = merge_rows(indptr, indices, delta, n_nodes)
+
+                prefix = 'r' if reverse else ''
+                write_array(os.path.join(self.path, '%s.%sindptr' % (relation, prefix)), new_indptr)
+                write_array(os.path.join(self.path, '%s.%sindices' % (relation, prefix)), new_indices)
+
+        tmp = os.path.join(self.path, 'nodes.tmp')
+        with open(tmp, 'w') as f:
+            f.writelines( '%s\n' % id for id in self._nodes )
+        os.replace(tmp, os.path.join(self.path, 'nodes'))
+
+        # Now safely in the arrays
+        with open(os.path.join(self.path, 'journal'), 'w'):
+            pass
+
+        self.load()
+
+    @classmethod
+    def build(cls, biocyc, org_id, batch_size=1000):
+        '''
+        (Re)build the index for org_id from all known objects in the cache, without network requests
+        '''
+        path = os.path.join(biocyc.cache_path, org_id, 'network')
+        for f in os.listdir(path) if os.path.isdir(path) else []:
+            os.remove(os.path.join(path, f))
+
+        index = cls(path)
+        for table in INDEX_TABLES:
+            ids = list( biocyc._get_local_index(org_id, table) )
+            for n in range(0, len(ids), batch_size):
+                objs = biocyc.get_many_from_cache(org_id, ids[n:n + batch_size])
+                edges = [e for obj in objs.values() for e in object_edges(obj)]
+                index._add_edges(edges, journal=False)
+
+        index.save()
+        return index
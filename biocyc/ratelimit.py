@@ -0,0 +1,42 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket rate limiter
+
+    Tokens are added at rate per second up to a maximum of burst. Each request
+    takes a single token, when none are available the token is borrowed against
+    the future and the caller waits until it is due. A single bucket can be shared
+    by any number of threads to keep them within the same overall budget.
+    '''
+    def __init__(self, rate=1.0, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        '''
+        Take a token and return the number of seconds to wait before it may be used
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        '''
+        Take a token, blocking until it is available. Returns the time spent waiting
+        '''
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
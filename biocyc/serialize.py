@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned record format for cached objects
+
+A record holds an object's type name and its attribute values, by attribute name,
+rather than a pickle of the class. Records stay readable when classes change
+(renamed attributes are converted, unknown ones skipped, as for old pickles), can
+be decoded without executing code, and can be read from other languages.
+
+    header    magic b'BCR', format version, codec (0 none, 1 zlib, 2 zstd)
+    payload   UTF-8 JSON: [type name, {attribute: value}], compressed by the codec
+
+zstd compression needs the zstandard package. Data without the header is assumed
+to be a pickle written by earlier versions, and is unpickled unless allow_pickle
+is False (for caches shared with others).
+
+Convert an existing cache folder or SQLite cache file in place with:
+
+    python -m biocyc.serialize ~/.biocyc --compression zlib
+
+"""
+import json
+import pickle
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'BCR'
+FORMAT_VERSION = 1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {None: CODEC_NONE, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+# Cacheable classes by name, see register
+TYPES = {}
+
+
+def register(*classes):
+    for cls in classes:
+        TYPES[cls.__name__] = cls
+
+
+def is_record(data):
+    return data[:3] == MAGIC
+
+
+def dumps(obj, compression=None):
+    '''
+    Encode obj as a record, optionally compressed with 'zlib' or 'zstd'
+    '''
+    if compression not in CODECS:
+        raise ValueError('Unknown compression %r, use one of zlib, zstd or None' % compression)
+
+    payload = json.dumps([type(obj).__name__, obj.__getstate__()], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    codec = CODECS[compression]
+    if codec == CODEC_ZLIB:
+        payload = zlib.compress(payload)
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        payload = zstandard.ZstdCompressor().compress(payload)
+
+    return MAGIC + bytes((FORMAT_VERSION, codec)) + payload
+
+
+def loads(data, allow_pickle=True):
+    '''
+    Decode a record (or with allow_pickle, a legacy pickle) from bytes or a memoryview
+    '''
+    return loads_sized(data, allow_pickle)[0]
+
+
+def loads_sized(data, allow_pickle=True):
+    '''
+    Decode as loads, returning (obj, size) where size is the length of the uncompressed
+    record (or pickle), e.g. to size the object in the memory cache without encoding it
+    '''
+    if not is_record(data):
+        if not allow_pickle:
+            raise ValueError('Not a record, and unpickling is not allowed')
+        return pickle.loads(data), len(data)
+
+    version, codec = data[3], data[4]
+    if version > FORMAT_VERSION:
+        raise ValueError('Record format version %d is newer than this version of biocyc supports' % version)
+
+    payload = data[5:]
+    if codec == CODEC_ZLIB:
+        payload = zlib.decompress(payload)
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError('Record is zstd compressed, which needs the zstandard package')
+        payload = zstandard.ZstdDecompressor().decompress(bytes(payload))
+    elif codec != CODEC_NONE:
+        raise ValueError('Unknown record codec %d' % codec)
+
+    name, state = json.loads(bytes(payload))
+    cls = TYPES.get(name)
+    if cls is None:
+        raise ValueError('Unknown record type %s' % name)
+
+    obj = cls.__new__(cls)
+    obj.__setstate__(state)
+    return obj, len(payload)
+
+
+def convert(path, compression=None):
+    '''
+    Rewrite all objects in a cache folder (one file per object) or SQLite cache file in
+    the record format. Returns the number of objects converted
+    '''
+    import os
+    from .biocyc import AVAILABLE_OBJECT_TYPES # Registers the object types
+    from .stores import PickleDirectoryStore, SQLiteStore
+
+    if os.path.isdir(path):
+        store = PickleDirectoryStore(path, compression=compression)
+        org_ids = [org_id for org_id in os.listdir(path) if os.path.isdir(os.path.join(path, org_id))]
+    else:
+        store = SQLiteStore(path, compression=compression)
+        org_ids = store.org_ids()
+
+    count = 0
+    for org_id in sorted(org_ids):
+        ids = [id for id, _ in store.iter_created(org_id)]
+        for n in range(0, len(ids), 1000):
+            objs = [obj for obj in store.get_many(org_id, ids[n:n + 1000]).values() if hasattr(obj, 'created_at')]
+            store.put_many(objs)
+            count += len(objs)
+
+    store.close()
+    return count
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert a biocyc cache to the record format')
+    parser.add_argument('path', help='cache folder, or SQLite cache file')
+    parser.add_argument('--compression', choices=['zlib', 'zstd'], help='compress the records')
+    args = parser.parse_args()
+
+    print('%d objects converted' % convert(args.path, args.compression))
+
+
+if __name__ == '__main__':
+    main()
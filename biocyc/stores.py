@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Object cache backends
+
+A store holds the cached entities for any number of organisms, keyed by (org_id, id).
+BioCyc reads from its primary store then each secondary store in turn, and writes
+to the primary store only.
+
+"""
+import os
+import errno
+import logging
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from . import serialize
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+def atomic_write(path, data):
+    '''
+    Write data (bytes) to path via a temporary file and rename, so readers never see a partial file
+
+    The file is not fsynced: a crash of this process leaves either the old or the new file,
+    but after an OS crash or power loss recent writes may be lost.
+    '''
+    tmp = os.path.join(os.path.dirname(path), '.%s.%d.%d.tmp' % (os.path.basename(path), os.getpid(), threading.get_ident()))
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def timestamp(dt):
+    '''
+    Convert a (naive, local) datetime to seconds for storage, see from_timestamp
+    '''
+    return (dt - EPOCH).total_seconds()
+
+
+def from_timestamp(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def estimate_size(obj):
+    '''
+    Roughly approximate the memory used by an object (in the units of its record length)
+    from the number of frame IDs, synonyms and links it holds, without encoding it. Objects
+    read from a store are sized by their record instead (see CacheStore.get_many)
+    '''
+    size = 160
+    for name in getattr(obj, 'id_attributes', ()):
+        value = getattr(obj, name, None)
+        size += 24 * len(value) if isinstance(value, (list, tuple)) else 24
+    return size + 32 * len(getattr(obj, 'synonyms', ())) + 48 * len(getattr(obj, 'dblinks', ()))
+
+
+class LRUMemoryCache(object):
+    '''
+    In-memory object cache shared by all organisms, keyed by (org_id, id)
+
+    Objects are evicted least-recently-used first once their total approximate
+    size exceeds max_bytes. Hits, misses and evictions are counted for tuning.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._objs = OrderedDict() # (org_id, id): (obj, size), least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._objs)
+
+    def __contains__(self, key):
+        return key in self._objs
+
+    def get(self, org_id, id):
+        key = (org_id, id)
+        with self._lock:
+            if key in self._objs:
+                self._objs.move_to_end(key)
+                self.hits += 1
+                return self._objs[key][0]
+
+            self.misses += 1
+            return None
+
+    def put(self, obj, size=None):
+        if size is None:
+            size = estimate_size(obj)
+
+        key = (obj.org_id, obj.id)
+        with self._lock:
+            if key in self._objs:
+                self.size -= self._objs.pop(key)[1]
+
+            self._objs[key] = (obj, size)
+            self.size += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        # Always keep the most recent object, however large
+        while self.size > self.max_bytes and len(self._objs) > 1:
+            _, (_, evicted_size) = self._objs.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def remove(self, org_id, id):
+        with self._lock:
+            if (org_id, id) in self._objs:
+                self.size -= self._objs.pop((org_id, id))[1]
+
+    def clear(self):
+        with self._lock:
+            self._objs.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        return {
+            'entries': len(self._objs),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class CacheStore(object):
+    '''
+    Base class for object cache backends
+
+    Objects are written in the record format (see biocyc.serialize), compressed with
+    compression ('zlib', 'zstd' or None). Pickles written by earlier versions are read
+    unless allow_pickle is False. Records that cannot be decoded (e.g. damaged, or
+    written by a newer version) are logged and treated as missing, so they are refetched.
+    '''
+    name = 'store' # Used in metric names
+    read_only = False
+    compression = None
+    allow_pickle = True
+
+    def dumps(self, obj):
+        return serialize.dumps(obj, self.compression)
+
+    def loads(self, data, sized=False):
+        if sized:
+            return serialize.loads_sized(data, self.allow_pickle)
+        return serialize.loads(data, self.allow_pickle)
+
+    def load_record(self, org_id, id, data, sized=False):
+        # As loads, returning None for a record that cannot be decoded
+        try:
+            return self.loads(data, sized)
+        except Exception as e:
+            logging.warning('Skipping undecodable %s record %s:%s in %s: %s' % (self.name, org_id, id, getattr(self, 'path', self), e))
+            return None
+
+    def get(self, org_id, id, sized=False):
+        '''
+        Return the cached object for id, or None if it is not in the store. With sized
+        return (obj, size of its uncompressed record), see serialize.loads_sized
+        '''
+        raise NotImplementedError
+
+    def get_many(self, org_id, ids, sized=False):
+        '''
+        Return a dict of id: obj (or with sized, id: (obj, size), see get) for all ids
+        found in the store
+        '''
+        objs = {}
+        for id in ids:
+            obj = self.get(org_id, id, sized)
+            if obj is not None:
+                objs[id] = obj
+        return objs
+
+    def put(self, obj):
+        raise NotImplementedError
+
+    def put_many(self, objs):
+        for obj in objs:
+            self.put(obj)
+
+    def iter_created(self, org_id, before=None):
+        '''
+        Iterate (id, created_at) for all objects in the store for org_id, optionally
+        only those created before the given datetime
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PickleDirectoryStore(CacheStore):
+    '''
+    One file per object under <path>/<org_id>/<id>, originally pickles
+    '''
+    name = 'pickle'
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.compression = compression
+
+    def get(self, org_id, id, sized=False):
+        try:
+            with open(os.path.join(self.path, org_id, id), 'rb') as f:
+                return self.loads(f.read(), sized)
+        except Exception:
+            return None
+
+    def put(self, obj):
+        write_path = os.path.join(self.path, obj.org_id)
+        if not os.path.exists(write_path):
+            mkdir_p(write_path)
+
+        path = os.path.join(write_path, obj.id)
+        atomic_write(path, self.dumps(obj))
+        os.utime(path, (obj._created_at, obj._created_at)) # Keep the age, e.g. when converting
+
+    def iter_created(self, org_id, before=None):
+        # The file modification time is the time the object was cached
+        try:
+            entries = os.listdir(os.path.join(self.path, org_id))
+        except OSError:
+            return
+
+        for id in entries:
+            if id.startswith('.'): # Temporary and lock files
+                continue
+            created_at = datetime.fromtimestamp(os.path.getmtime(os.path.join(self.path, org_id, id)))
+            if before is None or created_at < before:
+                yield id, created_at
+
+
+class SQLiteDatabase(object):
+    '''
+    SQLite database file opened in WAL mode, with one connection per thread
+
+    Connections are opened per thread so the database can be shared by worker threads,
+    and WAL mode allows readers in other processes while one process writes.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        mkdir_p(os.path.dirname(os.path.abspath(path)))
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+class SQLiteStore(SQLiteDatabase, CacheStore):
+    '''
+    All objects in a single SQLite database (WAL mode), one row per (org_id, id)
+    '''
+    name = 'sqlite'
+    max_variables = 500 # Per IN (...) query in get_many
+
+    def __init__(self, path, compression=None):
+        super(SQLiteStore, self).__init__(path)
+        self.compression = compression
+        db = self.db
+        db.execute('CREATE TABLE IF NOT EXISTS objects (org_id TEXT NOT NULL, id TEXT NOT NULL, created_at REAL NOT NULL, data BLOB NOT NULL, PRIMARY KEY (org_id, id)) WITHOUT ROWID')
+        db.execute('CREATE INDEX IF NOT EXISTS objects_created_at ON objects (org_id, created_at)')
+        db.commit()
+
+    def get(self, org_id, id, sized=False):
+        row = self.db.execute('SELECT data FROM objects WHERE org_id=? AND id=?', (org_id, id)).fetchone()
+        if row is not None:
+            return self.load_record(org_id, id, row[0], sized)
+
+    def get_many(self, org_id, ids, sized=False):
+        objs = {}
+        ids = list(ids)
+        for n in range(0, len(ids), self.max_variables):
+            batch = ids[n:n + self.max_variables]
+            rows = self.db.execute('SELECT id, data FROM objects WHERE org_id=? AND id IN (%s)' % ','.join('?' * len(batch)), [org_id] + batch)
+            for id, data in rows:
+                obj = self.load_record(org_id, id, data, sized)
+                if obj is not None:
+                    objs[id] = obj
+        return objs
+
+    def put(self, obj):
+        self.put_many([obj])
+
+    def put_many(self, objs):
+        with self.db as db:
+            db.executemany('INSERT OR REPLACE INTO objects (org_id, id, created_at, data) VALUES (?, ?, ?, ?)', [
+                (obj.org_id, obj.id, timestamp(obj.created_at), self.dumps(obj)) for obj in objs
+            ])
+
+    def iter_created(self, org_id, before=None):
+        if before is None:
+            rows = self.db.execute('SELECT id, created_at FROM objects WHERE org_id=?', (org_id,))
+        else:
+            rows = self.db.execute('SELECT id, created_at FROM objects WHERE org_id=? AND created_at<?', (org_id, timestamp(before)))
+
+        for id, created_at in rows.fetchall():
+            yield id, from_timestamp(created_at)
+
+    def org_ids(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT org_id FROM objects')]
+
+    def import_pickle_directory(self, path, batch_size=1000):
+        '''
+        Migrate an existing pickle cache directory (<path>/<org_id>/<id>) into this store
+
+        Index files and anything else that does not load as a cached object are
+        skipped. Returns the number of objects imported.
+        '''
+        count = 0
+        for org_id in sorted(os.listdir(path)):
+            org_path = os.path.join(path, org_id)
+            if not os.path.isdir(org_path):
+                continue
+
+            batch = []
+            for id in os.listdir(org_path):
+                try:
+                    with open(os.path.join(org_path, id), 'rb') as f:
+                        obj = self.loads(f.read())
+                except Exception:
+                    continue
+
+                if not hasattr(obj, 'created_at') or getattr(obj, 'id', None) != id:
+                    continue
+
+                if getattr(obj, 'org_id', None) is None:
+                    obj.org_id = org_id
+
+                batch.append(obj)
+                if len(batch) >= batch_size:
+                    self.put_many(batch)
+                    count += len(batch)
+                    batch = []
+
+            self.put_many(batch)
+            count += len(batch)
+
+        return count
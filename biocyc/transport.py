@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Transports carry the requests made by BioCyc.requestxml
+
+    HTTPTransport       the web services, over a pooled keep-alive session (default)
+    OfflineTransport    no network: every request fails at once with BioCycOfflineError
+    ArchiveTransport    serves responses from an on-disk archive, recording any that are
+                        missing (mode='record') or failing as offline (mode='replay')
+
+Retries, backoff and the rate limit are applied by BioCyc.requestxml around the
+transport. Responses a transport can answer locally (lookup) skip the rate limit.
+
+"""
+from collections import namedtuple
+from urllib.parse import urlparse, urlencode
+
+from .exceptions import BioCycOfflineError
+from .stores import SQLiteDatabase
+
+# The parts of a requests.Response used by BioCyc
+Response = namedtuple('Response', ['status_code', 'headers', 'content'])
+
+
+class Transport(object):
+    '''
+    Base class for transports
+    '''
+    errors = () # Exceptions raised by get for failures that may be retried
+
+    def lookup(self, url, params):
+        '''
+        Return a response available without a network request, or None. Raises
+        BioCycOfflineError if the request cannot be made at all
+        '''
+        return None
+
+    def get(self, url, params, timeout=None):
+        '''
+        Request url, returning a response with status_code, headers and content
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HTTPTransport(Transport):
+    '''
+    Requests over a pooled keep-alive HTTP session
+    '''
+    def __init__(self, pool_maxsize=10):
+        import requests # Deferred, slow to import
+
+        self.errors = (requests.RequestException,)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, params, timeout=None):
+        return self.session.get(url, params=params, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+class OfflineTransport(Transport):
+    '''
+    Strict offline mode, for hosts without network access
+    '''
+    def lookup(self, url, params):
+        raise BioCycOfflineError('Offline, not requesting %s' % url)
+
+    def get(self, url, params, timeout=None):
+        return self.lookup(url, params)
+
+
+def request_key(url, params):
+    '''
+    Return the archive key for a request: the path and the sorted query, so archives
+    are independent of the server address
+    '''
+    return '%s?%s' % (urlparse(url).path, urlencode(sorted(params.items())))
+
+
+class ArchiveTransport(SQLiteDatabase, Transport):
+    '''
+    Record and replay responses (200 and 404 only) in a single SQLite file
+
+    getxml responses are also archived per object, so any batch of archived objects
+    can be replayed, whatever batches they were recorded in. In 'replay' mode a
+    request that is not in the archive raises BioCycOfflineError; in 'record' mode
+    it is passed to transport (default HTTPTransport) and the response archived.
+    '''
+    modes = ['replay', 'record']
+
+    def __init__(self, path, mode='replay', transport=None):
+        if mode not in self.modes:
+            raise ValueError('Archive mode must be one of %s' % ', '.join(self.modes))
+
+        super(ArchiveTransport, self).__init__(path)
+        self.mode = mode
+        self.transport = transport
+        if mode == 'record' and transport is None:
+            self.transport = HTTPTransport()
+        self.errors = self.transport.errors if self.transport is not None else ()
+
+        db = self.db
+        db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, status INTEGER NOT NULL, content BLOB NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS objects (org_id TEXT NOT NULL, id TEXT NOT NULL, xml BLOB, PRIMARY KEY (org_id, id)) WITHOUT ROWID') # NULL xml, not found
+        db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def lookup(self, url, params):
+        row = self.db.execute('SELECT status, content FROM responses WHERE key=?', (request_key(url, params),)).fetchone()
+        if row is not None:
+            return Response(row[0], {}, bytes(row[1]))
+
+        if urlparse(url).path.endswith('/getxml'):
+            r = self._lookup_objects(params)
+            if r is not None:
+                return r
+
+        if self.mode == 'replay':
+            raise BioCycOfflineError('%s is not in the archive %s' % (request_key(url, params), self.path))
+
+    def _lookup_objects(self, params):
+        ids = [id.partition(':') for id in params.get('id', '').split(',')]
+        xml = []
+        for org_id, _, id in ids:
+            row = self.db.execute('SELECT xml FROM objects WHERE org_id=? AND id=?', (org_id, id)).fetchone()
+            if row is None: # Not archived, as found or not found
+                return None
+            if row[0] is not None:
+                xml.append( bytes(row[0]) )
+
+        if not xml:
+            return Response(404, {}, b'')
+        return Response(200, {}, b'<ptools-xml><metadata/>' + b''.join(xml) + b'</ptools-xml>')
+
+    def get(self, url, params, timeout=None):
+        if self.mode == 'replay':
+            return self.lookup(url, params)
+
+        r = self.transport.get(url, params, timeout)
+        if r.status_code in (200, 404):
+            self.record(url, params, r)
+        return r
+
+    def record(self, url, params, r):
+        from xml.etree import ElementTree as et
+
+        objects = []
+        if urlparse(url).path.endswith('/getxml'):
+            found = {}
+            if r.status_code == 200:
+                try:
+                    for element in et.fromstring(r.content):
+                        if 'frameid' in element.attrib:
+                            found[element.attrib['frameid'].upper()] = et.tostring(element)
+                except et.ParseError: # Truncated, not archived (will be retried)
+                    return
+
+            ids = [id.partition(':') for id in params.get('id', '').split(',')]
+            objects = [(org_id, id, found.get(id.upper())) for org_id, _, id in ids]
+
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO responses (key, status, content) VALUES (?, ?, ?)', (request_key(url, params), r.status_code, r.content))
+            db.executemany('INSERT OR REPLACE INTO objects (org_id, id, xml) VALUES (?, ?, ?)', objects)
+
+    def close(self):
+        super(ArchiveTransport, self).close()
+        if self.transport is not None:
+            self.transport.close()
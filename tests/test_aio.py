@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.server import BioCycServer, synthetic_corpus
+from biocyc.aio import AsyncBioCyc
+from biocyc.biocyc import BioCyc, Compound
+from biocyc.locking import claim, release
+
+
+class AsyncSingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = BioCycServer( synthetic_corpus('BENCH', pathways=2, compounds=10) ).start()
+        self.biocyc = BioCyc(cache_path=self.path, organism='BENCH')
+        self.biocyc.base_url = self.server.url
+        self.biocyc.set_rate_limit(1e6, 1000)
+        self.biocyc.claim_poll_interval = 0.01
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_waits_for_ids_claimed_elsewhere(self):
+        # Another process is requesting CPD-1
+        claim_path = self.biocyc._claim_path('BENCH', 'CPD-1')
+        self.assertTrue( claim(claim_path, 60) )
+
+        async def run():
+            async with AsyncBioCyc(self.biocyc) as abc:
+                task = asyncio.ensure_future( abc.get_for_org('BENCH', ['CPD-1', 'CPD-2']) )
+                await asyncio.sleep(0.2)
+                self.assertFalse(task.done())
+
+                other = BioCyc(cache_path=self.path, organism='BENCH')
+                obj = Compound(id='CPD-1')
+                obj.org_id = 'BENCH'
+                obj.name = 'cached elsewhere'
+                other.cache(obj)
+                release(claim_path)
+                return await task
+
+        cpd1, cpd2 = asyncio.run( run() )
+        self.assertEqual(cpd1.name, 'cached elsewhere')
+        self.assertEqual(cpd2.id, 'CPD-2')
+        self.assertEqual(self.server.requests, 1) # CPD-2 only
+
+
+if __name__ == '__main__':
+    unittest.main()
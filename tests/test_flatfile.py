@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from biocyc.biocyc import BioCyc, Compound, Protein
+from biocyc.flatfile import load_flat_files, read_records
+
+FLAT_FILES = os.path.join(os.path.dirname(__file__), 'fixtures', 'flatfiles')
+
+
+class ReadRecordsTest(unittest.TestCase):
+    def test_records(self):
+        f = io.BytesIO(b'# comment\nUNIQUE-ID - A\nCOMMON-NAME - first line\n/second line\nLEFT - X\n^COEFFICIENT - 2\nCOMMENT -\n//\nUNIQUE-ID - B\n')
+        self.assertEqual(list(read_records(f)), [
+            [('UNIQUE-ID', 'A'), ('COMMON-NAME', 'first line\nsecond line'), ('LEFT', 'X'), ('LEFT^COEFFICIENT', '2'), ('COMMENT', '')],
+            [('UNIQUE-ID', 'B')], # No closing //
+        ])
+
+    def test_latin1(self):
+        f = io.BytesIO(b'UNIQUE-ID - G-1\nSYNONYMS - htpH \xe9\n//\n')
+        self.assertEqual(list(read_records(f)), [[('UNIQUE-ID', 'G-1'), ('SYNONYMS', 'htpH é')]])
+
+
+class LoadFlatFilesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.biocyc = BioCyc(cache_path=tempfile.mkdtemp(), organism='TEST')
+        cls.counts = load_flat_files(FLAT_FILES, 'test', biocyc=cls.biocyc)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.biocyc.cache_path, ignore_errors=True)
+
+    def get(self, id):
+        return self.biocyc.get_from_cache('TEST', id)
+
+    def test_counts(self):
+        self.assertEqual(dict(self.counts), {
+            'reactions.dat': 2, 'enzrxns.dat': 1, 'pathways.dat': 1, 'proteins.dat': 2, 'genes.dat': 1, 'compounds.dat': 2,
+        })
+        self.assertEqual(len(self.biocyc.known_reactions), 2)
+
+    def test_reaction(self):
+        r = self.get('RXN-1')
+        self.assertEqual(r.org_id, 'TEST')
+        self.assertEqual(r._compounds_left, ('PYRUVATE', 'NADH', 'PROTON')) # Annotations are not values
+        self.assertEqual(r._compounds_right, ('L-LACTATE', 'NAD'))
+        self.assertEqual(r._pathways, ('PWY-1',))
+        self.assertEqual(r._enzymatic_reactions, ('ENZRXN-1',))
+        self.assertEqual(r.direction, 'REVERSIBLE')
+        self.assertEqual(r.dblinks, {'RHEA': '16369'})
+        self.assertEqual(self.get('RXN-2')._compounds_left, ('PHOSPHO-ENOL-PYRUVATE', 'ADP')) # |Quoted|
+
+    def test_compound_sides(self):
+        # Collected from reactions.dat
+        pyruvate = self.get('PYRUVATE')
+        self.assertIsInstance(pyruvate, Compound)
+        self.assertEqual(pyruvate.reactions_in_left, ('RXN-1',))
+        self.assertEqual(pyruvate.reactions_in_right, ('RXN-2',))
+        self.assertEqual(self.get('ADP').reactions_in_left, ('RXN-2',))
+        self.assertEqual(self.get('ADP').reactions_in_right, ())
+
+    def test_compound(self):
+        pyruvate = self.get('PYRUVATE')
+        self.assertEqual(pyruvate.name, 'pyruvate')
+        self.assertEqual(pyruvate.molecular_weight, 87.055)
+        self.assertEqual(pyruvate.inchi, 'InChI=1S/C3H4O3/c1-2(4)3(5)6/h1H3,(H,5,6)/p-1')
+        self.assertEqual(pyruvate.synonyms, ['2-oxopropanoate'])
+        self.assertEqual(pyruvate.dblinks, {'CHEBI': '15361', 'LIGAND-CPD': 'C00022'})
+        self.assertEqual(pyruvate._parents, ('2-Oxo-carboxylates',))
+        self.assertIsNone(self.get('ADP').molecular_weight) # Unparseable, skipped
+
+    def test_pathway(self):
+        p = self.get('PWY-1')
+        self.assertEqual(p.name_as_html, 'pyruvate fermentation to <i>lactate</i>,\n via the long way round')
+        self.assertEqual(p.name, 'pyruvate fermentation to lactate,\n via the long way round')
+        self.assertEqual(p._parents, ('Fermentation', 'Pyruvate-Degradation'))
+        self.assertEqual(p._parent, 'Fermentation') # First value only
+        self.assertEqual(p._reactions, ('RXN-2', 'RXN-1'))
+        self.assertEqual(p._species, ('TAX-562',))
+        self.assertEqual(p._super_pathways, ('PWY-SUPER',))
+        self.assertEqual(p.synonyms, ['homolactic fermentation'])
+
+    def test_proteins(self):
+        complex = self.get('CPLX-1')
+        self.assertIsInstance(complex, Protein)
+        self.assertEqual(complex._components, ('PROT-1',))
+        self.assertEqual(complex.component_coefficient, 4) # From the ^COEFFICIENT annotation
+        self.assertEqual(complex._catalyzes, ('ENZRXN-1',))
+        self.assertEqual(complex.dblinks, {'UNIPROT': 'P52643', 'PDB': '4ZGS'})
+
+        protein = self.get('PROT-1')
+        self.assertEqual(protein._gene, 'G-1')
+        self.assertEqual(protein._complexes, ('CPLX-1',))
+        self.assertIsNone(protein.component_coefficient)
+
+    def test_enzymatic_reaction_and_gene(self):
+        enzrxn = self.get('ENZRXN-1')
+        self.assertEqual( (enzrxn._enzyme, enzrxn._reaction), ('PROT-1', 'RXN-1') )
+
+        gene = self.get('G-1')
+        self.assertEqual(gene._protein, 'PROT-1')
+        self.assertEqual(gene.synonyms, ['hslI', 'htpH é']) # Latin-1 file
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import unittest
+
+from xml.etree import ElementTree as et
+
+from biocyc.biocyc import BioCyc, BioCycEntityNotFound, Compound, Pathway
+from biocyc.transport import Response, Transport
+
+ENTITIES = {
+    'CPD-1': '<Compound ID="TEST:CPD-1" orgid="TEST" frameid="CPD-1"><common-name datatype="string">compound 1</common-name></Compound>',
+    'CPD-2': '<Compound ID="TEST:CPD-2" orgid="TEST" frameid="CPD-2"><common-name datatype="string">compound 2</common-name></Compound>',
+    'CPD-3': '<Compound ID="TEST:CPD-3" orgid="TEST" frameid="CPD-3"><common-name datatype="string">compound 3</common-name></Compound>',
+    'PWY-1': '<Pathway ID="TEST:PWY-1" orgid="TEST" frameid="PWY-1"><common-name datatype="string">pathway 1</common-name></Pathway>',
+}
+
+
+def response(*entities):
+    return et.fromstring('<ptools-xml><metadata/>%s</ptools-xml>' % ''.join(entities))
+
+
+class CannedTransport(Transport):
+    '''
+    Answers getxml requests from ENTITIES, recording the ids of each request
+    '''
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, params, timeout=None):
+        ids = [id.partition(':')[2] for id in params['id'].split(',')]
+        self.requests.append(ids)
+        found = [ENTITIES[id] for id in ids if id in ENTITIES]
+        if not found:
+            return Response(404, {}, b'')
+        return Response(200, {}, ('<ptools-xml><metadata/>%s</ptools-xml>' % ''.join(found)).encode('utf-8'))
+
+
+class CreateObjsFromXMLTest(unittest.TestCase):
+    def setUp(self):
+        self.biocyc = BioCyc(cache_path=tempfile.mkdtemp(), organism='TEST')
+
+    def tearDown(self):
+        shutil.rmtree(self.biocyc.cache_path, ignore_errors=True)
+
+    def test_objects_by_frameid(self):
+        objs = self.biocyc.create_objs_from_xml(['PWY-1', 'cpd-2'], response(ENTITIES['CPD-2'], ENTITIES['PWY-1']), 'TEST')
+        self.assertIsInstance(objs['PWY-1'], Pathway)
+        self.assertEqual(objs['PWY-1'].name, 'pathway 1')
+        self.assertIsInstance(objs['cpd-2'], Compound) # Matched case-insensitively
+        self.assertEqual(objs['cpd-2'].name, 'compound 2')
+
+    def test_missing_objects_are_not_found(self):
+        objs = self.biocyc.create_objs_from_xml(['CPD-1', 'CPD-9'], response(ENTITIES['CPD-1']), 'TEST')
+        self.assertEqual(objs['CPD-1'].name, 'compound 1')
+        self.assertIsInstance(objs['CPD-9'], BioCycEntityNotFound)
+        self.assertEqual( (objs['CPD-9'].id, objs['CPD-9'].org_id), ('CPD-9', 'TEST') )
+
+        objs = self.biocyc.create_objs_from_xml(['CPD-1'], None, 'TEST') # 404
+        self.assertIsInstance(objs['CPD-1'], BioCycEntityNotFound)
+
+    def test_anonymous_element_for_single_id(self):
+        anonymous = '<Compound ID="TEST:CPD-1" orgid="TEST"><common-name datatype="string">compound 1</common-name></Compound>'
+        objs = self.biocyc.create_objs_from_xml(['CPD-1'], response(anonymous), 'TEST')
+        self.assertIsInstance(objs['CPD-1'], Compound)
+        self.assertEqual(objs['CPD-1'].name, 'compound 1')
+
+        # Ambiguous with more than one requested id
+        objs = self.biocyc.create_objs_from_xml(['CPD-1', 'CPD-2'], response(anonymous), 'TEST')
+        self.assertIsInstance(objs['CPD-1'], BioCycEntityNotFound)
+        self.assertIsInstance(objs['CPD-2'], BioCycEntityNotFound)
+
+
+class BatchedRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.biocyc = BioCyc(cache_path=tempfile.mkdtemp(), organism='TEST')
+        self.biocyc.set_rate_limit(1e6, 1000)
+        self.biocyc.max_ids_per_request = 2
+        self.transport = CannedTransport()
+        self.biocyc.set_transport(self.transport)
+
+    def tearDown(self):
+        shutil.rmtree(self.biocyc.cache_path, ignore_errors=True)
+
+    def test_ids_split_across_responses(self):
+        ids = ['CPD-1', 'CPD-2', 'CPD-9', 'PWY-1', 'CPD-3']
+        objs = self.biocyc.get(ids)
+        self.assertEqual(self.transport.requests, [['CPD-1', 'CPD-2'], ['CPD-9', 'PWY-1'], ['CPD-3']])
+        self.assertEqual([obj.id if obj else None for obj in objs], ['CPD-1', 'CPD-2', None, 'PWY-1', 'CPD-3'])
+        self.assertEqual(objs[3].name, 'pathway 1')
+
+        # All cached, including the not found marker
+        self.assertEqual([obj.id if obj else None for obj in self.biocyc.get(ids)], ['CPD-1', 'CPD-2', None, 'PWY-1', 'CPD-3'])
+        self.assertEqual(len(self.transport.requests), 3)
+        self.assertIsInstance(self.biocyc.get_many_from_cache('TEST', ['CPD-9'])['CPD-9'], BioCycEntityNotFound)
+
+
+if __name__ == '__main__':
+    unittest.main()
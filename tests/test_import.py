@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from xml.etree import ElementTree as et
+
+from biocyc.biocyc import BioCyc, EnzymaticReaction
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# entities.json holds the attributes set by the per-type importers (the _import_*
+# methods) replaced by the tag-dispatched import_from_xml, for each entity in entities.xml
+
+
+def plain(state):
+    # As stored in entities.json: no creation time, tuples as lists
+    state = dict(state)
+    state.pop('_created_at', None)
+    return json.loads(json.dumps(state))
+
+
+class ImportFromXMLTest(unittest.TestCase):
+    def setUp(self):
+        self.biocyc = BioCyc(cache_path=tempfile.mkdtemp(), organism='TEST')
+        self.xml = et.parse(os.path.join(FIXTURES, 'entities.xml')).getroot()
+        with open(os.path.join(FIXTURES, 'entities.json')) as f:
+            self.expected = json.load(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.biocyc.cache_path, ignore_errors=True)
+
+    def test_same_attributes_as_per_type_importers(self):
+        objs = self.biocyc.create_objs_from_xml(sorted(self.expected), self.xml, 'TEST')
+        self.assertEqual(
+            sorted(set(type(obj).__name__ for obj in objs.values())),
+            ['Compound', 'EnzymaticReaction', 'Gene', 'Organism', 'Pathway', 'Protein', 'Reaction'],
+        )
+        for id, (type_name, state) in sorted(self.expected.items()):
+            with self.subTest(id=id):
+                self.assertEqual(type(objs[id]).__name__, type_name)
+                self.assertEqual(plain(objs[id].__getstate__()), state)
+
+    def test_embedded_enzymatic_reactions_cached(self):
+        self.biocyc.create_objs_from_xml(['RXN-1'], self.xml, 'TEST')
+        enzrxn = self.biocyc.get_many_from_cache('TEST', ['ENZRXN-1'])['ENZRXN-1']
+        self.assertIsInstance(enzrxn, EnzymaticReaction)
+        self.assertEqual( (enzrxn.name, enzrxn._enzyme, enzrxn._reaction), ('lactate dehydrogenase', 'PROT-1', 'RXN-1') )
+
+
+if __name__ == '__main__':
+    unittest.main()
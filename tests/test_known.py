@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import unittest
+
+from biocyc.biocyc import BioCyc, Compound
+
+
+def compound(id):
+    obj = Compound(id=id)
+    obj.org_id = 'TEST'
+    return obj
+
+
+class KnownObjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.biocyc = BioCyc(cache_path=tempfile.mkdtemp(), organism='TEST')
+        self.biocyc.cache( compound('CPD-1') )
+
+    def tearDown(self):
+        shutil.rmtree(self.biocyc.cache_path, ignore_errors=True)
+
+    def test_reused_until_objects_added(self):
+        known = self.biocyc.known_compounds
+        self.assertIs(self.biocyc.known_compounds, known)
+        self.assertIn('CPD-1', known)
+        self.assertNotIn('CPD-2', known)
+
+        self.biocyc.cache( compound('CPD-1') ) # Already known
+        self.assertIs(self.biocyc.known_compounds, known)
+
+        self.biocyc.cache( compound('CPD-2') )
+        known = self.biocyc.known_compounds
+        self.assertEqual(known.ids, ('CPD-1', 'CPD-2'))
+        self.assertIn('CPD-2', known)
+        self.assertEqual(len(self.biocyc.known_pathways), 0)
+
+    def test_objects(self):
+        self.assertEqual([obj.id for obj in self.biocyc.known_compounds], ['CPD-1'])
+        self.assertEqual(self.biocyc.known_compounds[0].id, 'CPD-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import shutil
+import tempfile
+import unittest
+
+from biocyc.biocyc import BioCyc, Pathway, Reaction
+from biocyc.network import NetworkIndex
+
+
+def pathway(biocyc, id, reactions):
+    obj = Pathway(id=id, biocyc=biocyc)
+    obj.org_id = 'TEST'
+    obj._reactions = tuple(reactions)
+    return obj
+
+
+def add_and_save(path, edge, loaded=None, go=None):
+    index = NetworkIndex(path) # Loaded before the other process saves
+    if loaded is not None:
+        loaded.set()
+        go.wait(30)
+    index._add_edges([edge])
+    index.save()
+
+
+class NetworkSaveTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_concurrent_saves_keep_all_edges(self):
+        # B loads the (empty) index, then A adds and saves an edge, then B adds and saves its own
+        loaded, go = multiprocessing.Event(), multiprocessing.Event()
+        b = multiprocessing.Process(target=add_and_save, args=(self.path, ('reaction-pathway', 'R2', 'P2'), loaded, go))
+        b.start()
+        self.assertTrue(loaded.wait(30))
+
+        a = multiprocessing.Process(target=add_and_save, args=(self.path, ('reaction-pathway', 'R1', 'P1')))
+        a.start()
+        a.join(30)
+        self.assertEqual(a.exitcode, 0)
+
+        go.set()
+        b.join(30)
+        self.assertEqual(b.exitcode, 0)
+
+        index = NetworkIndex(self.path)
+        self.assertEqual(index.pending, 0)
+        self.assertEqual(sorted(index._nodes), ['P1', 'P2', 'R1', 'R2'])
+        self.assertEqual(index.neighbors('R1', 'reaction-pathway'), ['P1'])
+        self.assertEqual(index.neighbors('R2', 'reaction-pathway'), ['P2'])
+        self.assertEqual(index.neighbors('P1', 'reaction-pathway', reverse=True), ['R1'])
+        self.assertEqual(index.neighbors('P2', 'reaction-pathway', reverse=True), ['R2'])
+
+
+class NetworkUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.builder = BioCyc(cache_path=self.path, organism='TEST')
+        self.builder.cache( pathway(self.builder, 'PWY-0', ['RXN-0']) )
+        self.builder.build_network()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_edges_cached_by_other_instances(self):
+        # The writer never loaded the network itself
+        writer = BioCyc(cache_path=self.path, organism='TEST')
+        writer.cache( pathway(writer, 'PWY-1', ['RXN-1-0']) )
+
+        reader = BioCyc(cache_path=self.path, organism='TEST')
+        self.assertEqual(reader.network().neighbors('PWY-1', 'reaction-pathway', reverse=True), ['RXN-1-0'])
+        self.assertEqual(self.builder.network().neighbors('PWY-1', 'reaction-pathway', reverse=True), ['RXN-1-0'])
+
+    def test_journal_compacted(self):
+        writer = BioCyc(cache_path=self.path, organism='TEST')
+        writer.network_journal_edges = 10
+        with writer.buffered_writes():
+            for n in range(2, 20):
+                writer.cache( pathway(writer, 'PWY-%d' % n, ['RXN-%d-0' % n]) )
+
+        network = self.builder.network()
+        self.assertLessEqual(network.pending, 10)
+        self.assertEqual(network.neighbors('RXN-19-0', 'reaction-pathway'), ['PWY-19'])
+
+    def test_membership_follows_other_instances(self):
+        self.assertEqual(self.builder.pathway_membership().pathways_of('CPD-1'), [])
+
+        writer = BioCyc(cache_path=self.path, organism='TEST')
+        reaction = Reaction(id='RXN-1', biocyc=writer)
+        reaction.org_id = 'TEST'
+        reaction._compounds_left = ('CPD-1',)
+        reaction._pathways = ('PWY-1',)
+        writer.cache(reaction)
+
+        self.assertEqual(self.builder.pathway_membership().pathways_of('CPD-1'), ['PWY-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
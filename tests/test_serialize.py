@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import copyreg
+import pickle
+import unittest
+
+from datetime import datetime
+
+from biocyc import serialize
+from biocyc.biocyc import BioCycEntityNotFound, Compound, Protein
+
+
+def compound():
+    obj = Compound(id='CPD-1')
+    obj.org_id = 'TEST'
+    obj.name = 'pyruvate'
+    obj.name_as_html = '<i>pyruvate</i>'
+    obj.synonyms = ['2-oxopropanoate', 'α-ketopropionate']
+    obj.dblinks = {'CHEBI': '15361'}
+    obj.molecular_weight = 87.055
+    obj.reactions_in_left = ('RXN-1', 'RXN-2')
+    return obj
+
+
+class LegacyPickle(object):
+    '''
+    Pickles as an object of cls with the given __dict__, as the classes before __slots__ did
+    '''
+    def __init__(self, cls, state):
+        self.cls = cls
+        self.state = state
+
+    def __reduce__(self):
+        return (copyreg._reconstructor, (self.cls, object, None), self.state)
+
+
+class SerializeTest(unittest.TestCase):
+    def assertSameObject(self, obj, expected):
+        self.assertIs(type(obj), type(expected))
+        self.assertEqual(obj.__getstate__(), expected.__getstate__())
+
+    def test_round_trip(self):
+        obj = compound()
+        for compression in [None, 'zlib']:
+            with self.subTest(compression=compression):
+                data = serialize.dumps(obj, compression)
+                self.assertTrue(serialize.is_record(data))
+                self.assertSameObject(serialize.loads(data), obj)
+                self.assertSameObject(serialize.loads(memoryview(data)), obj)
+
+                loaded, size = serialize.loads_sized(data)
+                self.assertSameObject(loaded, obj)
+                self.assertEqual(size, len(serialize.dumps(obj)) - 5) # Uncompressed payload
+
+    def test_zlib_compresses(self):
+        obj = compound()
+        obj.synonyms = ['synonym %d' % (n % 5) for n in range(200)]
+        self.assertLess(len(serialize.dumps(obj, 'zlib')), len(serialize.dumps(obj)))
+
+    @unittest.skipIf(serialize.zstandard is None, 'zstandard not installed')
+    def test_zstd_round_trip(self):
+        obj = compound()
+        self.assertSameObject(serialize.loads(serialize.dumps(obj, 'zstd')), obj)
+
+    @unittest.skipIf(serialize.zstandard is not None, 'zstandard installed')
+    def test_zstd_needs_zstandard(self):
+        with self.assertRaises(ValueError):
+            serialize.dumps(compound(), 'zstd')
+
+    def test_not_found_marker(self):
+        obj = serialize.loads(serialize.dumps(BioCycEntityNotFound('CPD-9', 'TEST')))
+        self.assertIsInstance(obj, BioCycEntityNotFound)
+        self.assertEqual( (obj.id, obj.org_id), ('CPD-9', 'TEST') )
+        self.assertFalse(obj)
+
+    def test_pickle_fallback(self):
+        obj = compound()
+        data = pickle.dumps(obj)
+        self.assertFalse(serialize.is_record(data))
+        self.assertSameObject(serialize.loads(data), obj)
+        with self.assertRaises(ValueError):
+            serialize.loads(data, allow_pickle=False)
+
+    def test_legacy_pickle_renamed_attributes(self):
+        created_at = datetime(2015, 3, 1, 12, 0)
+        data = pickle.dumps( LegacyPickle(Protein, {
+            'id': 'PROT-1',
+            'org_id': 'TEST',
+            'type': 'protein', # Now derived from the class
+            'created_at': created_at,
+            'component_coeffecient': 4,
+            '_gene': 'G-1',
+        }) )
+        obj = serialize.loads(data)
+        self.assertIsInstance(obj, Protein)
+        self.assertEqual(obj.component_coefficient, 4)
+        self.assertEqual(obj.created_at, created_at)
+        self.assertEqual(obj._gene, 'G-1')
+
+        # And kept under the new name when written as a record
+        self.assertEqual(serialize.loads(serialize.dumps(obj)).component_coefficient, 4)
+
+    def test_invalid_records(self):
+        with self.assertRaises(ValueError):
+            serialize.loads(b'BCR\x09\x00[]') # Newer format version
+        with self.assertRaises(ValueError):
+            serialize.loads(b'BCR\x01\x00["NoSuchType", {}]')
+        with self.assertRaises(ValueError):
+            serialize.dumps(compound(), 'lzma')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from biocyc.biocyc import BioCyc, Compound
+from biocyc.bundle import BundleStore, export_bundle
+from biocyc.stores import SQLiteStore
+
+
+def compound(id, name):
+    obj = Compound(id=id)
+    obj.org_id = 'TEST'
+    obj.name = name
+    return obj
+
+
+class SQLiteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = SQLiteStore(os.path.join(self.path, 'cache.sqlite'))
+        self.store.put_many([compound('CPD-1', 'one'), compound('CPD-2', 'two')])
+        with self.store.db as db: # Damage one row
+            db.execute("UPDATE objects SET data=? WHERE id='CPD-2'", (b'BCR\x01\x00[not json',))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_undecodable_rows_are_missing(self):
+        with self.assertLogs(level='WARNING'):
+            objs = self.store.get_many('TEST', ['CPD-1', 'CPD-2'])
+        self.assertEqual(list(objs), ['CPD-1'])
+        self.assertEqual(objs['CPD-1'].name, 'one')
+
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(self.store.get('TEST', 'CPD-2'))
+
+    def test_undecodable_rows_do_not_fail_batches(self):
+        biocyc = BioCyc(cache_path=self.path, organism='TEST')
+        biocyc.set_cache_store(self.store)
+        with self.assertLogs(level='WARNING'):
+            objs = biocyc.get_many_from_cache('TEST', ['CPD-1', 'CPD-2'])
+        self.assertEqual(list(objs), ['CPD-1'])
+
+
+class BundleStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        store = SQLiteStore(os.path.join(self.path, 'cache.sqlite'))
+        store.put_many([compound('CPD-1', 'one'), compound('CPD-2', 'two')])
+        self.bundle = os.path.join(self.path, 'TEST.bundle')
+        export_bundle([store], 'TEST', self.bundle)
+        store.close()
+
+        with open(self.bundle, 'r+b') as f: # Damage the record for CPD-2
+            data = f.read()
+            f.seek(data.index(b'"two"'))
+            f.write(b'\xff\xff')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_undecodable_records_are_missing(self):
+        store = BundleStore(self.bundle)
+        try:
+            self.assertEqual(store.get('TEST', 'CPD-1').name, 'one')
+            with self.assertLogs(level='WARNING'):
+                self.assertIsNone(store.get('TEST', 'CPD-2'))
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(list(store.get_many('TEST', ['CPD-1', 'CPD-2'])), ['CPD-1'])
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()